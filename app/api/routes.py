@@ -1,25 +1,39 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import json
+import math
+import mimetypes
 import os
+import shutil
 import time
 import uuid
+import zlib
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
 
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile
-from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi import APIRouter, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 
+from app.core import metrics
 from app.core.config import Config, get_config
 from app.core.db import Database
+from app.core.blobs import BlobStore, is_sha256
 from app.core.cache import CacheStore, LockManager
-from app.core.tasks import TaskStore
+from app.core.models import JobState
+from app.core.tasks import TERMINAL_STATES, StatusCache, TaskStore
+from app.core.uploads import UploadError, UploadStore
 from app.core.storage import write_bytes, safe_name
 from app.core.proc import download_to
-from app.core.convert import rewrite_conf_imports_to_default, compute_cache_key
+from app.core.convert import rewrite_conf_imports_to_default, compute_cache_key, cache_key_options
 from app.core.stylemap import prepare_effective_xsls
-from app.services.job_manager import JobManager
+from app.core.jvm import docx_stats
+from app.core.package import entry_digests, load_entries, stream_zip
+from app.core.preflight import CostModel, PreflightError, PreflightLimits, analyze_docx, poll_interval_sec
+from app.services.job_manager import MAX_DEADLINE_SEC, JobManager, QueueFull
 
 from app.core.filenames import sanitize_filename
 
@@ -33,8 +47,17 @@ class Ctx:
         self.db.init_schema()
         self.cache = CacheStore(self.db, self.cfg.data_root)
         self.locks = LockManager(self.db)
-        self.tasks = TaskStore(self.db)
+        status_cache = None
+        if self.cfg.status_cache_size > 0:
+            status_cache = StatusCache(self.db, self.cfg.status_cache_size, self.cfg.status_cache_check_sec)
+        self.tasks = TaskStore(
+            self.db,
+            write_behind_sec=self.cfg.task_write_behind_sec,
+            status_cache=status_cache,
+        )
         self.jobs = JobManager(self.cfg, self.tasks, self.cache, self.locks, workers=2)
+        self.blobs = BlobStore(self.cfg.data_root / "inputs")
+        self.uploads = UploadStore(self.cfg.data_root / "uploads", self.cfg.max_upload_bytes)
 
 
 ctx = Ctx()
@@ -43,6 +66,21 @@ ctx = Ctx()
 def healthz():
     return {"status": "ok"}
 
+
+@router.get("/readyz")
+def readyz():
+    """Readiness for load balancers: 503 while the job queue is at its limits."""
+    load = ctx.jobs.queue_load()
+    if load["saturated"]:
+        excess = max(1, load["queued_jobs"] - load["max_jobs"] + 1) if load["max_jobs"] > 0 else 1
+        return JSONResponse(
+            {"status": "saturated", "queue": load},
+            status_code=503,
+            headers={"Retry-After": str(ctx.jobs.retry_after(excess))},
+        )
+    return {"status": "ready", "queue": load}
+
+
 @router.get("/version")
 def version():
     return {
@@ -51,6 +89,19 @@ def version():
     }
 
 
+@router.get("/metrics")
+def get_metrics():
+    """Prometheus text format, aggregated over all uvicorn workers."""
+    extra: dict[str, float] = {}
+    try:
+        extra["docx2tex_cache_entries"] = ctx.cache.count_available()
+        extra["docx2tex_cache_bytes"] = ctx.cache.disk_usage()
+    except Exception:
+        pass
+    body = metrics.render(metrics.REGISTRY.collect(ctx.cfg.metrics_dir), extra)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @router.post("/v1/task")
 async def create_task(
     file: UploadFile | None = File(default=None),
@@ -65,10 +116,17 @@ async def create_task(
     TableModel: str | None = Form(default=None),
     FontMapsZip: UploadFile | None = File(default=None),
     image_dir: str | None = Form(default=None),
+    img_optimize: bool = Form(default=False),
+    docx_sha256: str | None = Form(default=None),
+    filename: str | None = Form(default=None),
+    priority: int = Form(default=0),
+    deadline_sec: float | None = Form(default=None),
 ):
     prep = await _prepare_job_request(
         file=file,
         url=url,
+        docx_sha256=docx_sha256,
+        filename=filename,
         debug=debug,
         img_post_proc=img_post_proc,
         conf=conf,
@@ -77,23 +135,27 @@ async def create_task(
         style_map=StyleMap,
         fontmaps_zip=FontMapsZip,
         image_dir=image_dir,
+        deadline_sec=deadline_sec,
     )
 
-    cache_key = compute_cache_key(
-        prep.input_docx,
-        prep.conf_path or _default_conf_path(),
-        prep.custom_xsl_path,
-        prep.custom_evolve_path,
-        (MathTypeSource or None),
-        (TableModel or None),
-        (prep.fontmaps_zip_path or None),
-    )
+    with ctx.jobs.stage(prep.job.task_id, "hashing"):
+        cache_key = compute_cache_key(
+            prep.input_docx,
+            prep.conf_path or _default_conf_path(),
+            prep.custom_xsl_path,
+            prep.custom_evolve_path,
+            (MathTypeSource or None),
+            (TableModel or None),
+            (prep.fontmaps_zip_path or None),
+            docx_hash=prep.docx_hash,
+        )
     cache_status = "MISS"
     row = ctx.cache.get(cache_key)
     if row and int(row.get("available", 0)) == 1:
         cache_status = "HIT"
     elif row and int(row.get("available", 0)) == 0:
         cache_status = "BUILDING"
+    metrics.inc("docx2tex_cache_requests_total", status=cache_status)
 
     # Submit background job
     ctx.jobs.submit(
@@ -112,9 +174,13 @@ async def create_task(
         job_cache_key=cache_key,
         no_cache=False,
         image_dir=prep.image_dir,
+        img_optimize=img_optimize,
+        priority=priority,
     )
 
-    return JSONResponse({"task_id": prep.job.task_id, "cache_key": cache_key, "cache_status": cache_status})
+    return JSONResponse(
+        {"task_id": prep.job.task_id, "cache_key": cache_key, "cache_status": cache_status, "preflight": prep.preflight}
+    )
 
 
 @router.post("/v1/nocache")
@@ -162,41 +228,549 @@ async def create_task_nocache(
         no_cache=True,
         image_dir=prep.image_dir,
     )
+    metrics.inc("docx2tex_cache_requests_total", status="BYPASS")
+
+    return JSONResponse({"task_id": prep.job.task_id, "cache_status": "BYPASS", "preflight": prep.preflight})
+
+
+@router.head("/v1/blobs/{sha256}")
+def head_blob(sha256: str):
+    """200 when the input store holds this DOCX digest (then submit with docx_sha256=), else 404."""
+    sha = sha256.strip().lower()
+    if not is_sha256(sha):
+        return Response(status_code=400)
+    if not ctx.blobs.has(sha):
+        return Response(status_code=404)
+    return Response(status_code=200, headers={"X-Blob-Size": str(ctx.blobs.path(sha).stat().st_size)})
+
+
+def _upload_http_error(e: UploadError) -> HTTPException:
+    headers = {"Upload-Offset": str(e.offset)} if e.offset is not None else None
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers=headers)
+
+
+@router.post("/v1/uploads")
+def create_upload(filename: str = Form(default="document.docx"), size: int | None = Form(default=None)):
+    """Open a resumable upload session; send the bytes with PUT, then finalize."""
+    try:
+        sess = ctx.uploads.create(filename, size)
+    except UploadError as e:
+        raise _upload_http_error(e)
+    return JSONResponse({"upload_id": sess["upload_id"], "offset": 0, "size": size})
+
+
+@router.get("/v1/uploads/{upload_id}")
+def get_upload(upload_id: str):
+    try:
+        sess = ctx.uploads.get(upload_id)
+    except UploadError as e:
+        raise _upload_http_error(e)
+    body = {k: sess.get(k) for k in ("upload_id", "filename", "size", "offset")}
+    return JSONResponse(body, headers={"Upload-Offset": str(sess["offset"])})
+
+
+@router.put("/v1/uploads/{upload_id}")
+async def put_upload_chunk(upload_id: str, request: Request, offset: int):
+    """Append the raw request body at `offset` (the session's current size)."""
+    try:
+        with ctx.uploads.open_append(upload_id, offset) as writer:
+            async for chunk in request.stream():
+                await run_in_threadpool(writer.write, chunk)
+            new_offset = writer.pos
+    except UploadError as e:
+        raise _upload_http_error(e)
+    metrics.inc("docx2tex_upload_bytes_total", new_offset - offset, kind="chunked")
+    return JSONResponse({"upload_id": upload_id, "offset": new_offset}, headers={"Upload-Offset": str(new_offset)})
+
+
+@router.delete("/v1/uploads/{upload_id}")
+def delete_upload(upload_id: str):
+    try:
+        ctx.uploads.get(upload_id)
+        ctx.uploads.discard(upload_id)
+    except UploadError as e:
+        raise _upload_http_error(e)
+    return JSONResponse({"upload_id": upload_id, "deleted": True})
+
+
+@router.post("/v1/uploads/{upload_id}/finalize")
+async def finalize_upload(
+    upload_id: str,
+    sha256: str | None = Form(default=None),
+    debug: bool = Form(default=False),
+    img_post_proc: bool = Form(default=True),
+    conf: UploadFile | None = File(default=None),
+    custom_xsl: UploadFile | None = File(default=None),
+    custom_evolve: UploadFile | None = File(default=None),
+    StyleMap: str | None = Form(default=None),
+    MathTypeSource: str | None = Form(default=None),
+    TableModel: str | None = Form(default=None),
+    FontMapsZip: UploadFile | None = File(default=None),
+    image_dir: str | None = Form(default=None),
+    img_optimize: bool = Form(default=False),
+    priority: int = Form(default=0),
+    deadline_sec: float | None = Form(default=None),
+):
+    """Complete an upload and submit it as a task (same options as POST /v1/task).
+
+    The data moves into the input store and the task references it by digest;
+    the session is sealed first, so later PUTs get 409. It is kept until the task is created, so a rejected submission
+    (429, pre-flight 413/422, ...) can be retried without uploading again.
+    """
+    try:
+        data, digest, sess = await run_in_threadpool(ctx.uploads.finish, upload_id, sha256)
+    except UploadError as e:
+        raise _upload_http_error(e)
+    if data is not None:
+        # Moved, not linked: the session file must never share the blob's inode
+        await run_in_threadpool(ctx.blobs.put, data, digest, True)
+    resp = await create_task(
+        file=None,
+        url=None,
+        debug=debug,
+        img_post_proc=img_post_proc,
+        conf=conf,
+        custom_xsl=custom_xsl,
+        custom_evolve=custom_evolve,
+        StyleMap=StyleMap,
+        MathTypeSource=MathTypeSource,
+        TableModel=TableModel,
+        FontMapsZip=FontMapsZip,
+        image_dir=image_dir,
+        img_optimize=img_optimize,
+        docx_sha256=digest,
+        filename=sess.get("filename"),
+        priority=priority,
+        deadline_sec=deadline_sec,
+    )
+    ctx.uploads.discard(upload_id)
+    return resp
+
+
+@router.post("/v1/batch")
+async def create_batch(
+    files: list[UploadFile] | None = File(default=None),
+    urls: str | None = Form(default=None),
+    debug: bool = Form(default=False),
+    img_post_proc: bool = Form(default=True),
+    conf: UploadFile | None = File(default=None),
+    custom_xsl: UploadFile | None = File(default=None),
+    custom_evolve: UploadFile | None = File(default=None),
+    StyleMap: str | None = Form(default=None),
+    MathTypeSource: str | None = Form(default=None),
+    TableModel: str | None = Form(default=None),
+    FontMapsZip: UploadFile | None = File(default=None),
+    image_dir: str | None = Form(default=None),
+    img_optimize: bool = Form(default=False),
+    priority: int = Form(default=0),
+    deadline_sec: float | None = Form(default=None),
+):
+    """Submit many documents sharing one set of options.
+
+    Shared inputs (conf, XSLs, StyleMap, fontmaps) are stored and processed
+    once per batch, and their contribution to the cache key is read once.
+    """
+    url_list = [u.strip() for u in (urls or "").splitlines() if u.strip()]
+    sources: list[tuple[UploadFile | None, str | None]] = [(f, None) for f in (files or [])]
+    sources += [(None, u) for u in url_list]
+    if not sources:
+        raise HTTPException(status_code=400, detail="Provide at least one file or url")
+    _check_deadline(deadline_sec)
+    _admit(jobs=len(sources))
+
+    batch_id = str(uuid.uuid4())
+    shared = ctx.cfg.data_root / "batches" / batch_id / "shared"
+    shared.mkdir(parents=True, exist_ok=True)
+    conf_path, xsl_path, evolve_path, fontmaps_zip_path = await _prepare_optional_inputs(
+        work=shared,
+        conf=conf,
+        custom_xsl=custom_xsl,
+        custom_evolve=custom_evolve,
+        style_map=StyleMap,
+        fontmaps_zip=FontMapsZip,
+    )
+    key_options = cache_key_options(
+        conf_path or _default_conf_path(),
+        xsl_path,
+        evolve_path,
+        (MathTypeSource or None),
+        (TableModel or None),
+        fontmaps_zip_path,
+    )
+    image_dir_name = _resolve_image_dir(image_dir)
+
+    tasks = []
+    for upload, url in sources:
+        js = ctx.jobs.create(debug=debug, img_post_proc=img_post_proc, batch_id=batch_id, deadline_sec=deadline_sec)
+        if debug:
+            _link_shared_artifacts(shared, Path(js.work_dir))
+        item = {"task_id": js.task_id, "source": (upload.filename if upload is not None else url) or ""}
+        try:
+            with ctx.jobs.stage(js.task_id, "input") as st:
+                input_docx, source_kind, source_value, docx_hash = await _receive_input(
+                    Path(js.work_dir), upload, url, task_id=js.task_id
+                )
+                st.update(kind=source_kind, bytes=input_docx.stat().st_size)
+            _admit_input(js, input_docx)
+            preflight = _run_preflight(js.task_id, input_docx, img_post_proc)
+        except HTTPException as e:
+            ctx.jobs.set_state(js.task_id, "failed", str(e.detail))
+            tasks.append({**item, "state": "failed", "err_msg": str(e.detail)})
+            continue
+        except Exception as e:
+            ctx.jobs.set_state(js.task_id, "failed", f"input failed: {e}")
+            tasks.append({**item, "state": "failed", "err_msg": f"input failed: {e}"})
+            continue
+        with ctx.jobs.stage(js.task_id, "hashing"):
+            cache_key = compute_cache_key(input_docx, None, None, options=key_options, docx_hash=docx_hash)
+        row = ctx.cache.get(cache_key)
+        cache_status = "MISS"
+        if row and int(row.get("available", 0)) == 1:
+            cache_status = "HIT"
+        elif row and int(row.get("available", 0)) == 0:
+            cache_status = "BUILDING"
+        metrics.inc("docx2tex_cache_requests_total", status=cache_status)
+        ctx.jobs.submit(
+            task_id=js.task_id,
+            source_kind=source_kind,
+            source_value=source_value,
+            debug=debug,
+            img_post_proc=img_post_proc,
+            conf_file=conf_path,
+            custom_xsl=xsl_path,
+            custom_evolve=evolve_path,
+            mtef_source=(MathTypeSource or None),
+            table_model=(TableModel or None),
+            fontmaps_dir=None,
+            fontmaps_zip=fontmaps_zip_path,
+            job_cache_key=cache_key,
+            no_cache=False,
+            image_dir=image_dir_name,
+            img_optimize=img_optimize,
+            priority=priority,
+        )
+        tasks.append({**item, "cache_key": cache_key, "cache_status": cache_status, "preflight": preflight})
+
+    return JSONResponse({"batch_id": batch_id, "tasks": tasks})
+
 
-    return JSONResponse({"task_id": prep.job.task_id, "cache_status": "BYPASS"})
+# StyleMap artifacts that debug packages collect from the task work dir
+SHARED_DEBUG_ARTIFACTS = ("custom-evolve-effective.xsl", "stylemap_manifest.json")
+
+
+def _link_shared_artifacts(shared: Path, work: Path) -> None:
+    """Link the StyleMap artifacts built once per batch into a task's work dir."""
+    for name in SHARED_DEBUG_ARTIFACTS:
+        src = shared / name
+        if not src.is_file():
+            continue
+        try:
+            os.link(src, work / name)
+        except OSError:
+            shutil.copy2(src, work / name)
+
+
+def _batch_tasks(batch_id: str) -> list[JobState]:
+    tasks = ctx.tasks.list_batch(batch_id)
+    if not tasks:
+        raise HTTPException(status_code=404, detail="batch not found")
+    return tasks
+
+
+@router.get("/v1/batch/{batch_id}")
+def get_batch(batch_id: str):
+    tasks = _batch_tasks(batch_id)
+    counts: dict[str, int] = {}
+    for js in tasks:
+        counts[js.state] = counts.get(js.state, 0) + 1
+    data = {
+        "batch_id": batch_id,
+        "total": len(tasks),
+        "counts": counts,
+        "finished": all(js.state in TERMINAL_STATES for js in tasks),
+        "tasks": [{"task_id": js.task_id, "state": js.state, "err_msg": js.err_msg} for js in tasks],
+    }
+    return JSONResponse({"code": 0, "data": data, "msg": "ok"})
+
+
+@router.get("/v1/batch/{batch_id}/result")
+def get_batch_result(batch_id: str):
+    """Stream one archive holding every finished task's result ZIP as <task_id>/<name>.zip."""
+    tasks = _batch_tasks(batch_id)
+    pending = [js.task_id for js in tasks if js.state not in TERMINAL_STATES]
+    if pending:
+        raise HTTPException(status_code=409, detail=f"batch not finished ({len(pending)} task(s) pending)")
+    entries: list[tuple[str, Path]] = []
+    summary = []
+    for js in tasks:
+        item = {"task_id": js.task_id, "state": js.state, "err_msg": js.err_msg, "file": ""}
+        if js.state == "done" and js.result_mode != "stream" and js.result_path and Path(js.result_path).is_file():
+            item["file"] = f"{js.task_id}/{Path(js.result_path).name}"
+            entries.append((item["file"], Path(js.result_path)))
+        summary.append(item)
+    manifest = {"batch_id": batch_id, "tasks": summary}
+    return StreamingResponse(
+        stream_zip(entries, manifest, ctx.jobs.zip_policy()),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=batch-{batch_id}.zip", "Cache-Control": "no-cache"},
+    )
 
 
 @router.get("/v1/task/{task_id}")
-def get_status(task_id: str):
+def get_status(task_id: str, request: Request):
     try:
         js = ctx.jobs.get(task_id)
-        data = {
-            "task_id": js.task_id,
-            "state": js.state,
-            "err_msg": js.err_msg,
-            "start_time": js.start_time,
-            "end_time": js.end_time,
-        }
-        return JSONResponse({"code": 0, "data": data, "msg": "ok"})
     except KeyError:
         raise HTTPException(status_code=404, detail="task not found")
+    data = {
+        "task_id": js.task_id,
+        "state": js.state,
+        "err_msg": js.err_msg,
+        "start_time": js.start_time,
+        "end_time": js.end_time,
+        "est_seconds": js.est_seconds,
+        "deadline": js.deadline,
+        "queue_position": ctx.jobs.queue_position(task_id) if js.state == "pending" else None,
+        "stages": ctx.tasks.stages(task_id),
+    }
+    body = {"code": 0, "data": data, "msg": "ok"}
+    etag = '"' + hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(body, headers=headers)
 
 
-@router.get("/v1/task/{task_id}/result")
-def get_result(task_id: str):
+@router.delete("/v1/task/{task_id}")
+def cancel_task(task_id: str):
+    """Cancel a queued or running task (stops its Calabash/Inkscape child, frees its work dir)."""
+    try:
+        js = ctx.jobs.get(task_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="task not found")
+    if not ctx.jobs.cancel(task_id):
+        js = ctx.jobs.get(task_id)
+        if js.state != "cancelled":
+            raise HTTPException(status_code=409, detail=f"task state: {js.state}")
+    return JSONResponse({"task_id": task_id, "state": "cancelled", "previous_state": js.state})
+
+
+# Poll interval while following a task log
+LOG_FOLLOW_POLL_SEC = 0.5
+# A follow stream ends after this long even if the task is still running;
+# clients resume with `offset` set to the bytes received so far
+LOG_FOLLOW_MAX_SEC = 600.0
+
+
+def _read_log(path: Path, pos: int, size: int = 64 * 1024) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            f.seek(pos)
+            return f.read(size)
+    except FileNotFoundError:
+        return b""
+
+
+@router.get("/v1/task/{task_id}/log")
+def get_log(task_id: str, request: Request, offset: int = 0, follow: bool = False):
+    """Task log from byte `offset`; with `follow`, keep streaming until the task ends."""
+    try:
+        ctx.jobs.get(task_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="task not found")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="offset must be >= 0")
+    log_path = ctx.cfg.log_dir / f"{task_id}.log"
+
+    # Reads and task lookups go to the threadpool one at a time; the waits
+    # between polls do not hold a thread
+    async def tail():
+        pos = offset
+        stop_at = time.monotonic() + LOG_FOLLOW_MAX_SEC
+        while True:
+            # Read the state first so output written just before it changed is not missed
+            js = await run_in_threadpool(ctx.tasks.get, task_id)
+            finished = js.state in TERMINAL_STATES
+            while True:
+                chunk = await run_in_threadpool(_read_log, log_path, pos)
+                if not chunk:
+                    break
+                pos += len(chunk)
+                yield chunk
+            if not follow or finished or time.monotonic() >= stop_at:
+                return
+            await asyncio.sleep(LOG_FOLLOW_POLL_SEC)
+            if await request.is_disconnected():
+                return
+
+    return StreamingResponse(
+        tail(),
+        media_type="text/plain; charset=utf-8",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.api_route("/v1/task/{task_id}/result", methods=["GET", "HEAD"])
+def get_result(task_id: str, request: Request, stream: bool = False):
     try:
         js = ctx.jobs.get(task_id)
     except KeyError:
         raise HTTPException(status_code=404, detail="task not found")
     if js.state != "done":
         raise HTTPException(status_code=409, detail=f"task state: {js.state}")
-    work = Path(js.work_dir)
-    tex_files = list(work.glob("*.tex"))
-    basename = tex_files[0].stem if tex_files else Path(work).name
-    zf = ctx.cfg.public_root / f"{basename}.zip"
-    if not zf.exists():
+    if stream or js.result_mode == "stream":
+        # Build the ZIP from the work dir while the client reads; nothing hits disk
+        spec = load_entries(Path(js.work_dir))
+        if not spec:
+            raise HTTPException(status_code=500, detail="result missing")
+        entries = [(arc, Path(src)) for arc, src in spec.get("entries", [])]
+        name = f"{spec.get('basename') or Path(js.work_dir).name}.zip"
+        return StreamingResponse(
+            stream_zip(entries, spec.get("manifest") or {}, ctx.jobs.zip_policy()),
+            media_type="application/zip",
+            headers={"Content-Disposition": f"attachment; filename={name}", "Cache-Control": "no-cache"},
+        )
+    if js.result_path:
+        zf = Path(js.result_path)
+    else:
+        # Tasks packaged before result_path was recorded
+        work = Path(js.work_dir)
+        tex_files = list(work.glob("*.tex"))
+        basename = tex_files[0].stem if tex_files else Path(work).name
+        zf = ctx.cfg.public_root / f"{basename}.zip"
+    try:
+        st = zf.stat()
+    except FileNotFoundError:
         raise HTTPException(status_code=500, detail="result missing")
-    return StreamingResponse(open(zf, "rb"), media_type="application/zip", headers={"Content-Disposition": f"attachment; filename={basename}.zip"})
+
+    headers = {"Cache-Control": "no-cache"}
+    # The stored digest only describes files in the task's own directory; results
+    # packaged before that lived at a path shared by tasks with the same basename
+    owned = zf.parent == ctx.cfg.public_root / js.task_id
+    if owned and js.result_sha256 and js.result_size == st.st_size:
+        headers["ETag"] = f'"{js.result_sha256}"'
+    else:
+        headers["ETag"] = f'"{int(st.st_mtime_ns)}-{st.st_size}"'
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    disposition = f"attachment; filename={zf.name}"
+    if ctx.cfg.result_accel_redirect and ctx.cfg.public_root in zf.parents:
+        # Let the front proxy stream the file with sendfile (and handle Range)
+        rel = zf.relative_to(ctx.cfg.public_root).as_posix()
+        headers["X-Accel-Redirect"] = ctx.cfg.result_accel_redirect.rstrip("/") + "/" + rel
+        headers["Content-Disposition"] = disposition
+        return Response(status_code=200, media_type="application/zip", headers=headers)
+    # FileResponse sets Content-Length/Last-Modified and serves Range/If-Range
+    return FileResponse(
+        zf,
+        media_type="application/zip",
+        headers={**headers, "Content-Disposition": disposition},
+        stat_result=st,
+    )
+
+
+@router.post("/v1/task/{task_id}/repackage")
+def repackage_task(
+    task_id: str,
+    debug: bool | None = Form(default=None),
+    img_post_proc: bool | None = Form(default=None),
+    image_dir: str | None = Form(default=None),
+    img_optimize: bool | None = Form(default=None),
+):
+    """Derive a new task from a finished one, re-running only post-processing and packaging."""
+    try:
+        js = ctx.jobs.get(task_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="task not found")
+    if js.state != "done":
+        raise HTTPException(status_code=409, detail=f"task state: {js.state}")
+    params = ctx.jobs.load_params(task_id)
+    if not params:
+        raise HTTPException(status_code=409, detail="task cannot be re-packaged (job parameters unavailable)")
+
+    overrides = {"debug": debug, "img_post_proc": img_post_proc, "img_optimize": img_optimize}
+    params.update({k: v for k, v in overrides.items() if v is not None})
+    if image_dir is not None:
+        params["image_dir"] = _resolve_image_dir(image_dir)
+    _admit()
+    new_js = ctx.jobs.create(debug=bool(params.get("debug")), img_post_proc=bool(params.get("img_post_proc", True)))
+    ctx.jobs.submit(task_id=new_js.task_id, reuse_from=task_id, **params)
+    return JSONResponse({"task_id": new_js.task_id, "source_task_id": task_id})
+
+
+# Text artifacts worth gzip-encoding when the client accepts it
+_GZIP_EXTS = {".tex", ".xml", ".csv", ".json", ".log", ".xsl", ".txt", ".html"}
+_GZIP_MIN_BYTES = 1024
+
+
+def _finished_entries(task_id: str) -> tuple[Path, dict, dict[str, Path]]:
+    """(work_dir, package spec, arcname -> source) for a finished task."""
+    try:
+        js = ctx.jobs.get(task_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="task not found")
+    if js.state != "done":
+        raise HTTPException(status_code=409, detail=f"task state: {js.state}")
+    spec = load_entries(Path(js.work_dir))
+    if not spec:
+        raise HTTPException(status_code=404, detail="file listing unavailable for this task")
+    return Path(js.work_dir), spec, {arc: Path(src) for arc, src in spec.get("entries", [])}
+
+
+@router.get("/v1/task/{task_id}/files")
+def list_files(task_id: str):
+    work, spec, entries = _finished_entries(task_id)
+    digests = entry_digests(work, entries.items())
+    files = [
+        {"path": arc, "size": d["size"], "sha256": d["sha256"]}
+        for arc, d in digests.items()
+    ]
+    manifest_bytes = json.dumps(spec.get("manifest") or {}, ensure_ascii=False, indent=2).encode("utf-8")
+    files.append(
+        {"path": "manifest.json", "size": len(manifest_bytes), "sha256": hashlib.sha256(manifest_bytes).hexdigest()}
+    )
+    return JSONResponse({"code": 0, "data": {"task_id": task_id, "files": files}, "msg": "ok"})
+
+
+@router.get("/v1/task/{task_id}/files/{path:path}")
+def get_file(task_id: str, path: str, request: Request):
+    work, spec, entries = _finished_entries(task_id)
+    accepts_gzip = "gzip" in (request.headers.get("accept-encoding") or "").lower()
+    if path == "manifest.json":
+        data = json.dumps(spec.get("manifest") or {}, ensure_ascii=False, indent=2).encode("utf-8")
+        etag = f'"{hashlib.sha256(data).hexdigest()}"'
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(content=data, media_type="application/json", headers={"ETag": etag})
+    src = entries.get(path)
+    if src is None or not src.is_file():
+        raise HTTPException(status_code=404, detail="file not found")
+    digest = entry_digests(work, [(path, src)]).get(path)
+    if not digest:
+        raise HTTPException(status_code=404, detail="file not found")
+
+    use_gzip = accepts_gzip and src.suffix.lower() in _GZIP_EXTS and digest["size"] >= _GZIP_MIN_BYTES
+    # Distinct strong validators per representation
+    etag = f'"{digest["sha256"]}-gz"' if use_gzip else f'"{digest["sha256"]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    media_type = mimetypes.guess_type(src.name)[0] or ("text/plain" if src.suffix.lower() in _GZIP_EXTS else "application/octet-stream")
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(_gzip_file(src), media_type=media_type, headers=headers)
+    return FileResponse(src, media_type=media_type, headers=headers)
+
+
+def _gzip_file(src: Path):
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    with open(src, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            out = comp.compress(chunk)
+            if out:
+                yield out
+    yield comp.flush()
 
 
 @router.post("/v1/dryrun")
@@ -219,14 +793,16 @@ async def dryrun(
     from zipfile import ZipFile, ZIP_DEFLATED
 
     mem_zip = work / "dryrun_xsls.zip"
+    policy = ctx.jobs.zip_policy()
     files_added = 0
-    with ZipFile(mem_zip, "w", ZIP_DEFLATED) as zf:
+    with ZipFile(mem_zip, "w", ZIP_DEFLATED, compresslevel=policy.deflate_level) as zf:
         if evolve_path and evolve_path.exists():
-            zf.write(evolve_path, arcname=f"xsl/{evolve_path.name}")
+            arc = f"xsl/{evolve_path.name}"
+            zf.write(evolve_path, arcname=arc, compress_type=policy.compress_type(arc))
             files_added += 1
         sm = work / "stylemap_manifest.json"
         if sm.exists():
-            zf.write(sm, arcname=sm.name)
+            zf.write(sm, arcname=sm.name, compress_type=policy.compress_type(sm.name))
     if files_added == 0:
         raise HTTPException(status_code=400, detail="No effective XSLs generated (check StyleMap and conf)")
 
@@ -250,6 +826,10 @@ class PreparedJobRequest:
     custom_evolve_path: Optional[Path]
     fontmaps_zip_path: Optional[Path]
     image_dir: str
+    # sha256 state after the DOCX bytes (seeds the cache key without a re-read)
+    docx_hash: Optional[object] = None
+    # analyze_docx report plus the cost estimate (returned to the client)
+    preflight: Optional[dict] = None
 
 
 def _default_conf_path() -> Path:
@@ -268,29 +848,31 @@ async def _prepare_job_request(
     style_map: str | None,
     fontmaps_zip: UploadFile | None,
     image_dir: str | None,
+    docx_sha256: str | None = None,
+    filename: str | None = None,
+    deadline_sec: float | None = None,
 ) -> PreparedJobRequest:
-    if (file is None and not url) or (file is not None and url):
-        raise HTTPException(status_code=400, detail="Provide exactly one of file or url")
+    docx_sha256 = (docx_sha256 or "").strip().lower() or None
+    if sum(1 for given in (file is not None, bool(url), bool(docx_sha256)) if given) != 1:
+        raise HTTPException(status_code=400, detail="Provide exactly one of file, url or docx_sha256")
+    if docx_sha256 and not is_sha256(docx_sha256):
+        raise HTTPException(status_code=400, detail="docx_sha256 must be 64 hex characters")
+    if docx_sha256 and not ctx.blobs.has(docx_sha256):
+        raise HTTPException(status_code=404, detail="unknown docx_sha256; upload the file instead")
+    _check_deadline(deadline_sec)
+    _admit()
 
-    js = ctx.jobs.create(debug=debug, img_post_proc=img_post_proc)
+    js = ctx.jobs.create(debug=debug, img_post_proc=img_post_proc, deadline_sec=deadline_sec)
     work = Path(js.work_dir)
 
-    if file is not None:
-        name = safe_name(file.filename or "document.docx")
-        if not name.lower().endswith(".docx"):
-            name = f"{name}.docx"
-        input_docx = work / name
-        await write_upload_stream(file, input_docx, ctx.cfg.max_upload_bytes)
-        input_docx = _sanitize_uploaded_path(input_docx)
-        source_kind = "file"
-        source_value = input_docx.name
-    else:
-        name = _safe_filename_from_url(url or "")
-        input_docx = work / name
-        download_to(input_docx, url or "")
-        input_docx = _sanitize_uploaded_path(input_docx)
-        source_kind = "url"
-        source_value = input_docx.name
+    with ctx.jobs.stage(js.task_id, "input") as st:
+        input_docx, source_kind, source_value, docx_hash = await _receive_input(
+            work, file, url, docx_sha256=docx_sha256, filename=filename, task_id=js.task_id
+        )
+        st.update(kind="blob" if docx_sha256 else source_kind, bytes=input_docx.stat().st_size)
+
+    _admit_input(js, input_docx)
+    preflight = _run_preflight(js.task_id, input_docx, img_post_proc)
 
     conf_path, xsl_path, evolve_path, fontmaps_zip_path = await _prepare_optional_inputs(
         work=work,
@@ -314,9 +896,130 @@ async def _prepare_job_request(
         custom_evolve_path=evolve_path,
         fontmaps_zip_path=fontmaps_zip_path,
         image_dir=image_dir_name,
+        docx_hash=docx_hash,
+        preflight=preflight,
     )
 
 
+def _check_deadline(deadline_sec: float | None) -> None:
+    # inf/nan would be stored as the deadline and break JSON status responses
+    if deadline_sec is not None and not (math.isfinite(deadline_sec) and 0 <= deadline_sec <= MAX_DEADLINE_SEC):
+        raise HTTPException(status_code=400, detail=f"deadline_sec must be between 0 and {MAX_DEADLINE_SEC}")
+
+
+def _admit(jobs: int = 1, input_bytes: int = 0) -> None:
+    """429 with Retry-After when the job queues cannot take `jobs` more jobs."""
+    try:
+        ctx.jobs.admit(jobs, input_bytes)
+    except QueueFull as e:
+        metrics.inc("docx2tex_admission_rejected_total", reason=e.reason)
+        raise HTTPException(status_code=429, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+
+def _admit_input(js: JobState, input_docx: Path) -> None:
+    """Byte-limit check once the DOCX size is known; a refused task is failed and its work dir freed."""
+    try:
+        _admit(input_bytes=input_docx.stat().st_size)
+    except HTTPException as e:
+        ctx.jobs.set_state(js.task_id, "failed", str(e.detail))
+        shutil.rmtree(js.work_dir, ignore_errors=True)
+        raise
+
+
+def _run_preflight(task_id: str, input_docx: Path, img_post_proc: bool) -> dict:
+    """Analyze the DOCX before it is queued; zip bombs fail the task with 413/422.
+
+    The cost estimate is stored on the task and returned with the report.
+    """
+    cfg = ctx.cfg
+    limits = PreflightLimits(
+        max_uncompressed_bytes=cfg.preflight_max_uncompressed_bytes,
+        max_ratio=cfg.preflight_max_ratio,
+        max_entries=cfg.preflight_max_entries,
+    )
+    with ctx.jobs.stage(task_id, "preflight") as st:
+        try:
+            report = analyze_docx(input_docx, limits)
+        except PreflightError as e:
+            st["rejected"] = e.detail
+            ctx.jobs.set_state(task_id, "failed", e.detail)
+            input_docx.unlink(missing_ok=True)
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        report["estimate_sec"] = CostModel().estimate(report, img_post_proc)
+        report["poll_interval_sec"] = poll_interval_sec(report["estimate_sec"])
+        st.update(report)
+    stats = docx_stats(report)
+    ctx.tasks.set_estimate(task_id, report["estimate_sec"], stats.document_xml_bytes, stats.media_bytes)
+    return report
+
+
+async def _receive_input(
+    work: Path,
+    file: UploadFile | None,
+    url: str | None,
+    *,
+    docx_sha256: str | None = None,
+    filename: str | None = None,
+    task_id: str | None = None,
+) -> tuple[Path, str, str, Optional[object]]:
+    """Place the DOCX (upload, download or stored blob) in the work dir.
+
+    Returns (path, source_kind, source_value, docx_hash), where docx_hash is a
+    sha256 object fed with the DOCX bytes (None for stored blobs). New inputs
+    are added to the content-addressed input store and their digest is
+    recorded on the task.
+    """
+    docx_hash = None
+    if docx_sha256:
+        name = safe_name(filename or "document.docx")
+        if not name.lower().endswith(".docx"):
+            name = f"{name}.docx"
+        input_docx = work / name
+        if ctx.blobs.link_to(docx_sha256, input_docx) is None:
+            raise HTTPException(status_code=404, detail="unknown docx_sha256; upload the file instead")
+        input_docx = _sanitize_uploaded_path(input_docx)
+        sha = docx_sha256
+        source_kind = "file"
+    elif file is not None:
+        name = safe_name(file.filename or "document.docx")
+        if not name.lower().endswith(".docx"):
+            name = f"{name}.docx"
+        # Final name up front so the upload is placed exactly once
+        input_docx = work / sanitize_filename(name)
+        docx_hash = await write_upload_stream(file, input_docx, ctx.cfg.max_upload_bytes)
+        sha = _store_input(input_docx, docx_hash)
+        source_kind = "file"
+    else:
+        name = _safe_filename_from_url(url or "")
+        input_docx = work / name
+        download_to(input_docx, url or "")
+        input_docx = _sanitize_uploaded_path(input_docx)
+        docx_hash = _hash_file(input_docx)
+        sha = _store_input(input_docx, docx_hash)
+        source_kind = "url"
+    if task_id and sha:
+        ctx.tasks.set_sha256(task_id, sha)
+    return input_docx, source_kind, input_docx.name, docx_hash
+
+
+def _hash_file(path: Path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h
+
+
+def _store_input(path: Path, docx_hash) -> str:
+    """Add an input to the blob store (best-effort); returns its digest or ''."""
+    try:
+        sha = docx_hash.copy().hexdigest()
+        ctx.blobs.put(path, sha)
+        return sha
+    except Exception:
+        return ""
+
+
 async def _prepare_optional_inputs(
     *,
     work: Path,
@@ -368,6 +1071,13 @@ async def _prepare_optional_inputs(
 # Helpers local to router
 
 
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
 def _sanitize_uploaded_path(path: Path) -> Path:
     safe = sanitize_filename(path.name)
     if safe == path.name:
@@ -381,26 +1091,40 @@ def _resolve_image_dir(image_dir: str | None) -> str:
     cleaned = sanitize_filename(image_dir or "image")
     return cleaned or "image"
 async def write_upload_stream(upload: UploadFile, dest: Path, max_bytes: int = 0):
+    """Copy an upload to `dest`; returns a sha256 object fed with its bytes.
+
+    The bytes are hashed in the same pass as the copy, so neither the input
+    store nor the cache key has to read the DOCX again. The multipart
+    parser's spool file has no name on disk (O_TMPFILE or already unlinked),
+    so it cannot be linked into place and one copy is unavoidable here.
+    Data sent through the resumable upload API is linked instead.
+    """
     dest.parent.mkdir(parents=True, exist_ok=True)
-    total = 0
-    with open(dest, "wb") as out:
-        while True:
-            chunk = await upload.read(1024 * 1024)
-            if not chunk:
-                break
-            total += len(chunk)
-            if max_bytes and total > max_bytes:
-                out.close()
-                try:
-                    dest.unlink(missing_ok=True)  # type: ignore[arg-type]
-                except Exception:
-                    pass
-                raise HTTPException(status_code=413, detail="uploaded file exceeds size limit")
-            out.write(chunk)
+    h = hashlib.sha256()
     try:
-        await upload.close()
-    except Exception:
-        pass
+        total = 0
+        with open(dest, "wb") as out:
+            while True:
+                chunk = await upload.read(1024 * 1024)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if max_bytes and total > max_bytes:
+                    out.close()
+                    try:
+                        dest.unlink(missing_ok=True)  # type: ignore[arg-type]
+                    except Exception:
+                        pass
+                    raise HTTPException(status_code=413, detail="uploaded file exceeds size limit")
+                h.update(chunk)
+                out.write(chunk)
+        metrics.inc("docx2tex_upload_bytes_total", total, kind="multipart")
+        return h
+    finally:
+        try:
+            await upload.close()
+        except Exception:
+            pass
 
 
 def _safe_filename_from_url(url: str) -> str:
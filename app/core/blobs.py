@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import os
+import re
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_sha256(value: str) -> bool:
+    return bool(_SHA256_RE.match(value or ""))
+
+
+class BlobStore:
+    """Content-addressed store of input DOCX files under DATA_ROOT/inputs.
+
+    Blobs live at `<root>/<sha[:2]>/<sha>.docx` and are hard-linked into
+    work dirs where the filesystem allows it. A blob's mtime is refreshed
+    whenever it is stored or used, and retention is mtime-based.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, sha: str) -> Path:
+        return self.root / sha[:2] / f"{sha}.docx"
+
+    def has(self, sha: str) -> bool:
+        return is_sha256(sha) and self.path(sha).is_file()
+
+    def put(self, src: Path, sha: str, move: bool = False) -> Path:
+        """Store `src` under its digest (no-op when already present).
+
+        With `move`, `src` is renamed into the store (copied when that fails)
+        rather than hard-linked, for sources that could still be written to.
+        """
+        dst = self.path(sha)
+        if dst.is_file():
+            _touch(dst)
+            return dst
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(f".{sha}.{uuid.uuid4().hex}.tmp")
+        if move:
+            try:
+                os.replace(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+        else:
+            _link_or_copy(src, tmp)
+        tmp.replace(dst)
+        return dst
+
+    def link_to(self, sha: str, dest: Path) -> Optional[Path]:
+        """Materialize blob `sha` at `dest`; returns None when it is unknown."""
+        if not self.has(sha):
+            return None
+        src = self.path(sha)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(src, dest)
+        _touch(src)
+        return dest
+
+    def cleanup(self, ttl_days: int) -> int:
+        """Drop blobs not stored or used within the TTL; returns the count."""
+        if ttl_days <= 0 or not self.root.exists():
+            return 0
+        cutoff = time.time() - ttl_days * 86400
+        removed = 0
+        for p in self.root.glob("*/*.docx"):
+            try:
+                if p.stat().st_mtime < cutoff:
+                    p.unlink()
+                    removed += 1
+            except Exception:
+                pass
+        return removed
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _touch(p: Path) -> None:
+    try:
+        os.utime(p)
+    except OSError:
+        pass
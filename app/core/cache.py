@@ -20,6 +20,8 @@ class CacheStore:
     def __init__(self, db: Database, data_root: Path):
         self.db = db
         self.data_root = data_root
+        self._usage: tuple[float, int] = (0.0, 0)
+        self._usage_lock = threading.Lock()
 
     # --- DB operations ---
     def get(self, key: str) -> Optional[Dict[str, str]]:
@@ -40,14 +42,28 @@ class CacheStore:
         except Exception:
             return None
 
-    def put(self, key: str, basename: str) -> None:
+    def put(self, key: str, basename: str, builder: Optional[str] = None) -> bool:
+        """Mark `key` available; with `builder`, only while it holds the build lock.
+
+        The lock check and the insert are one statement, so an entry is never
+        published after its builder was cancelled or superseded. Returns
+        whether the entry was written.
+        """
         now = time.time()
         with self.db.connect() as con:
-            con.execute(
-                "INSERT OR REPLACE INTO caches(cache_key, basename, created, last_access, available) VALUES(?,?,?,?,1)",
-                (key, basename, now, now),
-            )
+            if builder is None:
+                cur = con.execute(
+                    "INSERT OR REPLACE INTO caches(cache_key, basename, created, last_access, available) VALUES(?,?,?,?,1)",
+                    (key, basename, now, now),
+                )
+            else:
+                cur = con.execute(
+                    "INSERT OR REPLACE INTO caches(cache_key, basename, created, last_access, available)"
+                    " SELECT ?,?,?,?,1 WHERE EXISTS (SELECT 1 FROM locks WHERE cache_key=? AND builder=?)",
+                    (key, basename, now, now, key, builder),
+                )
             con.commit()
+            return cur.rowcount == 1
 
     def mark_gone(self, key: str) -> None:
         with self.db.connect() as con:
@@ -89,7 +105,29 @@ class CacheStore:
             con.execute("UPDATE caches SET last_access=? WHERE cache_key=?", (time.time(), key))
             con.commit()
 
+    def count_available(self) -> int:
+        with self.db.connect() as con:
+            return int(con.execute("SELECT COUNT(*) FROM caches WHERE available=1").fetchone()[0])
+
     # --- Filesystem helpers ---
+    def disk_usage(self, max_age_sec: float = 30.0) -> int:
+        """Bytes under <data_root>/cache; the walk is memoized for `max_age_sec`."""
+        with self._usage_lock:
+            at, total = self._usage
+            if at and time.monotonic() - at < max_age_sec:
+                return total
+            total = 0
+            root = self.data_root / "cache"
+            if root.exists():
+                for p in root.rglob("*"):
+                    try:
+                        if p.is_file():
+                            total += p.stat().st_size
+                    except OSError:
+                        pass
+            self._usage = (time.monotonic(), total)
+            return total
+
     def cache_dir(self, key: str) -> Path:
         return (self.data_root / "cache" / key).resolve()
 
@@ -200,14 +238,27 @@ class LockManager:
         except Exception:
             return False
 
-    def release(self, key: str) -> None:
+    def release(self, key: str, builder: Optional[str] = None) -> None:
+        """Drop the lock on `key`; with `builder`, only if that builder still holds it."""
         try:
             with self.db.connect() as con:
-                con.execute("DELETE FROM locks WHERE cache_key=?", (key,))
+                if builder is None:
+                    con.execute("DELETE FROM locks WHERE cache_key=?", (key,))
+                else:
+                    con.execute("DELETE FROM locks WHERE cache_key=? AND builder=?", (key, builder))
                 con.commit()
         except Exception:
             pass
 
+    def release_builder(self, builder: str) -> list[str]:
+        """Drop every lock held by `builder`; returns the released cache keys."""
+        with self.db.connect() as con:
+            keys = [r["cache_key"] for r in con.execute("SELECT cache_key FROM locks WHERE builder=?", (builder,))]
+            if keys:
+                con.executemany("DELETE FROM locks WHERE cache_key=? AND builder=?", [(k, builder) for k in keys])
+                con.commit()
+        return keys
+
     def get(self, key: str) -> Optional[dict]:
         try:
             with self.db.connect() as con:
@@ -226,17 +277,25 @@ class LockManager:
         except Exception:
             return None
 
-    def cleanup(self, max_age_sec: int) -> None:
+    def cleanup(self, max_age_sec: int, batch: int = 500) -> int:
         if max_age_sec <= 0:
-            return
-        now = time.time()
-        with self.db.connect() as con:
-            cur = con.execute("SELECT cache_key, started FROM locks")
-            rows = cur.fetchall()
-        for row in rows:
-            started = row["started"] or 0
-            if now - started > max_age_sec:
-                self.release(row["cache_key"])
+            return 0
+        cutoff = time.time() - max_age_sec
+        released = 0
+        while True:
+            # Index-driven (idx_locks_started) batched delete of stale locks
+            with self.db.connect() as con:
+                cur = con.execute(
+                    "DELETE FROM locks WHERE cache_key IN ("
+                    "SELECT cache_key FROM locks WHERE started < ? OR started IS NULL LIMIT ?)",
+                    (cutoff, batch),
+                )
+                n = cur.rowcount
+                con.commit()
+            released += max(n, 0)
+            if n < batch:
+                break
+        return released
 
     def start_sweeper(self, interval_sec: int, max_age_sec: int) -> None:
         if interval_sec <= 0:
@@ -8,78 +8,178 @@ from typing import Optional
 
 from .config import Config
 from .db import Database
+from .blobs import BlobStore
 from .cache import CacheStore
+from .logging import console
+from .tasks import TERMINAL_STATES
+from .uploads import UploadStore
 
 
-def _cleanup_old_jobs(cfg: Config, db: Database, retention_days: int) -> None:
+# Rows handled per transaction; keeps each write short so the WAL is not held
+# while purging a large backlog.
+CLEANUP_BATCH = 500
+
+# Status changes kept for StatusCache invalidation; a process that falls
+# further behind than this drops its whole cache once.
+TASK_CHANGES_KEEP = 100000
+
+
+def _cleanup_old_jobs(cfg: Config, db: Database, retention_days: int, batch: int = CLEANUP_BATCH) -> int:
     if retention_days <= 0:
-        return
+        return 0
     cutoff = time.time() - retention_days * 86400
-    ids_to_purge: list[str] = []
-    with db.connect() as con:
-        cur = con.execute(
-            "SELECT task_id, COALESCE(end_time, start_time) AS t FROM tasks WHERE state IN ('done','failed')"
-        )
-        for row in cur.fetchall():
-            if (row["t"] or 0) < cutoff:
-                ids_to_purge.append(row["task_id"])
-    # Filesystem cleanup first
-    for tid in ids_to_purge:
-        d = cfg.data_root / "tasks" / tid
-        if d.exists():
-            try:
-                shutil.rmtree(d, ignore_errors=True)
-            except Exception:
-                pass
-        log_path = cfg.log_dir / f"{tid}.log"
-        if log_path.exists() and (log_path.stat().st_mtime or 0) < cutoff:
-            try:
-                log_path.unlink()
-            except Exception:
-                pass
-    if ids_to_purge:
-        with db.connect() as con:
-            con.executemany("DELETE FROM tasks WHERE task_id=?", [(i,) for i in ids_to_purge])
-            con.commit()
+    purged = 0
+    for state in TERMINAL_STATES:
+        while True:
+            # Served by idx_tasks_state_end; cost scales with the expired rows only
+            with db.connect() as con:
+                cur = con.execute(
+                    "SELECT task_id FROM tasks WHERE state=? AND end_time < ? LIMIT ?",
+                    (state, cutoff, batch),
+                )
+                ids_to_purge = [row["task_id"] for row in cur.fetchall()]
+            if not ids_to_purge:
+                break
+            # Filesystem cleanup first
+            for tid in ids_to_purge:
+                for d in (cfg.data_root / "tasks" / tid, cfg.public_root / tid):
+                    if d.exists():
+                        try:
+                            shutil.rmtree(d, ignore_errors=True)
+                        except Exception:
+                            pass
+                log_path = cfg.log_dir / f"{tid}.log"
+                if log_path.exists() and (log_path.stat().st_mtime or 0) < cutoff:
+                    try:
+                        log_path.unlink()
+                    except Exception:
+                        pass
+            with db.connect() as con:
+                con.executemany("DELETE FROM tasks WHERE task_id=?", [(i,) for i in ids_to_purge])
+                con.executemany("DELETE FROM task_stages WHERE task_id=?", [(i,) for i in ids_to_purge])
+                con.commit()
+            purged += len(ids_to_purge)
+            if len(ids_to_purge) < batch:
+                break
+    return purged
 
 
-def _cleanup_caches(cfg: Config, db: Database, cache: CacheStore, ttl_days: int) -> None:
+def _cleanup_caches(cfg: Config, db: Database, cache: CacheStore, ttl_days: int, batch: int = CLEANUP_BATCH) -> int:
     if ttl_days <= 0:
-        return
+        return 0
     cutoff = time.time() - ttl_days * 86400
-    with db.connect() as con:
-        cur = con.execute(
-            "SELECT cache_key, basename, COALESCE(last_access, created) AS t, available FROM caches WHERE COALESCE(last_access, created) < ?",
-            (cutoff,),
-        )
-        rows = cur.fetchall()
-    for row in rows:
-        key = row["cache_key"]
+    purged = 0
+    while True:
+        # Served by idx_caches_last_access (last_access is backfilled by migration 1)
+        with db.connect() as con:
+            cur = con.execute(
+                "SELECT cache_key FROM caches WHERE last_access < ? ORDER BY last_access LIMIT ?",
+                (cutoff, batch),
+            )
+            keys = [row["cache_key"] for row in cur.fetchall()]
+        if not keys:
+            break
+        # mark unavailable to avoid races
         try:
-            # mark unavailable to avoid races
             with db.connect() as con:
-                con.execute("UPDATE caches SET available=0 WHERE cache_key=?", (key,))
+                con.executemany("UPDATE caches SET available=0 WHERE cache_key=?", [(k,) for k in keys])
                 con.commit()
         except Exception:
             pass
-        # delete filesystem safely
-        d = cache.cache_dir(key)
+        removed: list[str] = []
+        for key in keys:
+            # delete filesystem safely
+            d = cache.cache_dir(key)
+            try:
+                if d.exists():
+                    shutil.rmtree(d, ignore_errors=True)
+            except Exception:
+                continue
+            removed.append(key)
+        # delete db rows
         try:
-            if d.exists():
-                shutil.rmtree(d, ignore_errors=True)
+            with db.connect() as con:
+                con.executemany("DELETE FROM caches WHERE cache_key=?", [(k,) for k in removed])
+                con.commit()
         except Exception:
-            continue
-        # delete db row
+            pass
+        purged += len(removed)
+        if len(keys) < batch or not removed:
+            break
+    return purged
+
+
+def _cleanup_batches(cfg: Config, db: Database, retention_days: int) -> int:
+    """Remove shared batch inputs once the batch has no tasks left (run after job cleanup)."""
+    if retention_days <= 0:
+        return 0
+    root = cfg.data_root / "batches"
+    if not root.exists():
+        return 0
+    cutoff = time.time() - retention_days * 86400
+    removed = 0
+    for d in root.iterdir():
         try:
+            if not d.is_dir() or d.stat().st_mtime >= cutoff:
+                continue
             with db.connect() as con:
-                con.execute("DELETE FROM caches WHERE cache_key=?", (key,))
-                con.commit()
+                if con.execute("SELECT 1 FROM tasks WHERE batch_id=? LIMIT 1", (d.name,)).fetchone():
+                    continue
+            shutil.rmtree(d, ignore_errors=True)
+            removed += 1
         except Exception:
             pass
+    return removed
+
+
+def _prune_task_changes(db: Database, keep: int = TASK_CHANGES_KEEP) -> int:
+    """Drop all but the latest `keep` status changes (a lagging StatusCache then clears itself)."""
+    with db.connect() as con:
+        cur = con.execute("DELETE FROM task_changes WHERE rev <= (SELECT MAX(rev) FROM task_changes) - ?", (keep,))
+        con.commit()
+        return cur.rowcount
+
+
+def _cleanup_image_cache(cfg: Config, ttl_days: int) -> None:
+    """Drop optimized-image cache files not used within the TTL (mtime-based)."""
+    if ttl_days <= 0:
+        return
+    root = cfg.data_root / "imgopt"
+    if not root.exists():
+        return
+    cutoff = time.time() - ttl_days * 86400
+    for p in root.rglob("*"):
+        try:
+            if p.is_file() and p.stat().st_mtime < cutoff:
+                p.unlink()
+        except Exception:
+            pass
+
+
+def fail_interrupted_tasks(db: Database) -> int:
+    """Fail tasks a previous server run left queued or running; returns their number.
+
+    Their jobs lived in the memory of workers that have exited and will never
+    run; left pending they would count against QUEUE_MAX_JOBS forever. Only
+    call this while no worker is serving (entrypoint.sh runs it before uvicorn).
+    """
+    marks = ",".join("?" for _ in TERMINAL_STATES)
+    with db.connect() as con:
+        cur = con.execute(
+            f"UPDATE tasks SET state='failed', err_msg=?, end_time=?, queue_key=NULL WHERE state NOT IN ({marks})",
+            ("interrupted by a server restart", time.time(), *TERMINAL_STATES),
+        )
+        con.commit()
+        return cur.rowcount
 
 
 def start_cleanup_loop(cfg: Config, db: Database, cache: CacheStore, task_retention_days: Optional[int], cache_ttl_days: Optional[int]) -> None:
-    if task_retention_days is None and cache_ttl_days is None:
+    if (
+        task_retention_days is None
+        and cache_ttl_days is None
+        and cfg.input_store_ttl_days <= 0
+        and cfg.upload_session_ttl_sec <= 0
+    ):
         return
 
     def loop():
@@ -87,6 +187,11 @@ def start_cleanup_loop(cfg: Config, db: Database, cache: CacheStore, task_retent
             try:
                 if task_retention_days is not None:
                     _cleanup_old_jobs(cfg, db, task_retention_days)
+                    _cleanup_batches(cfg, db, task_retention_days)
+            except Exception:
+                pass
+            try:
+                _prune_task_changes(db)
             except Exception:
                 pass
             try:
@@ -94,8 +199,28 @@ def start_cleanup_loop(cfg: Config, db: Database, cache: CacheStore, task_retent
                     _cleanup_caches(cfg, db, cache, cache_ttl_days)
             except Exception:
                 pass
+            try:
+                if cache_ttl_days is not None:
+                    _cleanup_image_cache(cfg, cache_ttl_days)
+            except Exception:
+                pass
+            try:
+                BlobStore(cfg.data_root / "inputs").cleanup(cfg.input_store_ttl_days)
+            except Exception:
+                pass
+            try:
+                UploadStore(cfg.data_root / "uploads").cleanup(cfg.upload_session_ttl_sec)
+            except Exception:
+                pass
             time.sleep(6 * 3600)
 
     t = threading.Thread(target=loop, name="cleanup-loop", daemon=True)
     t.start()
 
+
+if __name__ == "__main__":
+    from .config import get_config
+
+    _db = Database(get_config().db_path)
+    _db.init_schema()
+    console(f"cleanup interrupted_failed={fail_interrupted_tasks(_db)}")
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import math
 import os
 from dataclasses import dataclass
 from pathlib import Path
@@ -15,6 +16,15 @@ def _parse_int(val: str | None, default: int) -> int:
         return default
 
 
+def _parse_float(val: str | None, default: float) -> float:
+    if val is None or str(val).strip() == "":
+        return default
+    try:
+        return float(str(val).strip())
+    except ValueError:
+        return default
+
+
 @dataclass(frozen=True)
 class Config:
     """Centralized configuration derived from environment variables.
@@ -36,6 +46,31 @@ class Config:
     ttl_days: Optional[int]
     lock_sweep_interval_sec: int
     lock_max_age_sec: int
+    img_opt_max_dpi: int
+    img_opt_jpeg_quality: int
+    img_opt_workers: int
+    img_opt_textwidth_in: float
+    task_write_behind_sec: float
+    status_cache_size: int
+    status_cache_check_sec: float
+    result_accel_redirect: str
+    debug_result_mode: str
+    zip_deflate_level: int
+    input_store_ttl_days: int
+    upload_session_ttl_sec: int
+    metrics_dir: Path
+    metrics_flush_sec: float
+    jvm_heap_policy: str
+    jvm_heap_min_mb: int
+    jvm_heap_max_mb: int
+    preflight_max_uncompressed_bytes: int
+    preflight_max_ratio: float
+    preflight_max_entries: int
+    queue_aging: float
+    queue_max_jobs: int
+    queue_max_bytes: int
+    default_deadline_sec: float
+    inkscape_timeout_sec: int
 
     @staticmethod
     def from_env() -> "Config":
@@ -70,6 +105,68 @@ class Config:
         lock_sweep_interval_sec = _parse_int(os.environ.get("LOCK_SWEEP_INTERVAL_SEC"), 120)
         lock_max_age_sec = _parse_int(os.environ.get("LOCK_MAX_AGE_SEC"), 1800)
 
+        # Raster image optimization (opt-in per task via `img_optimize`)
+        img_opt_max_dpi = _parse_int(os.environ.get("IMG_OPT_MAX_DPI"), 300)
+        img_opt_jpeg_quality = _parse_int(os.environ.get("IMG_OPT_JPEG_QUALITY"), 85)
+        img_opt_workers = _parse_int(os.environ.get("IMG_OPT_WORKERS"), 2)
+        img_opt_textwidth_in = _parse_float(os.environ.get("IMG_OPT_TEXTWIDTH_IN"), 6.0)
+
+        # Coalesce non-terminal task state writes (0 = write-through)
+        task_write_behind_sec = _parse_float(os.environ.get("TASK_WRITE_BEHIND_SEC"), 0.0)
+
+        # Process-local status cache for GET /v1/task/{id} (size 0 disables)
+        status_cache_size = _parse_int(os.environ.get("STATUS_CACHE_SIZE"), 4096)
+        status_cache_check_sec = _parse_float(os.environ.get("STATUS_CACHE_CHECK_SEC"), 0.25)
+
+        # Internal location prefix for X-Accel-Redirect (nginx serves WORK_ROOT via sendfile)
+        result_accel_redirect = os.environ.get("RESULT_ACCEL_REDIRECT", "").strip()
+
+        # Debug packages: 'zip' writes WORK_ROOT/<task_id>/<base>.zip, 'stream' builds it on download
+        debug_result_mode = os.environ.get("DEBUG_RESULT_MODE", "zip").strip().lower()
+        if debug_result_mode not in ("zip", "stream"):
+            debug_result_mode = "zip"
+
+        # Result ZIP compression: deflate level for text entries
+        zip_deflate_level = min(9, max(0, _parse_int(os.environ.get("ZIP_DEFLATE_LEVEL"), 6)))
+
+        # Content-addressed input store (DATA_ROOT/inputs); days unused before removal, 0 keeps forever
+        input_store_ttl_days = _parse_int(os.environ.get("INPUT_STORE_TTL_DAYS"), 7)
+
+        # Resumable upload sessions idle longer than this are removed
+        upload_session_ttl_sec = _parse_int(os.environ.get("UPLOAD_SESSION_TTL_SEC"), 86400)
+
+        # Per-worker metric snapshots merged by GET /metrics
+        metrics_dir = Path(os.environ.get("METRICS_DIR", str(data_root / "metrics"))).resolve()
+        metrics_flush_sec = _parse_float(os.environ.get("METRICS_FLUSH_SEC"), 5.0)
+
+        # Per-run Calabash JVM sizing: 'auto' picks -Xmx/-Xss/GC from the DOCX, 'off' leaves the JVM defaults
+        jvm_heap_policy = os.environ.get("JVM_HEAP_POLICY", "auto").strip().lower()
+        if jvm_heap_policy not in ("auto", "off"):
+            jvm_heap_policy = "auto"
+        jvm_heap_min_mb = _parse_int(os.environ.get("JVM_HEAP_MIN_MB"), 256)
+        # 0 = derive from the memory limit shared by all concurrent jobs
+        jvm_heap_max_mb = _parse_int(os.environ.get("JVM_HEAP_MAX_MB"), 0)
+
+        # DOCX pre-flight (zip-bomb guards checked before a task is queued)
+        preflight_max_uncompressed_bytes = _parse_int(os.environ.get("PREFLIGHT_MAX_UNCOMPRESSED_BYTES"), 2 * 1024**3)
+        preflight_max_ratio = _parse_float(os.environ.get("PREFLIGHT_MAX_RATIO"), 200.0)
+        preflight_max_entries = _parse_int(os.environ.get("PREFLIGHT_MAX_ENTRIES"), 20000)
+
+        # Job queue order: seconds of estimated cost a job gains per second waited
+        queue_aging = _parse_float(os.environ.get("QUEUE_AGING"), 1.0)
+
+        # Admission control over all workers' queues (0 = unlimited); excess submissions get 429
+        queue_max_jobs = _parse_int(os.environ.get("QUEUE_MAX_JOBS"), 100)
+        queue_max_bytes = _parse_int(os.environ.get("QUEUE_MAX_BYTES"), 0)
+
+        # Deadline for tasks submitted without deadline_sec (0 = none); late tasks end as 'expired'
+        default_deadline_sec = _parse_float(os.environ.get("DEFAULT_DEADLINE_SEC"), 0.0)
+        if not math.isfinite(default_deadline_sec) or default_deadline_sec < 0:
+            default_deadline_sec = 0.0
+
+        # Limit per Inkscape vector conversion (0 = none); a conversion that runs over counts as failed
+        inkscape_timeout_sec = max(0, _parse_int(os.environ.get("INKSCAPE_TIMEOUT_SEC"), 0))
+
         return Config(
             app_home=app_home,
             data_root=data_root,
@@ -83,6 +180,31 @@ class Config:
             ttl_days=ttl_days,
             lock_sweep_interval_sec=lock_sweep_interval_sec,
             lock_max_age_sec=lock_max_age_sec,
+            img_opt_max_dpi=img_opt_max_dpi,
+            img_opt_jpeg_quality=img_opt_jpeg_quality,
+            img_opt_workers=img_opt_workers,
+            img_opt_textwidth_in=img_opt_textwidth_in,
+            task_write_behind_sec=task_write_behind_sec,
+            status_cache_size=status_cache_size,
+            status_cache_check_sec=status_cache_check_sec,
+            result_accel_redirect=result_accel_redirect,
+            debug_result_mode=debug_result_mode,
+            zip_deflate_level=zip_deflate_level,
+            input_store_ttl_days=input_store_ttl_days,
+            upload_session_ttl_sec=upload_session_ttl_sec,
+            metrics_dir=metrics_dir,
+            metrics_flush_sec=metrics_flush_sec,
+            jvm_heap_policy=jvm_heap_policy,
+            jvm_heap_min_mb=jvm_heap_min_mb,
+            jvm_heap_max_mb=jvm_heap_max_mb,
+            preflight_max_uncompressed_bytes=preflight_max_uncompressed_bytes,
+            preflight_max_ratio=preflight_max_ratio,
+            preflight_max_entries=preflight_max_entries,
+            queue_aging=queue_aging,
+            queue_max_jobs=queue_max_jobs,
+            queue_max_bytes=queue_max_bytes,
+            default_deadline_sec=default_deadline_sec,
+            inkscape_timeout_sec=inkscape_timeout_sec,
         )
 
     def as_dict(self) -> dict:
@@ -99,6 +221,31 @@ class Config:
             "ttl_days": self.ttl_days,
             "lock_sweep_interval_sec": self.lock_sweep_interval_sec,
             "lock_max_age_sec": self.lock_max_age_sec,
+            "img_opt_max_dpi": self.img_opt_max_dpi,
+            "img_opt_jpeg_quality": self.img_opt_jpeg_quality,
+            "img_opt_workers": self.img_opt_workers,
+            "img_opt_textwidth_in": self.img_opt_textwidth_in,
+            "task_write_behind_sec": self.task_write_behind_sec,
+            "status_cache_size": self.status_cache_size,
+            "status_cache_check_sec": self.status_cache_check_sec,
+            "result_accel_redirect": self.result_accel_redirect,
+            "debug_result_mode": self.debug_result_mode,
+            "zip_deflate_level": self.zip_deflate_level,
+            "input_store_ttl_days": self.input_store_ttl_days,
+            "upload_session_ttl_sec": self.upload_session_ttl_sec,
+            "metrics_dir": str(self.metrics_dir),
+            "metrics_flush_sec": self.metrics_flush_sec,
+            "jvm_heap_policy": self.jvm_heap_policy,
+            "jvm_heap_min_mb": self.jvm_heap_min_mb,
+            "jvm_heap_max_mb": self.jvm_heap_max_mb,
+            "preflight_max_uncompressed_bytes": self.preflight_max_uncompressed_bytes,
+            "preflight_max_ratio": self.preflight_max_ratio,
+            "preflight_max_entries": self.preflight_max_entries,
+            "queue_aging": self.queue_aging,
+            "queue_max_jobs": self.queue_max_jobs,
+            "queue_max_bytes": self.queue_max_bytes,
+            "default_deadline_sec": self.default_deadline_sec,
+            "inkscape_timeout_sec": self.inkscape_timeout_sec,
         }
 
 
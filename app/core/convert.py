@@ -1,58 +1,85 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
 
-def compute_cache_key(
-    docx: Path,
-    conf: Optional[Path],
+def _tagged_chunks(path: Path, tag: bytes) -> list[bytes]:
+    parts: list[bytes] = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 512), b""):
+            parts.append(tag)
+            parts.append(chunk)
+    return parts
+
+
+def cache_key_options(
+    conf: Path,
     xsl: Optional[Path],
     evolve_xsl: Optional[Path] = None,
     mtef_source: Optional[str] = None,
     table_model: Optional[str] = None,
     fontmaps_zip: Optional[Path] = None,
-) -> str:
-    import hashlib
+) -> bytes:
+    """Bytes hashed after the DOCX by `compute_cache_key`.
 
-    h = hashlib.sha256()
-    # docx
-    with open(docx, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    # conf (use provided path)
-    conf_path = conf if conf else docx.with_suffix(".conf.xml")
-    with open(conf_path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 512), b""):
-            h.update(b"|CONF|")
-            h.update(chunk)
+    Computing them once lets callers sharing the same options (batches) key
+    many documents without re-reading the option files.
+    """
+    parts = _tagged_chunks(conf, b"|CONF|")
     # xsl (optional)
     if xsl and xsl.exists():
-        with open(xsl, "rb") as f:
-            for chunk in iter(lambda: f.read(1024 * 512), b""):
-                h.update(b"|XSL|")
-                h.update(chunk)
+        parts += _tagged_chunks(xsl, b"|XSL|")
     else:
-        h.update(b"|XSL|NONE")
+        parts.append(b"|XSL|NONE")
     # evolve driver (optional)
     if evolve_xsl and evolve_xsl.exists():
-        with open(evolve_xsl, "rb") as f:
-            for chunk in iter(lambda: f.read(1024 * 512), b""):
-                h.update(b"|EVOLVE|")
-                h.update(chunk)
+        parts += _tagged_chunks(evolve_xsl, b"|EVOLVE|")
     else:
-        h.update(b"|EVOLVE|NONE")
+        parts.append(b"|EVOLVE|NONE")
     # mtef/table
-    h.update(("|MTEF|" + (mtef_source or "NONE")).encode("utf-8"))
-    h.update(("|TABLE|" + (table_model or "NONE")).encode("utf-8"))
+    parts.append(("|MTEF|" + (mtef_source or "NONE")).encode("utf-8"))
+    parts.append(("|TABLE|" + (table_model or "NONE")).encode("utf-8"))
     # fontmaps zip content
     if fontmaps_zip and fontmaps_zip.exists():
-        with open(fontmaps_zip, "rb") as f:
-            for chunk in iter(lambda: f.read(1024 * 512), b""):
-                h.update(b"|FONTS|")
-                h.update(chunk)
+        parts += _tagged_chunks(fontmaps_zip, b"|FONTS|")
+    else:
+        parts.append(b"|FONTS|NONE")
+    return b"".join(parts)
+
+
+def compute_cache_key(
+    docx: Path,
+    conf: Optional[Path],
+    xsl: Optional[Path],
+    evolve_xsl: Optional[Path] = None,
+    mtef_source: Optional[str] = None,
+    table_model: Optional[str] = None,
+    fontmaps_zip: Optional[Path] = None,
+    *,
+    options: Optional[bytes] = None,
+    docx_hash: Optional[Any] = None,
+) -> str:
+    """sha256 over the DOCX bytes followed by `cache_key_options`.
+
+    `docx_hash` may be a sha256 object already fed with the DOCX bytes (e.g.
+    while the upload was stored), which skips re-reading the file.
+    """
+    import hashlib
+
+    if docx_hash is not None:
+        h = docx_hash.copy()
     else:
-        h.update(b"|FONTS|NONE")
+        h = hashlib.sha256()
+        # docx
+        with open(docx, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    if options is None:
+        # conf (use provided path)
+        conf_path = conf if conf else docx.with_suffix(".conf.xml")
+        options = cache_key_options(conf_path, xsl, evolve_xsl, mtef_source, table_model, fontmaps_zip)
+    h.update(options)
     return h.hexdigest()
 
 
@@ -1,23 +1,210 @@
 from __future__ import annotations
 
+import os
 import sqlite3
+import threading
+import time
+import weakref
 from pathlib import Path
 from typing import Optional
 
+from . import metrics
+
+
+# Ordered schema migrations applied on top of the base tables in init_schema.
+# Each entry is (version, statements); PRAGMA user_version records the last
+# applied version. Append new entries, never edit released ones.
+MIGRATIONS: list[tuple[int, list[str]]] = [
+    (
+        1,
+        [
+            # Backfill so cleanup can filter on plain indexed columns
+            "UPDATE tasks SET end_time=start_time WHERE end_time IS NULL AND state IN ('done','failed')",
+            "UPDATE caches SET last_access=created WHERE last_access IS NULL",
+            "CREATE INDEX IF NOT EXISTS idx_tasks_state_end ON tasks(state, end_time)",
+            "CREATE INDEX IF NOT EXISTS idx_caches_last_access ON caches(last_access)",
+            "CREATE INDEX IF NOT EXISTS idx_locks_started ON locks(started)",
+        ],
+    ),
+    (
+        2,
+        [
+            # Result package recorded at packaging time (path, digest, size)
+            "ALTER TABLE tasks ADD COLUMN result_path TEXT",
+            "ALTER TABLE tasks ADD COLUMN result_sha256 TEXT",
+            "ALTER TABLE tasks ADD COLUMN result_size INTEGER",
+        ],
+    ),
+    (
+        3,
+        [
+            # 'zip' (file under WORK_ROOT) or 'stream' (built from the work dir on download)
+            "ALTER TABLE tasks ADD COLUMN result_mode TEXT",
+        ],
+    ),
+    (
+        4,
+        [
+            # Tasks submitted together through POST /v1/batch
+            "ALTER TABLE tasks ADD COLUMN batch_id TEXT",
+            "CREATE INDEX IF NOT EXISTS idx_tasks_batch ON tasks(batch_id)",
+        ],
+    ),
+    (
+        5,
+        [
+            # Structured per-stage timings (queue wait, input, hashing, calabash, ...)
+            """
+            CREATE TABLE IF NOT EXISTS task_stages (
+              task_id TEXT NOT NULL,
+              stage TEXT NOT NULL,
+              started REAL NOT NULL,
+              duration REAL NOT NULL,
+              detail TEXT
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_task_stages_task ON task_stages(task_id, started)",
+        ],
+    ),
+    (
+        6,
+        [
+            # Latest runs of one stage (JVM heap calibration from Calabash peak RSS)
+            "CREATE INDEX IF NOT EXISTS idx_task_stages_stage ON task_stages(stage, started)",
+        ],
+    ),
+    (
+        7,
+        [
+            # Pre-flight cost estimate (seconds), used for scheduling
+            "ALTER TABLE tasks ADD COLUMN est_seconds REAL",
+        ],
+    ),
+    (
+        8,
+        [
+            # Scheduling key of queued tasks (NULL once started); queue position across workers
+            "ALTER TABLE tasks ADD COLUMN queue_key REAL",
+            "CREATE INDEX IF NOT EXISTS idx_tasks_queue_key ON tasks(queue_key) WHERE queue_key IS NOT NULL",
+        ],
+    ),
+    (
+        9,
+        [
+            # DOCX bytes of submitted tasks: queued bytes for admission control, drained bytes for Retry-After
+            "ALTER TABLE tasks ADD COLUMN input_bytes INTEGER",
+        ],
+    ),
+    (
+        10,
+        [
+            # Absolute deadline (epoch seconds) from deadline_sec / DEFAULT_DEADLINE_SEC
+            "ALTER TABLE tasks ADD COLUMN deadline REAL",
+        ],
+    ),
+    (
+        11,
+        [
+            # Tasks whose status changed, in commit order; lets each process's
+            # StatusCache drop just those entries (pruned by the cleanup loop)
+            "CREATE TABLE IF NOT EXISTS task_changes (rev INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT NOT NULL)",
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_tasks_changed
+            AFTER UPDATE OF state, err_msg, end_time, sha256, result_path, result_sha256, result_size, result_mode,
+                            est_seconds, deadline ON tasks
+            BEGIN INSERT INTO task_changes(task_id) VALUES (NEW.task_id); END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_tasks_deleted AFTER DELETE ON tasks
+            BEGIN INSERT INTO task_changes(task_id) VALUES (OLD.task_id); END
+            """,
+        ],
+    ),
+    (
+        12,
+        [
+            # Stage records are cached with the status, so they count as changes too
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_task_stages_added AFTER INSERT ON task_stages
+            BEGIN INSERT INTO task_changes(task_id) VALUES (NEW.task_id); END
+            """,
+        ],
+    ),
+    (
+        13,
+        [
+            # Pre-flight size figures, reused to size the Calabash JVM heap
+            "ALTER TABLE tasks ADD COLUMN document_xml_bytes INTEGER",
+            "ALTER TABLE tasks ADD COLUMN media_bytes INTEGER",
+        ],
+    ),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Extra attempts after busy_timeout expired with SQLITE_BUSY (counted in metrics)
+BUSY_RETRIES = 3
+
+
+def _is_busy(exc: sqlite3.OperationalError) -> bool:
+    msg = str(exc).lower()
+    return "database is locked" in msg or "database is busy" in msg
+
+
+class _Connection(sqlite3.Connection):
+    """Connection that retries statements which still hit SQLITE_BUSY."""
+
+    def _retry(self, fn, *args):
+        for attempt in range(BUSY_RETRIES + 1):
+            try:
+                return fn(*args)
+            except sqlite3.OperationalError as e:
+                if attempt == BUSY_RETRIES or not _is_busy(e):
+                    raise
+                metrics.inc("docx2tex_sqlite_busy_retries_total")
+                time.sleep(0.05 * (attempt + 1))
+
+    def execute(self, *args):
+        return self._retry(super().execute, *args)
+
+    def executemany(self, *args):
+        return self._retry(super().executemany, *args)
+
+    def commit(self):
+        return self._retry(super().commit)
+
 
 class Database:
     """SQLite database helper with schema initialization.
 
     Mirrors the schema used by server.py and provides methods to create
     connections with sane defaults for concurrency.
+
+    Connections are persistent per thread (and per process, so forked workers
+    never share a handle). PRAGMAs are applied once when a connection is
+    opened, and sqlite3's per-connection statement cache lets repeated queries
+    reuse their prepared statements. Callers keep using
+    `with db.connect() as con:`, which commits or rolls back but does not close.
+    Only the thread-local holds a connection strongly, so the connection of a
+    thread that exits is closed when its thread-local is released.
     """
 
+    STATEMENT_CACHE_SIZE = 256
+
     def __init__(self, db_path: Path):
         self.db_path = db_path
+        self._local = threading.local()
+        # Weak: tracks open connections for close() without keeping dead threads' alive
+        self._all: "weakref.WeakSet[sqlite3.Connection]" = weakref.WeakSet()
+        self._all_lock = threading.Lock()
 
-    def connect(self) -> sqlite3.Connection:
+    def _open(self) -> sqlite3.Connection:
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        con = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        con = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            cached_statements=self.STATEMENT_CACHE_SIZE,
+            factory=_Connection,
+        )
         con.row_factory = sqlite3.Row
         # Improve concurrency
         con.execute("PRAGMA journal_mode=WAL;")
@@ -25,6 +212,29 @@ class Database:
         con.execute("PRAGMA busy_timeout=5000;")
         return con
 
+    def connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use."""
+        con = getattr(self._local, "con", None)
+        if con is not None and getattr(self._local, "pid", None) == os.getpid():
+            return con
+        con = self._open()
+        self._local.con = con
+        self._local.pid = os.getpid()
+        with self._all_lock:
+            self._all.add(con)
+        return con
+
+    def close(self) -> None:
+        """Close every connection opened by this instance (best-effort)."""
+        with self._all_lock:
+            cons, self._all = list(self._all), weakref.WeakSet()
+        for con in cons:
+            try:
+                con.close()
+            except Exception:
+                pass
+        self._local = threading.local()
+
     def init_schema(self) -> None:
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         with self.connect() as con:
@@ -73,4 +283,30 @@ class Database:
                 """
             )
             con.commit()
+        self.migrate()
+
+    def schema_version(self) -> int:
+        with self.connect() as con:
+            return int(con.execute("PRAGMA user_version").fetchone()[0])
+
+    def migrate(self) -> int:
+        """Apply pending MIGRATIONS; safe to call concurrently from several workers."""
+        con = self.connect()
+        if self.schema_version() >= SCHEMA_VERSION:
+            return SCHEMA_VERSION
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            current = int(con.execute("PRAGMA user_version").fetchone()[0])
+            for version, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                for sql in statements:
+                    con.execute(sql)
+                con.execute(f"PRAGMA user_version={int(version)}")
+                current = version
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        return current
 
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from .postprocess import INCLUDE_RE, ensure_unique, unescape_tex_path
+from .storage import compute_sha256
+
+
+# Units accepted in `width=` options, expressed in inches.
+_UNIT_IN = {
+    "in": 1.0,
+    "cm": 1 / 2.54,
+    "mm": 1 / 25.4,
+    "pt": 1 / 72.27,
+    "bp": 1 / 72.0,
+}
+_WIDTH_RE = re.compile(
+    r"width\s*=\s*([0-9]*\.?[0-9]+)?\s*(?:(in|cm|mm|pt|bp)\b|\\+(textwidth|linewidth|columnwidth))",
+    re.IGNORECASE,
+)
+_PNG_EXTS = {".png"}
+_JPEG_EXTS = {".jpg", ".jpeg"}
+_TO_PNG_EXTS = {".bmp", ".tif", ".tiff"}
+
+
+def _width_inches(options: str, textwidth_in: float) -> Optional[float]:
+    """Return the display width in inches from an includegraphics option string."""
+    m = _WIDTH_RE.search(options or "")
+    if not m:
+        return None
+    factor = float(m.group(1)) if m.group(1) else 1.0
+    if m.group(2):
+        return factor * _UNIT_IN[m.group(2).lower()]
+    return factor * textwidth_in
+
+
+def _collect_targets(content: str, prefix: str, textwidth_in: float) -> dict[str, Optional[float]]:
+    """Map image file name (under prefix/) to the largest display width in inches.
+
+    None means at least one include has no parseable width, so no downscaling.
+    """
+    targets: dict[str, Optional[float]] = {}
+    for m in INCLUDE_RE.finditer(content):
+        ref = unescape_tex_path(m.group(3)).replace("\\", "/")
+        if not ref.startswith(f"{prefix}/"):
+            continue
+        name = ref[len(prefix) + 1 :]
+        w = _width_inches(m.group(2) or "", textwidth_in)
+        if name in targets:
+            prev = targets[name]
+            targets[name] = None if (prev is None or w is None) else max(prev, w)
+        else:
+            targets[name] = w
+    return targets
+
+
+def _optimize_one(
+    src: Path,
+    dst: Path,
+    max_px: Optional[int],
+    jpeg_quality: int,
+    cache_dir: Optional[Path],
+) -> Optional[tuple[int, int, bool]]:
+    """Optimize `src` into `dst` (same path unless converting to PNG).
+
+    Returns (bytes_before, bytes_after, from_cache) or None when the file is
+    left untouched.
+    """
+    from PIL import Image
+
+    ext = src.suffix.lower()
+    out_ext = dst.suffix.lower()
+    before = src.stat().st_size
+
+    cached: Optional[Path] = None
+    if cache_dir is not None:
+        key = hashlib.sha256(
+            f"{compute_sha256(src)}|{max_px or 0}|{jpeg_quality}".encode("utf-8")
+        ).hexdigest()
+        cached = cache_dir / key[:2] / f"{key}{out_ext}"
+        if cached.exists():
+            after = cached.stat().st_size
+            if dst == src and after >= before:
+                return None
+            shutil.copyfile(cached, dst)
+            if dst != src:
+                src.unlink()
+            try:
+                os.utime(cached)  # mtime drives retention in cleanup
+            except OSError:
+                pass
+            return before, after, True
+
+    # Unique per call: a.png and a.bmp -> a_1.png are optimized side by side
+    fd, name = tempfile.mkstemp(prefix=f".{src.stem}.", suffix=f".opt{out_ext}", dir=src.parent)
+    os.close(fd)
+    tmp = Path(name)
+    try:
+        with Image.open(src) as im:
+            im.load()
+            if max_px and im.width > max_px:
+                h = max(1, round(im.height * max_px / im.width))
+                im = im.resize((max_px, h), Image.LANCZOS)
+            if out_ext in _JPEG_EXTS:
+                if im.mode not in ("RGB", "L", "CMYK"):
+                    im = im.convert("RGB")
+                im.save(tmp, "JPEG", quality=jpeg_quality, optimize=True, progressive=True)
+            else:
+                im.save(tmp, "PNG", optimize=True)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    after = tmp.stat().st_size
+    unchanged = dst == src and after >= before
+    if unchanged:
+        # Re-encoding did not help; keep the original bytes.
+        tmp.unlink()
+    else:
+        tmp.replace(dst)
+        if dst != src:
+            src.unlink()
+
+    if cached is not None:
+        _publish_cached(dst, cached)
+    if unchanged:
+        return None
+    return before, after, False
+
+
+def _publish_cached(src: Path, cached: Path) -> None:
+    """Copy `src` into the shared cache; readers only ever see complete files."""
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        fd, name = tempfile.mkstemp(prefix=f".{cached.name}.", dir=cached.parent)
+        os.close(fd)
+        try:
+            shutil.copyfile(src, name)
+            os.replace(name, cached)
+        except BaseException:
+            os.unlink(name)
+            raise
+    except Exception:
+        pass
+
+
+def optimize_raster_images(
+    tex_path: Path,
+    image_dir: Path,
+    image_alias: Optional[str] = None,
+    *,
+    max_dpi: int = 300,
+    textwidth_in: float = 6.0,
+    jpeg_quality: int = 85,
+    workers: int = 2,
+    cache_dir: Optional[Path] = None,
+) -> dict:
+    """Shrink raster images collected by `release_collect_images_and_normalize`.
+
+    - PNG is re-compressed losslessly, JPEG is re-encoded at `jpeg_quality`.
+    - BMP/TIFF are converted to PNG and TeX references are rewritten.
+    - Images displayed at a known `width=` are downscaled to at most `max_dpi`.
+    - Results are cached under `cache_dir` by source digest and parameters.
+
+    Returns a stats dict suitable for the manifest. Requires Pillow; when it is
+    not installed the stage is skipped.
+    """
+    stats: dict = {"optimized": 0, "converted": 0, "cache_hits": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        stats["skipped"] = "Pillow not installed"
+        return stats
+    if not image_dir.exists():
+        return stats
+
+    prefix = (image_alias or image_dir.name).strip("/\\") or "image"
+    content = tex_path.read_text(encoding="utf-8", errors="replace")
+    targets = _collect_targets(content, prefix, textwidth_in)
+
+    used_names: set[str] = {p.name for p in image_dir.iterdir()}
+    jobs: list[tuple[str, Path, Path, Optional[int]]] = []
+    for name, width_in in targets.items():
+        src = image_dir / name
+        ext = src.suffix.lower()
+        if not src.is_file() or ext not in (_PNG_EXTS | _JPEG_EXTS | _TO_PNG_EXTS):
+            continue
+        dst = src
+        if ext in _TO_PNG_EXTS:
+            dst = src.with_name(ensure_unique(used_names, f"{src.stem}.png"))
+        max_px = int(width_in * max_dpi) if (width_in and max_dpi > 0) else None
+        jobs.append((name, src, dst, max_px))
+
+    def run(job: tuple[str, Path, Path, Optional[int]]):
+        name, src, dst, max_px = job
+        try:
+            return name, dst, _optimize_one(src, dst, max_px, jpeg_quality, cache_dir)
+        except Exception:
+            return name, dst, False
+
+    renames: dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for name, dst, res in pool.map(run, jobs):
+            if res is False:
+                stats["failed"] += 1
+                continue
+            if res is None:
+                continue
+            before, after, from_cache = res
+            stats["optimized"] += 1
+            stats["bytes_before"] += before
+            stats["bytes_after"] += after
+            if from_cache:
+                stats["cache_hits"] += 1
+            new_name = dst.relative_to(image_dir).as_posix()
+            if new_name != name:
+                stats["converted"] += 1
+                renames[name] = new_name
+
+    if renames:
+        def repl_func(match: re.Match) -> str:
+            inner = match.group(3)
+            ref = unescape_tex_path(inner).replace("\\", "/")
+            if not ref.startswith(f"{prefix}/"):
+                return match.group(0)
+            new_name = renames.get(ref[len(prefix) + 1 :])
+            if not new_name:
+                return match.group(0)
+            return f"{match.group(1)}{match.group(2) or ''}{{{prefix}/{new_name}}}"
+
+        new_content = INCLUDE_RE.sub(repl_func, content)
+        if new_content != content:
+            tex_path.write_text(new_content, encoding="utf-8")
+    return stats
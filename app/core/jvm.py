@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import math
+import os
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Iterable, Optional
+
+
+_MIB = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class DocxStats:
+    """Size figures of a DOCX as measured by the pre-flight check."""
+
+    document_xml_bytes: int = 0
+    media_count: int = 0
+    media_bytes: int = 0
+
+
+def docx_stats(report: dict) -> DocxStats:
+    """Heap-sizing figures from an `app.core.preflight.analyze_docx` report."""
+    media = (report.get("media") or {}).values()
+    return DocxStats(
+        document_xml_bytes=int(report.get("document_xml_bytes") or 0),
+        media_count=sum(int(m.get("count", 0)) for m in media),
+        media_bytes=sum(int(m.get("bytes", 0)) for m in media),
+    )
+
+
+@dataclass(frozen=True)
+class HeapPolicy:
+    """Per-run JVM sizing for Calabash.
+
+    The heap is `base_mb` plus `xml_factor` times the uncompressed
+    word/document.xml (the XSLT passes keep several trees of it in memory)
+    plus `media_factor` times the media bytes, with `headroom` on top,
+    rounded up to 64 MiB and clamped to [min_mb, max_mb]. `xml_factor` can be
+    re-fitted from peak RSS of earlier runs (see `calibrate`).
+    Small heaps use the serial collector (no GC threads competing with
+    other jobs); larger ones the parallel collector.
+    """
+
+    min_mb: int = 256
+    max_mb: int = 4096
+    base_mb: int = 192
+    xml_factor: float = 12.0
+    media_factor: float = 0.25
+    headroom: float = 1.25
+    serial_gc_max_mb: int = 1024
+    xss: str = "4m"
+    xss_large: str = "16m"
+    xss_large_xml_bytes: int = 32 * _MIB
+
+    def heap_mb(self, stats: DocxStats) -> int:
+        est = self.base_mb + (self.xml_factor * stats.document_xml_bytes + self.media_factor * stats.media_bytes) / _MIB
+        mb = int(math.ceil(est * self.headroom / 64.0) * 64)
+        return max(self.min_mb, min(self.max_mb, mb))
+
+    def options(self, stats: DocxStats) -> dict:
+        heap = self.heap_mb(stats)
+        gc = "SerialGC" if heap <= self.serial_gc_max_mb else "ParallelGC"
+        xss = self.xss_large if stats.document_xml_bytes >= self.xss_large_xml_bytes else self.xss
+        return {"xmx_mb": heap, "xss": xss, "gc": gc}
+
+    def calibrate(self, samples: Iterable[tuple[int, int]], min_samples: int = 5) -> "HeapPolicy":
+        """Re-fit `xml_factor` from (document_xml_bytes, peak_rss_bytes) pairs.
+
+        Uses the 90th percentile of the per-run ratio so most documents fit;
+        documents under 1 MiB are ignored because the fixed JVM overhead
+        dominates them. Returns self when there are too few samples.
+        """
+        ratios = sorted(
+            (rss - self.base_mb * _MIB) / doc
+            for doc, rss in samples
+            if doc >= _MIB and rss > self.base_mb * _MIB
+        )
+        if len(ratios) < min_samples:
+            return self
+        p90 = ratios[min(len(ratios) - 1, int(len(ratios) * 0.9))]
+        return replace(self, xml_factor=round(min(40.0, max(4.0, p90)), 2))
+
+
+def java_tool_options(current: str, opts: dict) -> str:
+    """Append heap/stack/GC flags to JAVA_TOOL_OPTIONS.
+
+    Flags the operator already set (any -Xmx, -Xss or collector choice) win.
+    """
+    parts = current.split()
+    extra = []
+    if not any(p.startswith("-Xmx") or p.startswith("-XX:MaxRAMPercentage") for p in parts):
+        extra.append(f"-Xmx{opts['xmx_mb']}m")
+    if not any(p.startswith("-Xss") for p in parts):
+        extra.append(f"-Xss{opts['xss']}")
+    if not any(p.startswith("-XX:+Use") and p.endswith("GC") for p in parts):
+        extra.append(f"-XX:+Use{opts['gc']}")
+    return " ".join(parts + extra)
+
+
+def memory_limit_bytes() -> Optional[int]:
+    """Container memory limit (cgroup v2/v1), else physical memory; None if unknown."""
+    for p in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            raw = Path(p).read_text().strip()
+        except OSError:
+            continue
+        if raw.isdigit() and int(raw) < (1 << 60):
+            return int(raw)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Iterable, Optional
+
+from .storage import atomic_write_json
+
+
+# name -> (type, help). Only metrics listed here are recorded or exported.
+METRICS: dict[str, tuple[str, str]] = {
+    "docx2tex_queue_depth": ("gauge", "Jobs submitted to a pool and waiting for a thread."),
+    "docx2tex_jobs_running": ("gauge", "Jobs currently executing in a pool."),
+    "docx2tex_stage_duration_seconds": ("histogram", "Duration of task stages (see GET /v1/task/{id} stages)."),
+    "docx2tex_calabash_runs_total": ("counter", "Calabash runs by exit code."),
+    "docx2tex_cache_requests_total": ("counter", "Conversion cache status at submit time."),
+    "docx2tex_vector_conversions_total": ("counter", "Vector image references handled by Inkscape conversion."),
+    "docx2tex_sqlite_busy_retries_total": ("counter", "SQLite statements retried after SQLITE_BUSY."),
+    "docx2tex_upload_bytes_total": ("counter", "Input bytes received, by upload kind."),
+    "docx2tex_cache_entries": ("gauge", "Available conversion cache entries."),
+    "docx2tex_cache_bytes": ("gauge", "Bytes on disk under DATA_ROOT/cache."),
+    "docx2tex_child_cpu_seconds_total": ("counter", "CPU time of child processes (Calabash, Inkscape) by mode."),
+    "docx2tex_child_io_blocks_total": ("counter", "Block I/O operations of child processes by direction."),
+    "docx2tex_child_max_rss_bytes": ("histogram", "Peak resident set size of child processes, per task stage."),
+    "docx2tex_admission_rejected_total": ("counter", "Submissions refused with 429 because the job queue was full, by limit."),
+    "docx2tex_tasks_expired_total": ("counter", "Tasks ended as expired because their deadline passed, by where (queue or running)."),
+}
+
+# Seconds; stages range from milliseconds (hashing) to the Calabash timeout.
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0)
+# Bytes; sized for JVM heaps (Calabash) from 64 MiB to 16 GiB.
+RSS_BUCKETS = tuple(float(2**n * 1024 * 1024) for n in range(6, 15))
+
+# Histograms not listed here use DURATION_BUCKETS.
+BUCKETS: dict[str, tuple[float, ...]] = {
+    "docx2tex_child_max_rss_bytes": RSS_BUCKETS,
+}
+
+
+def buckets_for(name: str) -> tuple[float, ...]:
+    return BUCKETS.get(name, DURATION_BUCKETS)
+
+
+_Key = tuple[str, tuple[tuple[str, str], ...]]
+
+
+def _key(name: str, labels: dict) -> _Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+    """Process-local counters, gauges and histograms.
+
+    uvicorn workers are separate processes, so each one periodically writes
+    its values to `<dir>/<pid>-<token>.json` (see `start_flusher`) and the
+    worker answering /metrics merges every snapshot with its own live values.
+    Counters and histograms of exited workers keep counting; their gauges
+    are dropped.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: dict[_Key, float] = {}
+        self._gauges: dict[_Key, float] = {}
+        self._hists: dict[_Key, list[float]] = {}  # bucket counts..., +Inf, sum
+        self._dir: Optional[Path] = None
+        self._file: Optional[str] = None
+        self._flusher: Optional[threading.Thread] = None
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            self._counters[k] = self._counters.get(k, 0.0) + value
+
+    def gauge_add(self, name: str, delta: float, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            self._gauges[k] = self._gauges.get(k, 0.0) + delta
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            bounds = buckets_for(name)
+            h = self._hists.get(k)
+            if h is None:
+                h = self._hists[k] = [0.0] * (len(bounds) + 2)
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    h[i] += 1
+                    break
+            else:
+                h[len(bounds)] += 1
+            h[-1] += value
+
+    def snapshot(self, include_gauges: bool = True) -> dict:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "counters": [[n, list(map(list, lb)), v] for (n, lb), v in self._counters.items()],
+                "gauges": [[n, list(map(list, lb)), v] for (n, lb), v in self._gauges.items()] if include_gauges else [],
+                "histograms": [[n, list(map(list, lb)), list(h)] for (n, lb), h in self._hists.items()],
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._hists.clear()
+
+    # --- Multiprocess ---
+    def _snapshot_name(self) -> str:
+        if self._file is None or not self._file.startswith(f"{os.getpid()}-"):
+            self._file = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+        return self._file
+
+    def dump(self, include_gauges: bool = True) -> Optional[Path]:
+        if self._dir is None:
+            return None
+        self._dir.mkdir(parents=True, exist_ok=True)
+        path = self._dir / self._snapshot_name()
+        atomic_write_json(path, self.snapshot(include_gauges))
+        return path
+
+    def start_flusher(self, directory: Path, interval_sec: float = 5.0) -> None:
+        """Write this process's snapshot every `interval_sec` and at exit."""
+        self._dir = directory
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+
+        def loop():
+            while True:
+                time.sleep(max(0.5, interval_sec))
+                try:
+                    self.dump()
+                except Exception:
+                    pass
+
+        self._flusher = threading.Thread(target=loop, name="metrics-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self._dump_at_exit)
+
+    def _dump_at_exit(self) -> None:
+        try:
+            self.dump(include_gauges=False)
+        except Exception:
+            pass
+
+    def collect(self, directory: Optional[Path] = None) -> dict:
+        """Merge this process's live values with the other workers' snapshots."""
+        directory = directory or self._dir
+        snaps = [self.snapshot()]
+        if directory is not None and directory.exists():
+            for p in directory.glob("*.json"):
+                if p.name.startswith(f"{os.getpid()}-"):
+                    continue
+                try:
+                    snap = json.loads(p.read_text(encoding="utf-8"))
+                except Exception:
+                    continue
+                if not _pid_alive(int(snap.get("pid") or 0)):
+                    snap["gauges"] = []
+                snaps.append(snap)
+        return merge(snaps)
+
+
+def merge(snapshots: Iterable[dict]) -> dict:
+    out: dict[str, dict] = {"counters": {}, "gauges": {}, "histograms": {}}
+    for snap in snapshots:
+        for kind in ("counters", "gauges"):
+            for name, labels, value in snap.get(kind, []):
+                k = (name, tuple(tuple(x) for x in labels))
+                out[kind][k] = out[kind].get(k, 0.0) + value
+        for name, labels, buckets in snap.get("histograms", []):
+            k = (name, tuple(tuple(x) for x in labels))
+            cur = out["histograms"].get(k)
+            out["histograms"][k] = list(buckets) if cur is None else [a + b for a, b in zip(cur, buckets)]
+    return out
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+def _labels(pairs: Iterable[tuple[str, str]]) -> str:
+    parts = []
+    for k, v in pairs:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render(merged: dict, extra_gauges: Optional[dict[str, float]] = None) -> str:
+    """Prometheus text exposition format (version 0.0.4)."""
+    gauges = dict(merged.get("gauges", {}))
+    for name, value in (extra_gauges or {}).items():
+        gauges[(name, ())] = value
+    series: dict[str, list[tuple]] = {}
+    for (name, labels), v in list(merged.get("counters", {}).items()) + list(gauges.items()):
+        series.setdefault(name, []).append((labels, 0, f"{name}{_labels(labels)} {_fmt(v)}"))
+    for (name, labels), h in merged.get("histograms", {}).items():
+        lines = series.setdefault(name, [])
+        cumulative = 0.0
+        for i, (bound, n) in enumerate(zip(list(buckets_for(name)) + [float("inf")], h[:-1])):
+            cumulative += n
+            le = tuple(labels) + (("le", _fmt(bound)),)
+            lines.append((labels, i, f"{name}_bucket{_labels(le)} {_fmt(cumulative)}"))
+        lines.append((labels, i + 1, f"{name}_sum{_labels(labels)} {_fmt(h[-1])}"))
+        lines.append((labels, i + 2, f"{name}_count{_labels(labels)} {_fmt(cumulative)}"))
+    out: list[str] = []
+    for name, (kind, help_text) in METRICS.items():
+        if name not in series:
+            continue
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(line for _, _, line in sorted(series[name], key=lambda t: (t[0], t[1])))
+    return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+gauge_add = REGISTRY.gauge_add
+observe = REGISTRY.observe
+
+
+def record_child_usage(tool: str, usage: dict) -> None:
+    """Count one child run's rusage (see proc.run_subprocess) under `tool`."""
+    if not usage:
+        return
+    REGISTRY.inc("docx2tex_child_cpu_seconds_total", usage.get("cpu_user_sec", 0), tool=tool, mode="user")
+    REGISTRY.inc("docx2tex_child_cpu_seconds_total", usage.get("cpu_sys_sec", 0), tool=tool, mode="system")
+    REGISTRY.inc("docx2tex_child_io_blocks_total", usage.get("io_read_blocks", 0), tool=tool, direction="read")
+    REGISTRY.inc("docx2tex_child_io_blocks_total", usage.get("io_write_blocks", 0), tool=tool, direction="write")
+    REGISTRY.observe("docx2tex_child_max_rss_bytes", usage.get("max_rss_kb", 0) * 1024, tool=tool)
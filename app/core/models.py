@@ -16,6 +16,17 @@ class JobState(BaseModel):
     img_post_proc: bool = True
     work_dir: str
     sha256: Optional[str] = None
+    result_path: Optional[str] = None
+    result_sha256: Optional[str] = None
+    result_size: Optional[int] = None
+    result_mode: Optional[str] = None
+    batch_id: Optional[str] = None
+    est_seconds: Optional[float] = None
+    # Epoch seconds after which the result is no longer wanted (None = no deadline)
+    deadline: Optional[float] = None
+    # Pre-flight figures: uncompressed word/document.xml and word/media bytes
+    document_xml_bytes: Optional[int] = None
+    media_bytes: Optional[int] = None
 
 
 class CacheEntry(BaseModel):
@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import json
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from .storage import atomic_write_json, compute_sha256
+
+
+# Sidecar in the work dir describing what the result package contains, so the
+# package can be re-streamed (or inspected) without re-walking the work dir.
+ENTRIES_FILE = "package_entries.json"
+
+_CHUNK = 1024 * 1024
+
+# Formats that are already compressed; deflating them again only burns CPU.
+STORED_EXTS = frozenset(
+    {
+        ".png", ".jpg", ".jpeg", ".jfif", ".gif", ".webp", ".pdf", ".emz", ".wdp",
+        ".zip", ".docx", ".xlsx", ".pptx", ".vsdx", ".odt",
+        ".gz", ".bz2", ".xz", ".7z", ".mp3", ".mp4",
+    }
+)
+
+
+@dataclass(frozen=True)
+class ZipPolicy:
+    """Per-entry compression policy for result packages.
+
+    Already-compressed media is STORED; everything else is deflated at
+    `deflate_level`.
+    """
+
+    deflate_level: int = 6
+
+    def compress_type(self, arcname: str) -> int:
+        return ZIP_STORED if Path(arcname).suffix.lower() in STORED_EXTS else ZIP_DEFLATED
+
+    def as_dict(self) -> dict:
+        return {"deflate_level": self.deflate_level}
+
+
+def _add_tree(entries: list[tuple[str, Path]], root: Path, arc_prefix: str) -> None:
+    if not root.exists():
+        return
+    for sub in sorted(root.rglob("*")):
+        if sub.is_file():
+            entries.append((f"{arc_prefix}/{sub.relative_to(root).as_posix()}", sub))
+
+
+def debug_entries(work: Path, basename: str, log_path: Optional[Path]) -> list[tuple[str, Path]]:
+    """(arcname, source) pairs for a debug package, in archive order."""
+    entries: list[tuple[str, Path]] = []
+    for name in (f"{basename}.tex", f"{basename}.xml", f"{basename}.csv"):
+        p = work / name
+        if p.exists():
+            entries.append((p.name, p))
+    _add_tree(entries, work / f"{basename}.debug", f"{basename}.debug")
+    _add_tree(entries, work / f"{basename}.docx.tmp", f"{basename}.docx.tmp")
+    if log_path is not None and log_path.exists():
+        entries.append((f"logs/{log_path.name}", log_path))
+    eff = work / "custom-evolve-effective.xsl"
+    if eff.exists():
+        entries.append((f"xsl/{eff.name}", eff))
+    sm = work / "stylemap_manifest.json"
+    if sm.exists():
+        entries.append((sm.name, sm))
+    return entries
+
+
+def release_entries(work: Path, basename: str, image_dir: str) -> list[tuple[str, Path]]:
+    """(arcname, source) pairs for a release package: TeX plus collected images."""
+    entries: list[tuple[str, Path]] = []
+    out_tex = work / f"{basename}.tex"
+    if out_tex.exists():
+        entries.append((out_tex.name, out_tex))
+    _add_tree(entries, work / image_dir, image_dir)
+    return entries
+
+
+def save_entries(work: Path, basename: str, entries: list[tuple[str, Path]], manifest: dict) -> Path:
+    path = work / ENTRIES_FILE
+    atomic_write_json(
+        path,
+        {
+            "basename": basename,
+            "entries": [[arc, str(src)] for arc, src in entries],
+            "manifest": manifest,
+        },
+    )
+    return path
+
+
+def load_entries(work: Path) -> Optional[dict]:
+    path = work / ENTRIES_FILE
+    if not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+
+
+DIGESTS_FILE = "package_digests.json"
+
+
+def entry_digests(work: Path, entries: Iterable[tuple[str, Path]]) -> dict[str, dict]:
+    """Size and sha256 per arcname, memoized in a sidecar keyed by size+mtime."""
+    memo_path = work / DIGESTS_FILE
+    try:
+        memo = json.loads(memo_path.read_text(encoding="utf-8")) if memo_path.exists() else {}
+    except Exception:
+        memo = {}
+    out: dict[str, dict] = {}
+    changed = False
+    for arc, src in entries:
+        try:
+            st = Path(src).stat()
+        except FileNotFoundError:
+            continue
+        cached = memo.get(arc)
+        if cached and cached.get("size") == st.st_size and cached.get("mtime_ns") == st.st_mtime_ns:
+            out[arc] = cached
+            continue
+        out[arc] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": compute_sha256(Path(src))}
+        changed = True
+    if changed:
+        memo.update(out)
+        try:
+            atomic_write_json(memo_path, memo)
+        except Exception:
+            pass
+    return out
+
+
+def write_zip(
+    dest: Path,
+    entries: Iterable[tuple[str, Path]],
+    manifest: dict,
+    policy: Optional[ZipPolicy] = None,
+) -> dict:
+    """Write entries plus manifest.json to `dest` following `policy`.
+
+    The returned stats (time, sizes, ratio) are also stored in the manifest
+    under "packaging" before it is written.
+    """
+    policy = policy or ZipPolicy()
+    entries = list(entries)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
+    with ZipFile(dest, "w", ZIP_DEFLATED) as zf:
+        for arc, src in entries:
+            zf.write(src, arcname=arc, compress_type=policy.compress_type(arc), compresslevel=policy.deflate_level)
+
+        bytes_in = sum(i.file_size for i in zf.infolist())
+        bytes_out = sum(i.compress_size for i in zf.infolist())
+        stats = {
+            "seconds": round(time.perf_counter() - t0, 4),
+            "entries": len(entries),
+            "stored": sum(1 for i in zf.infolist() if i.compress_type == ZIP_STORED),
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "ratio": round(bytes_out / bytes_in, 4) if bytes_in else 1.0,
+            "policy": policy.as_dict(),
+        }
+        manifest["packaging"] = stats
+        zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+    return stats
+
+
+class _Sink:
+    """Write-only, non-seekable file object that ZipFile streams into."""
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._pos = 0
+
+    def write(self, b) -> int:
+        self._buf += b
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        out = bytes(self._buf)
+        self._buf.clear()
+        return out
+
+
+def stream_zip(
+    entries: Iterable[tuple[str, Path]],
+    manifest: dict,
+    policy: Optional[ZipPolicy] = None,
+) -> Iterator[bytes]:
+    """Yield a ZIP archive chunk by chunk without touching the disk.
+
+    ZipFile writes data descriptors when its target cannot seek. STORED
+    entries (large media) are emitted chunk by chunk as they are read;
+    deflated entries go through `ZipFile.write`, the only public call that
+    takes a per-entry level, so at most one compressed text entry is held in
+    memory. Entries that vanished since packaging are skipped.
+    """
+    policy = policy or ZipPolicy()
+    sink = _Sink()
+    with ZipFile(sink, "w", ZIP_DEFLATED) as zf:  # type: ignore[arg-type]
+        for arc, src in entries:
+            src = Path(src)
+            if not src.is_file():
+                continue
+            if policy.compress_type(arc) == ZIP_DEFLATED:
+                zf.write(src, arcname=arc, compress_type=ZIP_DEFLATED, compresslevel=policy.deflate_level)
+            else:
+                info = ZipInfo.from_file(src, arcname=arc)
+                info.compress_type = ZIP_STORED
+                with open(src, "rb") as fin, zf.open(info, "w", force_zip64=True) as fout:
+                    for chunk in iter(lambda: fin.read(_CHUNK), b""):
+                        fout.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            data = sink.drain()
+            if data:
+                yield data
+        zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+    data = sink.drain()
+    if data:
+        yield data
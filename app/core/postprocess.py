@@ -3,7 +3,9 @@ from __future__ import annotations
 import re
 import shutil
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Callable, Tuple, Optional
+
+from .storage import compute_sha256
 
 
 INCLUDE_RE = re.compile(
@@ -21,23 +23,26 @@ def _normalize_width_options(text: str) -> str:
     return text
 
 
-def _unescape_tex_path(p: str) -> str:
+def unescape_tex_path(p: str) -> str:
+    """Undo the escaping of `%` and `#` in an includegraphics path."""
     return p.replace(r"\%", "%").replace(r"\#", "#")
 
 
-def _ensure_unique(dst_dir: Path, filename: str) -> str:
+def ensure_unique(used: set[str], filename: str) -> str:
+    """Pick a name not yet in `used` (an in-memory registry) and reserve it."""
     stem = Path(filename).stem
     suffix = Path(filename).suffix
     candidate = filename
     i = 1
-    while (dst_dir / candidate).exists():
+    while candidate in used:
         candidate = f"{stem}_{i}{suffix}"
         i += 1
+    used.add(candidate)
     return candidate
 
 
 def _find_source(tex_dir: Path, stem_dir: Path, raw_path: str) -> Path | None:
-    p = Path(_unescape_tex_path(raw_path))
+    p = Path(unescape_tex_path(raw_path))
     candidates: list[Path] = []
     if not p.is_absolute():
         candidates.append((tex_dir / p).resolve())
@@ -66,11 +71,18 @@ def _find_source(tex_dir: Path, stem_dir: Path, raw_path: str) -> Path | None:
 
 
 def release_collect_images_and_normalize(
-    tex_path: Path, image_dir: Path, image_alias: Optional[str] = None
+    tex_path: Path,
+    image_dir: Path,
+    image_alias: Optional[str] = None,
+    stats: Optional[dict] = None,
 ) -> Tuple[int, int]:
     """Non-debug: collect referenced images to image_dir, rewrite include paths,
     drop .vsdx includes, and normalize width options.
 
+    Images are de-duplicated by content digest: identical files embedded under
+    different names are copied once and every reference points to that copy.
+    If `stats` is given it is filled with `deduplicated` and `bytes_saved`.
+
     Returns (collected_images, dropped_vsdx_includes).
     """
     tex_dir = tex_path.parent
@@ -81,16 +93,20 @@ def release_collect_images_and_normalize(
     prefix = (image_alias or image_dir.name).strip("/\\")
     if not prefix:
         prefix = "image"
-    copied: dict[str, str] = {}
+    copied: dict[str, str] = {}  # source path -> name in image_dir
+    by_digest: dict[str, str] = {}  # content sha256 -> name in image_dir
+    used_names: set[str] = {p.name for p in image_dir.iterdir()}
     removed_vsdx = 0
+    deduplicated = 0
+    bytes_saved = 0
 
     def repl_func(match: re.Match) -> str:
-        nonlocal removed_vsdx
+        nonlocal removed_vsdx, deduplicated, bytes_saved
         cmd = match.group(1)
         opt = match.group(2) or ""
         inner = match.group(3)
         raw = inner
-        if Path(_unescape_tex_path(raw)).suffix.lower() == ".vsdx":
+        if Path(unescape_tex_path(raw)).suffix.lower() == ".vsdx":
             removed_vsdx += 1
             return ""  # remove the whole includegraphics command
         if raw.replace("\\", "/").startswith(f"{prefix}/"):
@@ -101,11 +117,16 @@ def release_collect_images_and_normalize(
         if src.suffix.lower() == ".vsdx":
             removed_vsdx += 1
             return ""
-        new_name = _ensure_unique(image_dir, src.name)
-        dst = image_dir / new_name
         if str(src) not in copied:
-            shutil.copy2(src, dst)
-            copied[str(src)] = new_name
+            digest = compute_sha256(src)
+            if digest in by_digest:
+                deduplicated += 1
+                bytes_saved += src.stat().st_size
+            else:
+                new_name = ensure_unique(used_names, src.name)
+                shutil.copy2(src, image_dir / new_name)
+                by_digest[digest] = new_name
+            copied[str(src)] = by_digest[digest]
         new_ref = f"{prefix}/{copied[str(src)]}"
         return f"{cmd}{opt}{{{new_ref}}}"
 
@@ -113,7 +134,10 @@ def release_collect_images_and_normalize(
     new_content = _normalize_width_options(new_content)
     if new_content != content:
         tex_path.write_text(new_content, encoding="utf-8")
-    return len(copied), removed_vsdx
+    if stats is not None:
+        stats["deduplicated"] = deduplicated
+        stats["bytes_saved"] = bytes_saved
+    return len(by_digest), removed_vsdx
 
 
 def debug_comment_vsdx_and_normalize(tex_path: Path) -> Tuple[int, int]:
@@ -161,8 +185,15 @@ def _detect_inkscape_cmd(inkscape_hint: Optional[str]) -> list[str]:
         return cmd + ["--batch-process"]
 
 
-def _convert_with_inkscape(inkscape_base: list[str], src: Path, dst: Path) -> bool:
-    import subprocess
+def _convert_with_inkscape(
+    inkscape_base: list[str],
+    src: Path,
+    dst: Path,
+    usage: Optional[dict] = None,
+    cancel: Optional[Callable[[], bool]] = None,
+    timeout: Optional[float] = None,
+) -> bool:
+    from .proc import merge_usage, run_subprocess
     dst.parent.mkdir(parents=True, exist_ok=True)
     try:
         if "--batch-process" in inkscape_base:
@@ -173,15 +204,27 @@ def _convert_with_inkscape(inkscape_base: list[str], src: Path, dst: Path) -> bo
             ]
         else:
             cmd = inkscape_base + ["-z", "-f", str(src), "-A", str(dst)]
-        cp = subprocess.run(cmd, capture_output=True, text=True)
-        return cp.returncode == 0
+        child: dict = {}
+        rc, _, _ = run_subprocess(cmd, timeout=timeout, usage=child, cancel=cancel)
+        if usage is not None and child:
+            merge_usage(usage, child)
+        return rc == 0
     except FileNotFoundError:
         return False
 
 
-def convert_vector_references(tex_path: Path, inkscape_hint: Optional[str] = None) -> Tuple[int, int, int]:
+def convert_vector_references(
+    tex_path: Path,
+    inkscape_hint: Optional[str] = None,
+    usage: Optional[dict] = None,
+    cancel: Optional[Callable[[], bool]] = None,
+    timeout: Optional[float] = None,
+) -> Tuple[int, int, int]:
     """Convert emf/wmf/svg references in TeX to PDF using Inkscape and update paths.
-    Returns (converted_count, missing_count, failed_count).
+    Returns (converted_count, missing_count, failed_count); `usage`, when given,
+    accumulates the Inkscape processes' resource usage. Once `cancel()`
+    returns true the running Inkscape is stopped and no further one started.
+    Each Inkscape run gets at most `timeout` seconds (None = no limit).
     """
     tex_path = tex_path.resolve()
     tex_dir = tex_path.parent
@@ -193,8 +236,10 @@ def convert_vector_references(tex_path: Path, inkscape_hint: Optional[str] = Non
     failed: int = 0
 
     for m in INCLUDE_RE.finditer(content):
+        if cancel is not None and cancel():
+            break
         raw_include = m.group(3)
-        unescaped = _unescape_tex_path(raw_include)
+        unescaped = unescape_tex_path(raw_include)
         ref_path = Path(unescaped)
         if not ref_path.is_absolute():
             ref_path = (tex_dir / ref_path).resolve()
@@ -213,7 +258,7 @@ def convert_vector_references(tex_path: Path, inkscape_hint: Optional[str] = Non
                 missing += 1
                 continue
             dst = src.with_suffix(".pdf")
-            ok = _convert_with_inkscape(inkscape_cmd_base, src, dst)
+            ok = _convert_with_inkscape(inkscape_cmd_base, src, dst, usage, cancel, timeout)
             if ok:
                 converted += 1
                 # Update reference to .pdf
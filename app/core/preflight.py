@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+
+_MIB = 1024 * 1024
+
+VECTOR_EXTS = frozenset({".emf", ".wmf", ".svg"})
+RASTER_EXTS = frozenset({".png", ".jpg", ".jpeg", ".jfif", ".gif", ".bmp", ".tif", ".tiff", ".webp", ".wdp"})
+
+# Markers counted in the scanned prefix of word/document.xml
+_TABLE_MARKERS = (b"<w:tbl>", b"<w:tbl ")
+_MATHTYPE_MARKER = b'ProgID="Equation.'
+
+
+class PreflightError(Exception):
+    """The DOCX must not be converted; `status_code` is the HTTP status to report."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+@dataclass(frozen=True)
+class PreflightLimits:
+    """Zip-bomb guards checked against the central directory.
+
+    An entry is rejected when its declared compression ratio exceeds
+    `max_ratio` (entries under 1 MiB are exempt); the archive when it has
+    more than `max_entries` entries, more than `max_uncompressed_bytes` in
+    total, or entries whose data ranges overlap. Only the first
+    `scan_bytes` of word/document.xml are inflated to count tables and
+    MathType objects; larger documents get extrapolated counts.
+    """
+
+    max_uncompressed_bytes: int = 2048 * _MIB
+    max_ratio: float = 200.0
+    max_entries: int = 20000
+    scan_bytes: int = 8 * _MIB
+
+
+@dataclass(frozen=True)
+class CostModel:
+    """Rough seconds per unit of work, used for scheduling and client hints."""
+
+    base_sec: float = 3.0
+    per_xml_mib_sec: float = 1.5
+    per_vector_sec: float = 1.0  # one Inkscape run each, only with img_post_proc
+    per_raster_mib_sec: float = 0.02
+    per_ole_sec: float = 0.3
+    per_table_sec: float = 0.05
+
+    def estimate(self, report: dict, img_post_proc: bool = True) -> float:
+        media = report.get("media", {})
+        sec = (
+            self.base_sec
+            + self.per_xml_mib_sec * report.get("document_xml_bytes", 0) / _MIB
+            + self.per_raster_mib_sec * media.get("raster", {}).get("bytes", 0) / _MIB
+            + self.per_ole_sec * report.get("ole_objects", 0)
+            + self.per_table_sec * report.get("tables", 0)
+        )
+        if img_post_proc:
+            sec += self.per_vector_sec * media.get("vector", {}).get("count", 0)
+        return round(sec, 1)
+
+
+def poll_interval_sec(estimate_sec: float) -> float:
+    """Suggested status poll interval: about a tenth of the estimate, 1-30 s."""
+    return round(min(30.0, max(1.0, estimate_sec / 10.0)), 1)
+
+
+def _check_overlap(infos: list[zipfile.ZipInfo]) -> None:
+    ordered = sorted(infos, key=lambda i: i.header_offset)
+    for a, b in zip(ordered, ordered[1:]):
+        if a.header_offset + a.compress_size > b.header_offset:
+            raise PreflightError(422, f"docx rejected: overlapping zip entries ({a.filename}, {b.filename})")
+
+
+def _scan_document(zf: zipfile.ZipFile, info: zipfile.ZipInfo, limit: int) -> tuple[int, int, bool]:
+    """Count table and MathType markers in the first `limit` bytes; (tables, mathtype, truncated)."""
+    keep = max(len(m) for m in _TABLE_MARKERS + (_MATHTYPE_MARKER,)) - 1
+    tables = mathtype = 0
+    scanned = 0
+    tail = b""
+    with zf.open(info) as f:
+        while scanned < limit:
+            chunk = f.read(min(256 * 1024, limit - scanned))
+            if not chunk:
+                break
+            scanned += len(chunk)
+            buf = tail + chunk
+            tables += sum(buf.count(m) for m in _TABLE_MARKERS)
+            mathtype += buf.count(_MATHTYPE_MARKER)
+            # Markers fully inside the carried-over tail were counted already
+            tail = buf[-keep:]
+            tables -= sum(tail.count(m) for m in _TABLE_MARKERS)
+            mathtype -= tail.count(_MATHTYPE_MARKER)
+    tables += sum(tail.count(m) for m in _TABLE_MARKERS)
+    mathtype += tail.count(_MATHTYPE_MARKER)
+    return tables, mathtype, scanned < info.file_size
+
+
+def analyze_docx(path: Path, limits: Optional[PreflightLimits] = None) -> dict:
+    """Cost-relevant figures of a DOCX, read mostly from its central directory.
+
+    Raises PreflightError for archives that look like zip bombs. Files that
+    are not ZIP archives are reported with `valid: false` and left for the
+    converter to fail on.
+    """
+    limits = limits or PreflightLimits()
+    try:
+        zf = zipfile.ZipFile(path)
+    except (zipfile.BadZipFile, OSError):
+        return {"valid": False}
+    with zf:
+        infos = [i for i in zf.infolist() if not i.is_dir()]
+        if len(infos) > limits.max_entries:
+            raise PreflightError(422, f"docx rejected: {len(infos)} zip entries (limit {limits.max_entries})")
+        total = sum(i.file_size for i in infos)
+        if total > limits.max_uncompressed_bytes:
+            raise PreflightError(413, f"docx rejected: {total} bytes uncompressed (limit {limits.max_uncompressed_bytes})")
+        for i in infos:
+            if i.file_size > _MIB and i.file_size > limits.max_ratio * max(1, i.compress_size):
+                raise PreflightError(422, f"docx rejected: compression ratio of {i.filename} exceeds {limits.max_ratio:g}")
+        _check_overlap(infos)
+
+        media: dict[str, dict] = {k: {"count": 0, "bytes": 0} for k in ("vector", "raster", "other")}
+        ole = 0
+        doc: Optional[zipfile.ZipInfo] = None
+        for i in infos:
+            name = i.filename
+            if name == "word/document.xml":
+                doc = i
+            elif name.startswith("word/media/"):
+                ext = Path(name).suffix.lower()
+                kind = "vector" if ext in VECTOR_EXTS else "raster" if ext in RASTER_EXTS else "other"
+                media[kind]["count"] += 1
+                media[kind]["bytes"] += i.file_size
+            elif name.startswith("word/embeddings/"):
+                ole += 1
+        report = {
+            "valid": doc is not None,
+            "entries": len(infos),
+            "uncompressed_bytes": total,
+            "document_xml_bytes": doc.file_size if doc else 0,
+            "media": media,
+            "ole_objects": ole,
+            "tables": 0,
+            "mathtype_objects": 0,
+        }
+        if doc is not None and limits.scan_bytes > 0:
+            try:
+                tables, mathtype, truncated = _scan_document(zf, doc, limits.scan_bytes)
+            except (zipfile.BadZipFile, OSError, EOFError, RuntimeError) as e:
+                raise PreflightError(422, f"docx rejected: unreadable word/document.xml ({e})")
+            if truncated:
+                scale = doc.file_size / limits.scan_bytes
+                tables, mathtype = int(tables * scale), int(mathtype * scale)
+            report.update(tables=tables, mathtype_objects=mathtype, counts_estimated=truncated)
+        return report
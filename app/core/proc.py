@@ -1,22 +1,184 @@
 from __future__ import annotations
 
+import io
+import os
+import signal
+import threading
+import time
+from collections import deque
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
 import requests
 
 
-def run_subprocess(cmd: list[str], cwd: Optional[Path] = None, env: Optional[dict] = None, timeout: int = 600) -> tuple[int, str, str]:
+_READ_CHUNK = 64 * 1024
+
+
+def _rusage_dict(ru) -> dict:
+    """Resource usage of one reaped child (Linux: ru_maxrss in KiB, blocks of 512 bytes)."""
+    return {
+        "cpu_user_sec": round(ru.ru_utime, 3),
+        "cpu_sys_sec": round(ru.ru_stime, 3),
+        "max_rss_kb": int(ru.ru_maxrss),
+        "io_read_blocks": int(ru.ru_inblock),
+        "io_write_blocks": int(ru.ru_oublock),
+    }
+
+
+def merge_usage(total: dict, usage: dict) -> dict:
+    """Accumulate `usage` into `total` (CPU and I/O summed, RSS as the peak)."""
+    for k, v in usage.items():
+        if k == "max_rss_kb":
+            total[k] = max(total.get(k, 0), v)
+        else:
+            total[k] = round(total.get(k, 0) + v, 3)
+    return total
+
+
+def _wait4(proc, timeout: Optional[float], cancel: Optional[Callable[[], bool]] = None):
+    """Reap `proc` with wait4 so its rusage is not lost.
+
+    Returns the rusage, or None when `timeout` passed or `cancel()` returned
+    true before the child exited.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.005
+    while True:
+        pid, status, ru = os.wait4(proc.pid, os.WNOHANG)
+        if pid == proc.pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return ru
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        if cancel is not None and cancel():
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+
+def _signal_group(proc, sig: int) -> None:
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _stop_group(proc, grace_sec: float):
+    """SIGTERM the child's process group, SIGKILL it after `grace_sec`; returns the child's rusage.
+
+    The child leads its own session (see run_subprocess), so the group also
+    holds whatever it started, e.g. the JVM behind calabash.sh.
+    """
+    _signal_group(proc, signal.SIGTERM)
+    ru = _wait4(proc, grace_sec)
+    # Also reached when the leader exited on SIGTERM: nothing it started may outlive it
+    _signal_group(proc, signal.SIGKILL)
+    if ru is None:
+        ru = _wait4(proc, None)
+    return ru
+
+
+class _Tail:
+    """Keeps the last `limit` bytes written to it."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._chunks: deque[bytes] = deque()
+        self._size = 0
+
+    def write(self, data: bytes) -> None:
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._chunks and self._size - len(self._chunks[0]) >= self.limit:
+            self._size -= len(self._chunks.popleft())
+
+    def text(self) -> str:
+        data = b"".join(self._chunks)
+        return data[-self.limit :].decode("utf-8", errors="replace") if self.limit else ""
+
+
+def run_subprocess(
+    cmd: list[str],
+    cwd: Optional[Path] = None,
+    env: Optional[dict] = None,
+    timeout: int = 600,
+    usage: Optional[dict] = None,
+    log_path: Optional[Path] = None,
+    tail_bytes: int = 64 * 1024,
+    cancel: Optional[Callable[[], bool]] = None,
+    kill_grace_sec: float = 5.0,
+) -> tuple[int, str, str]:
+    """Run `cmd` and return (rc, stdout, stderr); rc 124 means it timed out.
+
+    Without `log_path` the complete output is returned. With it, stdout and
+    stderr are appended to that file as they arrive (so the log can be
+    tailed while the child runs) and only the last `tail_bytes` of each are
+    kept in memory for the return value.
+
+    When `usage` is given it is filled with the child's CPU time, peak RSS
+    and block I/O, taken from wait4 when the child is reaped.
+
+    The child runs in its own process group. On timeout, or as soon as
+    `cancel()` (polled while waiting) returns true, the whole group gets
+    SIGTERM and, `kill_grace_sec` later, SIGKILL; a cancelled run returns
+    the child's (negative, signal) exit code.
+    """
     import subprocess
 
-    proc = subprocess.Popen(cmd, cwd=str(cwd) if cwd else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env)
+    proc = subprocess.Popen(
+        cmd,
+        cwd=str(cwd) if cwd else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+        start_new_session=True,
+    )
+    log = open(log_path, "ab") if log_path is not None else None
+    log_lock = threading.Lock()
+    sinks = {name: (_Tail(tail_bytes) if log is not None else io.BytesIO()) for name in ("out", "err")}
+
+    def drain(name: str, stream) -> None:
+        fd = stream.fileno()
+        while True:
+            data = os.read(fd, _READ_CHUNK)
+            if not data:
+                break
+            sinks[name].write(data)
+            if log is not None:
+                with log_lock:
+                    log.write(data)
+                    log.flush()
+        stream.close()
+
+    readers = [
+        threading.Thread(target=drain, args=("out", proc.stdout), daemon=True),
+        threading.Thread(target=drain, args=("err", proc.stderr), daemon=True),
+    ]
+    for t in readers:
+        t.start()
     try:
-        out, err = proc.communicate(timeout=timeout)
-        return proc.returncode, out, err
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        out, err = proc.communicate()
-        return 124, out, err
+        try:
+            ru = _wait4(proc, timeout, cancel)
+        except ChildProcessError:
+            # Reaped elsewhere (e.g. SIGCHLD ignored); no rusage available
+            ru = None
+            proc.wait()
+        rc = proc.returncode
+        if ru is None and rc is None:
+            cancelled = cancel is not None and cancel()
+            ru = _stop_group(proc, kill_grace_sec)
+            rc = proc.returncode if cancelled else 124
+        for t in readers:
+            t.join()
+    finally:
+        if log is not None:
+            log.close()
+    if usage is not None and ru is not None:
+        usage.update(_rusage_dict(ru))
+    if log is not None:
+        return rc, sinks["out"].text(), sinks["err"].text()
+    return rc, *(sinks[n].getvalue().decode("utf-8", errors="replace") for n in ("out", "err"))
 
 
 def download_to(path: Path, url: str):
@@ -25,4 +187,3 @@ def download_to(path: Path, url: str):
     path.parent.mkdir(parents=True, exist_ok=True)
     with open(path, "wb") as f:
         f.write(r.content)
-
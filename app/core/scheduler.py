@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import threading
+from typing import Any, Callable, Optional
+
+
+class _Entry:
+    __slots__ = ("key", "seq", "fn", "args", "cancelled")
+
+    def __init__(self, key: float, seq: int, fn: Callable, args: tuple):
+        self.key = key
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other: "_Entry") -> bool:
+        return (self.key, self.seq) < (other.key, other.seq)
+
+
+class PriorityPool:
+    """Fixed set of worker threads running the queued call with the lowest key.
+
+    Keys are fixed at submit time. Callers that want aging fold the submit
+    time into the key (`cost + aging * submitted_at`): a job then overtakes
+    every later job whose cost is lower by less than `aging` times the extra
+    wait, so large jobs cannot be starved. Equal keys run in submit order.
+    """
+
+    def __init__(self, workers: int, name: str = "jobs"):
+        self._heap: list[_Entry] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True) for i in range(max(1, workers))
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key: float, fn: Callable, *args: Any) -> _Entry:
+        entry = _Entry(key, next(self._seq), fn, args)
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            self._pending += 1
+            self._cond.notify()
+        return entry
+
+    def cancel(self, entry: _Entry) -> bool:
+        """Drop a queued call; False when it already started."""
+        with self._cond:
+            if entry.cancelled or entry not in self._heap:
+                return False
+            entry.cancelled = True
+            self._pending -= 1
+            return True
+
+    def position(self, entry: _Entry) -> Optional[int]:
+        """1-based place of a queued call in run order; None once it started."""
+        with self._cond:
+            if entry.cancelled or entry not in self._heap:
+                return None
+            return 1 + sum(1 for e in self._heap if not e.cancelled and e < entry)
+
+    def pending(self) -> int:
+        with self._cond:
+            return self._pending
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    while not self._heap:
+                        self._cond.wait()
+                    entry = heapq.heappop(self._heap)
+                    if not entry.cancelled:
+                        self._pending -= 1
+                        break
+            try:
+                entry.fn(*entry.args)
+            except Exception:
+                pass
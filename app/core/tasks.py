@@ -1,21 +1,168 @@
 from __future__ import annotations
 
+import atexit
+import json
+import sqlite3
+import threading
 import time
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from typing import Optional
 
 from .db import Database
 from .models import JobState
 
 
+TERMINAL_STATES = ("done", "failed", "cancelled", "expired")
+# Terminal states set from outside the job (DELETE /v1/task/{id}); state
+# writes the job makes afterwards are ignored.
+FINAL_STATES = ("cancelled",)
+_FINAL_SQL = ",".join(f"'{s}'" for s in FINAL_STATES)
+
+
+class StatusCache:
+    """Process-local LRU of recent JobStates (and their stages) for status polling.
+
+    Writes made through TaskStore in this process update entries in place.
+    Every committed status change is also appended to `task_changes` (by
+    triggers, so writes from any process count). When `PRAGMA data_version`
+    on a dedicated read-only connection shows that some other connection
+    committed, the changes since the last check are read and only the tasks
+    they name are dropped. The check runs at most once per
+    `check_interval_sec`, which bounds staleness for cross-worker updates.
+    """
+
+    def __init__(self, db: Database, max_entries: int = 4096, check_interval_sec: float = 0.25):
+        self.db = db
+        self.max_entries = max_entries
+        self.check_interval_sec = check_interval_sec
+        self._entries: "OrderedDict[str, JobState]" = OrderedDict()
+        # Stage timelines of cached entries only; dropped together with them
+        self._stages: dict[str, list[dict]] = {}
+        self._lock = threading.Lock()
+        self._watch: Optional[sqlite3.Connection] = None
+        self._data_version: Optional[int] = None
+        self._rev: Optional[int] = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _validate_locked(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval_sec:
+            return
+        self._checked_at = now
+        try:
+            if self._watch is None:
+                self._watch = self.db._open()
+            version = int(self._watch.execute("PRAGMA data_version").fetchone()[0])
+            if version == self._data_version:
+                return
+            if self._rev is None:
+                changes = None
+                rev = int(self._watch.execute("SELECT COALESCE(MAX(rev), 0) FROM task_changes").fetchone()[0])
+            else:
+                changes = self._watch.execute(
+                    "SELECT rev, task_id FROM task_changes WHERE rev > ? ORDER BY rev", (self._rev,)
+                ).fetchall()
+                rev = changes[-1]["rev"] if changes else self._rev
+        except Exception:
+            self._clear_locked()
+            self._watch = None
+            self._data_version = self._rev = None
+            return
+        if changes is None or (changes and changes[0]["rev"] != self._rev + 1):
+            # First check, or the changes we had not seen yet were pruned
+            self._clear_locked()
+        else:
+            for row in changes:
+                self._drop_locked(row["task_id"])
+        self._data_version = version
+        self._rev = rev
+
+    def _clear_locked(self) -> None:
+        self._entries.clear()
+        self._stages.clear()
+
+    def _drop_locked(self, task_id: str) -> None:
+        self._entries.pop(task_id, None)
+        self._stages.pop(task_id, None)
+
+    def get(self, task_id: str) -> Optional[JobState]:
+        with self._lock:
+            self._validate_locked()
+            js = self._entries.get(task_id)
+            if js is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(task_id)
+            self.hits += 1
+            return js.model_copy()
+
+    def put(self, js: JobState) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[js.task_id] = js.model_copy()
+            self._entries.move_to_end(js.task_id)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._stages.pop(evicted, None)
+
+    def update(self, task_id: str, cols: dict) -> None:
+        with self._lock:
+            js = self._entries.get(task_id)
+            if js is None:
+                return
+            if "state" in cols and js.state in FINAL_STATES:
+                return
+            for k, v in cols.items():
+                setattr(js, k, v)
+
+    def invalidate(self, task_id: str) -> None:
+        with self._lock:
+            self._drop_locked(task_id)
+
+    def get_stages(self, task_id: str) -> Optional[list[dict]]:
+        with self._lock:
+            self._validate_locked()
+            stages = self._stages.get(task_id)
+            return [dict(s) for s in stages] if stages is not None else None
+
+    def put_stages(self, task_id: str, stages: list[dict]) -> None:
+        with self._lock:
+            if task_id in self._entries:
+                self._stages[task_id] = [dict(s) for s in stages]
+
+    def add_stage(self, task_id: str, item: dict) -> None:
+        with self._lock:
+            stages = self._stages.get(task_id)
+            if stages is not None:
+                stages.append(dict(item))
+                stages.sort(key=lambda s: s["started"])
+
+
 @dataclass
 class TaskStore:
     db: Database
+    # Write-behind: when > 0, non-terminal state updates and stage records are
+    # coalesced in memory and flushed in one transaction every `write_behind_sec`
+    # seconds. Terminal states flush immediately; `get` and `stages` overlay
+    # pending writes (read-your-writes).
+    write_behind_sec: float = 0.0
+    # Optional process-local cache consulted by get() and updated write-through
+    status_cache: Optional[StatusCache] = None
+    _pending: dict = field(default_factory=dict, init=False, repr=False)
+    _pending_stages: list = field(default_factory=list, init=False, repr=False)
+    _pending_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _flush_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _flusher: Optional[threading.Thread] = field(default=None, init=False, repr=False)
 
     def insert(self, js: JobState) -> None:
         with self.db.connect() as con:
             con.execute(
-                "INSERT INTO tasks(task_id,state,err_msg,start_time,end_time,debug,img_post_proc,work_dir,created,sha256) VALUES(?,?,?,?,?,?,?,?,?,?)",
+                "INSERT INTO tasks(task_id,state,err_msg,start_time,end_time,debug,img_post_proc,work_dir,created,sha256,batch_id,deadline)"
+                " VALUES(?,?,?,?,?,?,?,?,?,?,?,?)",
                 (
                     js.task_id,
                     js.state,
@@ -27,38 +174,309 @@ class TaskStore:
                     js.work_dir,
                     time.time(),
                     js.sha256,
+                    js.batch_id,
+                    js.deadline,
                 ),
             )
             con.commit()
 
     def get(self, task_id: str) -> JobState:
+        if self.status_cache is not None:
+            cached = self.status_cache.get(task_id)
+            if cached is not None:
+                return cached
+        with self._pending_lock:
+            has_pending = task_id in self._pending
+        if not has_pending:
+            js = self._read(task_id)
+        else:
+            # Hold off flushes so the DB row plus overlay is a consistent snapshot
+            with self._flush_lock:
+                js = self._read(task_id)
+                with self._pending_lock:
+                    pending = dict(self._pending.get(task_id) or {})
+            if js.state not in FINAL_STATES:
+                for k, v in pending.items():
+                    setattr(js, k, v)
+        if self.status_cache is not None:
+            self.status_cache.put(js)
+        return js
+
+    def _read(self, task_id: str) -> JobState:
         with self.db.connect() as con:
             cur = con.execute("SELECT * FROM tasks WHERE task_id=?", (task_id,))
             row = cur.fetchone()
             if not row:
                 raise KeyError(task_id)
-            return JobState(
-                task_id=row["task_id"],
-                state=row["state"],
-                err_msg=row["err_msg"] or "",
-                start_time=row["start_time"],
-                end_time=row["end_time"],
-                debug=bool(row["debug"]),
-                img_post_proc=bool(row["img_post_proc"]),
-                work_dir=row["work_dir"],
-            )
+            return self._from_row(row)
+
+    @staticmethod
+    def _from_row(row: sqlite3.Row) -> JobState:
+        return JobState(
+            task_id=row["task_id"],
+            state=row["state"],
+            err_msg=row["err_msg"] or "",
+            start_time=row["start_time"],
+            end_time=row["end_time"],
+            debug=bool(row["debug"]),
+            img_post_proc=bool(row["img_post_proc"]),
+            work_dir=row["work_dir"],
+            sha256=row["sha256"],
+            result_path=row["result_path"],
+            result_sha256=row["result_sha256"],
+            result_size=row["result_size"],
+            result_mode=row["result_mode"],
+            batch_id=row["batch_id"],
+            est_seconds=row["est_seconds"],
+            deadline=row["deadline"],
+            document_xml_bytes=row["document_xml_bytes"],
+            media_bytes=row["media_bytes"],
+        )
+
+    def list_batch(self, batch_id: str) -> list[JobState]:
+        """All tasks of a batch in submission order (served by idx_tasks_batch)."""
+        if self.write_behind_sec > 0:
+            self.flush()
+        with self.db.connect() as con:
+            cur = con.execute("SELECT * FROM tasks WHERE batch_id=? ORDER BY created, rowid", (batch_id,))
+            return [self._from_row(row) for row in cur.fetchall()]
 
     def set_state(self, task_id: str, state: str, err: str = "") -> None:
+        end_time = time.time() if state in TERMINAL_STATES else None
+        cols: dict = {"state": state, "err_msg": err}
+        if end_time is not None:
+            cols["end_time"] = end_time
+        if self.status_cache is not None:
+            self.status_cache.update(task_id, cols)
+        if self.write_behind_sec > 0:
+            self._queue(task_id, cols)
+            if end_time is not None:
+                self.flush()
+            return
         with self.db.connect() as con:
-            end_time = time.time() if state in ("done", "failed") else None
             if end_time is None:
-                con.execute("UPDATE tasks SET state=?, err_msg=? WHERE task_id=?", (state, err, task_id))
+                con.execute(
+                    f"UPDATE tasks SET state=?, err_msg=? WHERE task_id=? AND state NOT IN ({_FINAL_SQL})",
+                    (state, err, task_id),
+                )
             else:
-                con.execute("UPDATE tasks SET state=?, err_msg=?, end_time=? WHERE task_id=?", (state, err, end_time, task_id))
+                con.execute(
+                    f"UPDATE tasks SET state=?, err_msg=?, end_time=? WHERE task_id=? AND state NOT IN ({_FINAL_SQL})",
+                    (state, err, end_time, task_id),
+                )
             con.commit()
 
+    def finish_if_active(self, task_id: str, state: str, err: str = "") -> bool:
+        """Move a task that has not ended into terminal `state`; False when it already ended."""
+        if self.write_behind_sec > 0:
+            self.flush()
+        marks = ",".join("?" for _ in TERMINAL_STATES)
+        end_time = time.time()
+        with self.db.connect() as con:
+            cur = con.execute(
+                f"UPDATE tasks SET state=?, err_msg=?, end_time=?, queue_key=NULL WHERE task_id=? AND state NOT IN ({marks})",
+                (state, err, end_time, task_id, *TERMINAL_STATES),
+            )
+            con.commit()
+            changed = cur.rowcount == 1
+        if changed and self.status_cache is not None:
+            self.status_cache.update(task_id, {"state": state, "err_msg": err, "end_time": end_time})
+        return changed
+
     def set_sha256(self, task_id: str, sha: str) -> None:
         with self.db.connect() as con:
             con.execute("UPDATE tasks SET sha256=? WHERE task_id=?", (sha, task_id))
             con.commit()
 
+    def set_estimate(
+        self,
+        task_id: str,
+        seconds: float,
+        document_xml_bytes: Optional[int] = None,
+        media_bytes: Optional[int] = None,
+    ) -> None:
+        """Record the pre-flight estimate together with the size figures it was based on."""
+        cols = {"est_seconds": seconds, "document_xml_bytes": document_xml_bytes, "media_bytes": media_bytes}
+        if self.status_cache is not None:
+            self.status_cache.update(task_id, cols)
+        with self.db.connect() as con:
+            con.execute(
+                "UPDATE tasks SET est_seconds=?, document_xml_bytes=?, media_bytes=? WHERE task_id=?",
+                (seconds, document_xml_bytes, media_bytes, task_id),
+            )
+            con.commit()
+
+    def set_queue_key(self, task_id: str, key: Optional[float], input_bytes: Optional[int] = None) -> None:
+        with self.db.connect() as con:
+            if input_bytes is None:
+                con.execute("UPDATE tasks SET queue_key=? WHERE task_id=?", (key, task_id))
+            else:
+                con.execute("UPDATE tasks SET queue_key=?, input_bytes=? WHERE task_id=?", (key, input_bytes, task_id))
+            con.commit()
+
+    def queue_totals(self) -> tuple[int, int]:
+        """(tasks, input bytes) waiting in the queues of all workers."""
+        with self.db.connect() as con:
+            row = con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(input_bytes), 0) FROM tasks WHERE queue_key IS NOT NULL AND state='pending'"
+            ).fetchone()
+        return int(row[0]), int(row[1])
+
+    def finished_since(self, since: float) -> tuple[int, int]:
+        """(tasks, input bytes) of submitted jobs that ended after `since` (served by idx_tasks_state_end)."""
+        if self.write_behind_sec > 0:
+            self.flush()
+        with self.db.connect() as con:
+            row = con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(input_bytes), 0) FROM tasks"
+                " WHERE state IN ('done','failed') AND end_time >= ? AND input_bytes IS NOT NULL",
+                (since,),
+            ).fetchone()
+        return int(row[0]), int(row[1])
+
+    def queue_ranks(self) -> dict[str, int]:
+        """1-based rank by queue_key of every queued task (served by idx_tasks_queue_key)."""
+        with self.db.connect() as con:
+            cur = con.execute(
+                "SELECT task_id FROM tasks WHERE queue_key IS NOT NULL AND state='pending' ORDER BY queue_key, rowid"
+            )
+            return {row["task_id"]: i for i, row in enumerate(cur.fetchall(), 1)}
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """1-based rank by queue_key among pending tasks; None when not queued."""
+        return self.queue_ranks().get(task_id)
+
+    def set_result(self, task_id: str, path: str, sha: str, size: int, mode: str = "zip") -> None:
+        """Record the packaged result so downloads need no filesystem lookup."""
+        cols = {"result_path": path, "result_sha256": sha, "result_size": size, "result_mode": mode}
+        if self.status_cache is not None:
+            self.status_cache.update(task_id, cols)
+        with self.db.connect() as con:
+            con.execute(
+                "UPDATE tasks SET result_path=?, result_sha256=?, result_size=?, result_mode=? WHERE task_id=?",
+                (path, sha, size, mode, task_id),
+            )
+            con.commit()
+
+    # --- Stage timeline ---
+    def add_stage(self, task_id: str, stage: str, started: float, duration: float, detail: Optional[dict] = None) -> None:
+        row = (task_id, stage, started, duration, json.dumps(detail, ensure_ascii=False) if detail else None)
+        if self.status_cache is not None:
+            self.status_cache.add_stage(task_id, _stage_item(row[1:]))
+        if self.write_behind_sec > 0:
+            with self._pending_lock:
+                self._pending_stages.append(row)
+                self._start_flusher_locked()
+            return
+        with self.db.connect() as con:
+            con.execute("INSERT INTO task_stages(task_id,stage,started,duration,detail) VALUES(?,?,?,?,?)", row)
+            con.commit()
+
+    def stages(self, task_id: str) -> list[dict]:
+        """Recorded stages in start order (served by idx_task_stages_task)."""
+        if self.status_cache is not None:
+            cached = self.status_cache.get_stages(task_id)
+            if cached is not None:
+                return cached
+        # Hold off flushes so the table plus pending records is a consistent snapshot
+        with self._flush_lock:
+            with self.db.connect() as con:
+                cur = con.execute(
+                    "SELECT stage, started, duration, detail FROM task_stages WHERE task_id=? ORDER BY started, rowid",
+                    (task_id,),
+                )
+                rows = [tuple(r) for r in cur.fetchall()]
+            with self._pending_lock:
+                pending = [r[1:] for r in self._pending_stages if r[0] == task_id]
+        out = [_stage_item(r) for r in rows]
+        if pending:
+            out = sorted(out + [_stage_item(r) for r in pending], key=lambda s: s["started"])
+        if self.status_cache is not None:
+            self.status_cache.put_stages(task_id, out)
+        return out
+
+    def recent_stage_details(self, stage: str, limit: int = 200) -> list[dict]:
+        """Detail dicts of the latest `limit` records of `stage`, newest first."""
+        if self.write_behind_sec > 0:
+            self.flush()
+        with self.db.connect() as con:
+            cur = con.execute(
+                "SELECT detail FROM task_stages WHERE stage=? AND detail IS NOT NULL ORDER BY started DESC LIMIT ?",
+                (stage, limit),
+            )
+            rows = cur.fetchall()
+        out = []
+        for row in rows:
+            try:
+                out.append(json.loads(row["detail"]))
+            except ValueError:
+                pass
+        return out
+
+    # --- Write-behind ---
+    def _queue(self, task_id: str, cols: dict) -> None:
+        with self._pending_lock:
+            self._pending.setdefault(task_id, {}).update(cols)
+            self._start_flusher_locked()
+
+    def _start_flusher_locked(self) -> None:
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="task-write-behind", daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(max(0.01, self.write_behind_sec))
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def flush(self) -> int:
+        """Write all pending updates and stages in a single transaction; returns rows written."""
+        with self._flush_lock:
+            return self._flush_locked()
+
+    def _flush_locked(self) -> int:
+        with self._pending_lock:
+            if not self._pending and not self._pending_stages:
+                return 0
+            batch, self._pending = self._pending, {}
+            stages, self._pending_stages = self._pending_stages, []
+        try:
+            with self.db.connect() as con:
+                for task_id, cols in batch.items():
+                    names = sorted(cols)
+                    assignments = ", ".join(f"{n}=?" for n in names)
+                    con.execute(
+                        f"UPDATE tasks SET {assignments} WHERE task_id=? AND state NOT IN ({_FINAL_SQL})",
+                        [cols[n] for n in names] + [task_id],
+                    )
+                if stages:
+                    con.executemany(
+                        "INSERT INTO task_stages(task_id,stage,started,duration,detail) VALUES(?,?,?,?,?)", stages
+                    )
+                con.commit()
+        except Exception:
+            # Put the batch back underneath anything queued meanwhile
+            with self._pending_lock:
+                for task_id, cols in batch.items():
+                    merged = dict(cols)
+                    merged.update(self._pending.get(task_id, {}))
+                    self._pending[task_id] = merged
+                self._pending_stages[:0] = stages
+            raise
+        return len(batch) + len(stages)
+
+
+def _stage_item(row: tuple) -> dict:
+    """API form of a (stage, started, duration, detail_json) record."""
+    stage, started, duration, detail = row
+    item = {"stage": stage, "started": started, "duration": round(duration, 6)}
+    if detail:
+        try:
+            item["detail"] = json.loads(detail)
+        except ValueError:
+            pass
+    return item
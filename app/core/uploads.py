@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from .storage import atomic_write_json
+
+
+SESSION_FILE = "session.json"
+DATA_FILE = "data"
+_CHUNK = 1024 * 1024
+
+
+class UploadError(Exception):
+    """Upload protocol violation; `status_code` is the HTTP status to report."""
+
+    def __init__(self, status_code: int, detail: str, offset: Optional[int] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.offset = offset
+
+
+class UploadStore:
+    """Resumable upload sessions under DATA_ROOT/uploads/<upload_id>.
+
+    The bytes received so far live in `data`; its size is the resume offset,
+    so a session survives restarts and can be continued from any worker.
+    The SHA-256 is computed incrementally while all chunks land in one
+    process; once a chunk goes to a process that has not seen the session,
+    the digest is computed in a single pass at finalize instead.
+    Finalizing seals the session (`sha256` in session.json, written under
+    the data file's flock), after which PUTs are refused.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._hashers: dict[str, tuple[int, "hashlib._Hash"]] = {}
+        self._lock = threading.Lock()
+
+    def _dir(self, upload_id: str) -> Path:
+        try:
+            uuid.UUID(upload_id)
+        except ValueError:
+            raise UploadError(404, "upload not found")
+        return self.root / upload_id
+
+    def create(self, filename: str, size: Optional[int] = None) -> dict:
+        if size is not None and size < 0:
+            raise UploadError(400, "size must be >= 0")
+        if size is not None and self.max_bytes and size > self.max_bytes:
+            raise UploadError(413, "upload exceeds size limit")
+        upload_id = str(uuid.uuid4())
+        d = self.root / upload_id
+        d.mkdir(parents=True, exist_ok=True)
+        (d / DATA_FILE).touch()
+        meta = {"upload_id": upload_id, "filename": filename, "size": size, "created": time.time()}
+        atomic_write_json(d / SESSION_FILE, meta)
+        return {**meta, "offset": 0}
+
+    def get(self, upload_id: str) -> dict:
+        d = self._dir(upload_id)
+        try:
+            meta = json.loads((d / SESSION_FILE).read_text(encoding="utf-8"))
+            # A sealed session's data may already have moved to the input store
+            offset = meta["offset"] if meta.get("sha256") else (d / DATA_FILE).stat().st_size
+        except (FileNotFoundError, ValueError):
+            raise UploadError(404, "upload not found")
+        return {**meta, "offset": offset}
+
+    def _limit(self, meta: dict) -> int:
+        limits = [n for n in (meta.get("size"), self.max_bytes or None) if n is not None]
+        return min(limits) if limits else 0
+
+    def open_append(self, upload_id: str, offset: int) -> "_Appender":
+        """Writer for the bytes of one PUT at `offset` (must equal the current size).
+
+        Use as a context manager: a rejected request (over the limit) is rolled
+        back to `offset`; bytes written before a dropped connection are kept so
+        the client can resume after them.
+        """
+        meta = self.get(upload_id)
+        if meta.get("sha256"):
+            raise UploadError(409, "upload already finalized", offset=meta["offset"])
+        return _Appender(self, upload_id, self._dir(upload_id) / DATA_FILE, offset, self._limit(meta))
+
+    def _cached_hasher(self, upload_id: str, offset: int):
+        """This process's digest state if it covers exactly `offset` bytes, else None."""
+        with self._lock:
+            cached = self._hashers.pop(upload_id, None)
+        if cached is not None and cached[0] == offset:
+            return cached[1]
+        return hashlib.sha256() if offset == 0 else None
+
+    def finish(self, upload_id: str, expected_sha256: Optional[str] = None) -> tuple[Optional[Path], str, dict]:
+        """Seal a complete upload; returns (data path, sha256, session meta).
+
+        Holds the data file's flock, so a PUT in progress makes this a 409
+        and PUTs after it are refused. Finishing a sealed session again
+        returns the same digest; the data path is None once the caller has
+        moved the data away. The caller calls `discard` when it no longer
+        needs the session.
+        """
+        d = self._dir(upload_id)
+        path = d / DATA_FILE
+        meta = self.get(upload_id)
+        if not meta.get("sha256"):
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                raise UploadError(404, "upload not found")
+            with f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    raise UploadError(409, "another chunk is being written to this upload")
+                meta = self.get(upload_id)
+                if not meta.get("sha256"):
+                    if meta.get("size") is not None and meta["offset"] != meta["size"]:
+                        raise UploadError(409, "upload incomplete", offset=meta["offset"])
+                    h = self._cached_hasher(upload_id, meta["offset"])
+                    if h is None:
+                        h = hashlib.sha256()
+                        for chunk in iter(lambda: f.read(_CHUNK), b""):
+                            h.update(chunk)
+                    meta["sha256"] = h.hexdigest()
+                    atomic_write_json(d / SESSION_FILE, meta)
+        sha = meta["sha256"]
+        if expected_sha256 and expected_sha256.strip().lower() != sha:
+            raise UploadError(422, "sha256 mismatch")
+        return (path if path.exists() else None), sha, meta
+
+    def discard(self, upload_id: str) -> None:
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+
+    def cleanup(self, max_age_sec: int) -> int:
+        """Remove sessions without activity for `max_age_sec`; returns the count."""
+        if max_age_sec <= 0 or not self.root.exists():
+            return 0
+        cutoff = time.time() - max_age_sec
+        removed = 0
+        for d in self.root.iterdir():
+            try:
+                data = d / DATA_FILE
+                last = data.stat().st_mtime if data.exists() else d.stat().st_mtime
+                if last < cutoff:
+                    shutil.rmtree(d, ignore_errors=True)
+                    with self._lock:
+                        self._hashers.pop(d.name, None)
+                    removed += 1
+            except Exception:
+                pass
+        return removed
+
+
+class _Appender:
+    def __init__(self, store: UploadStore, upload_id: str, path: Path, offset: int, limit: int):
+        self.store = store
+        self.upload_id = upload_id
+        self.path = path
+        self.start = offset
+        self.limit = limit
+        self.pos = offset
+        self._f = None
+        self._hasher = None
+
+    def __enter__(self) -> "_Appender":
+        try:
+            f = open(self.path, "r+b")
+        except FileNotFoundError:
+            raise UploadError(409, "upload already finalized")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            raise UploadError(409, "another chunk is being written to this upload")
+        # finish() seals the session under the same flock
+        meta = self.store.get(self.upload_id)
+        if meta.get("sha256"):
+            f.close()
+            raise UploadError(409, "upload already finalized", offset=meta["offset"])
+        current = os.fstat(f.fileno()).st_size
+        if self.start != current:
+            f.close()
+            raise UploadError(409, "offset mismatch", offset=current)
+        self._hasher = self.store._cached_hasher(self.upload_id, current)
+        f.seek(current)
+        self._f = f
+        return self
+
+    def write(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        if self.limit and self.pos + len(chunk) > self.limit:
+            raise UploadError(413, "upload exceeds size limit", offset=self.start)
+        self._f.write(chunk)
+        if self._hasher is not None:
+            self._hasher.update(chunk)
+        self.pos += len(chunk)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        f = self._f
+        try:
+            if isinstance(exc, UploadError):
+                f.truncate(self.start)
+                self.pos = self.start
+                self._hasher = None
+            f.flush()
+        finally:
+            f.close()  # releases the flock
+        with self.store._lock:
+            if self._hasher is not None:
+                self.store._hashers[self.upload_id] = (self.pos, self._hasher)
+            else:
+                self.store._hashers.pop(self.upload_id, None)
@@ -6,11 +6,22 @@ export WORK_ROOT="${WORK_ROOT:-/work}"
 export LOG_DIR="${LOG_DIR:-/var/log/docx2tex}"
 export DOCX2TEX_HOME="${DOCX2TEX_HOME:-/opt/docx2tex}"
 
+export METRICS_DIR="${METRICS_DIR:-${DATA_ROOT:-/data}/metrics}"
+
 mkdir -p "$WORK_ROOT" "$LOG_DIR"
+# Metric snapshots of a previous container run would be merged into /metrics.
+# Only the snapshot files are removed: METRICS_DIR may point at a shared directory.
+if [ -d "$METRICS_DIR" ]; then
+  find "$METRICS_DIR" -maxdepth 1 -type f \( -name '*.json' -o -name '*.json.tmp' \) -delete
+fi
 
 echo "[entrypoint] APP_HOME=$APP_HOME WORK_ROOT=$WORK_ROOT LOG_DIR=$LOG_DIR DOCX2TEX_HOME=$DOCX2TEX_HOME"
 
 UVICORN_BIN="/opt/venv/bin/uvicorn"
+PYTHON_BIN="/opt/venv/bin/python"
+[ -x "$PYTHON_BIN" ] || PYTHON_BIN="python3"
+# Jobs queued or running in the previous run are gone; fail them so they do not count against QUEUE_MAX_JOBS
+"$PYTHON_BIN" -m app.core.cleanup || echo "[entrypoint] interrupted task sweep failed"
 APP_IMPORT="app.server:app"  # use package import path
 # Default to 2 workers now that job state is file-backed
 WORKERS="${UVICORN_WORKERS:-2}"
@@ -5,6 +5,7 @@ from typing import Optional
 
 from fastapi import FastAPI
 
+from app.core import metrics
 from app.core.config import get_config
 from app.core.db import Database
 from app.core.cache import CacheStore, LockManager
@@ -34,5 +35,8 @@ def on_startup():
     retention: Optional[int] = _CFG.ttl_days
     start_cleanup_loop(_CFG, _DB_CORE, _CACHE_CORE, retention, retention)
 
+    # Per-worker metric snapshots, merged by GET /metrics
+    metrics.REGISTRY.start_flusher(_CFG.metrics_dir, _CFG.metrics_flush_sec)
+
     # Start lock sweeper
     _LOCKS_CORE.start_sweeper(_CFG.lock_sweep_interval_sec, _CFG.lock_max_age_sec)
@@ -1,60 +1,487 @@
 from __future__ import annotations
 
 import json
+import math
 import shutil
+import threading
 import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import os
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
 from app.core.config import Config
+from app.core import metrics
 from app.core.cache import CacheStore, LockManager
 from app.core.convert import compute_cache_key
 from app.core.logging import log_line, console, log_exception
 from app.core.proc import run_subprocess
-from app.core.storage import compute_sha256
-from app.core.tasks import TaskStore
+from app.core.scheduler import PriorityPool
+from app.core.storage import atomic_write_json, compute_sha256
+from app.core.tasks import TERMINAL_STATES, TaskStore
 from app.core.postprocess import (
     release_collect_images_and_normalize,
     debug_comment_vsdx_and_normalize,
 )
+from app.core.imageopt import optimize_raster_images
+from app.core.jvm import DocxStats, HeapPolicy, docx_stats, java_tool_options, memory_limit_bytes
+from app.core.preflight import PreflightError, PreflightLimits, analyze_docx
+from app.core.package import ENTRIES_FILE, ZipPolicy, debug_entries, release_entries, save_entries, write_zip
 from app.core.models import JobState
 
 
+# Job arguments saved at submit time (see JobManager.save_params)
+PARAMS_FILE = "task_params.json"
+# Converter output before post-processing, kept for re-packaging
+ORIG_TEX_SUFFIX = ".tex.orig"
+# Calabash stderr kept in memory for err_msg; the full output is in the task log
+CALABASH_ERR_TAIL_BYTES = 16 * 1024
+# Calabash run limit; tasks with a deadline get at most their remaining budget
+CALABASH_TIMEOUT_SEC = 1200
+# Longest accepted deadline_sec / DEFAULT_DEADLINE_SEC
+MAX_DEADLINE_SEC = 7 * 86400
+# How often the JVM heap policy is re-fitted from recorded Calabash peak RSS
+HEAP_CALIBRATE_SEC = 300
+# Scheduling: one `priority` step outweighs this many seconds of estimated cost
+PRIORITY_STEP_SEC = 60.0
+PRIORITY_RANGE = (-10, 10)
+# Cost assumed for tasks without a pre-flight estimate (e.g. re-packaging)
+DEFAULT_EST_SEC = 5.0
+# Admission control: jobs finished within this window give the drain rate for Retry-After
+THROUGHPUT_WINDOW_SEC = 600
+RETRY_AFTER_RANGE = (1, 3600)
+# Queue ranks of tasks queued in other workers are re-read at most this often
+QUEUE_RANK_TTL_SEC = 1.0
+# Cancellation: how often a job polls the database for a cancel made by another
+# worker, and how long a child gets between SIGTERM and SIGKILL
+CANCEL_POLL_SEC = 1.0
+KILL_GRACE_SEC = 5.0
+
+
+class QueueFull(Exception):
+    """The job queues are at QUEUE_MAX_JOBS / QUEUE_MAX_BYTES; retry after `retry_after` seconds."""
+
+    def __init__(self, detail: str, retry_after: int, reason: str):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    # PDFs may be regenerated in place by vector conversion; never share their inode.
+    if not src.lower().endswith(".pdf"):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+class TaskCancelled(Exception):
+    """Raised inside a job once its task was cancelled."""
+
+
+class TaskExpired(Exception):
+    """Raised inside a job once its task's deadline has passed."""
+
+
 class JobManager:
     def __init__(self, cfg: Config, tasks: TaskStore, cache: CacheStore, locks: LockManager, workers: int = 2):
         self.cfg = cfg
         self.tasks = tasks
         self.cache = cache
         self.locks = locks
-        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.pool = PriorityPool(workers, name="jobs")
+        self._queued: dict = {}
+        self._queued_lock = threading.Lock()
+        self._running: set[str] = set()
+        self._cancelled: set[str] = set()
+        self._heap_policy: Optional[HeapPolicy] = None
+        self._heap_policy_at = 0.0
+        self._ranks: dict[str, int] = {}
+        self._ranks_at = 0.0
+        self._ranks_lock = threading.Lock()
 
-    def create(self, debug: bool, img_post_proc: bool) -> JobState:
+    def create(
+        self,
+        debug: bool,
+        img_post_proc: bool,
+        batch_id: Optional[str] = None,
+        deadline_sec: Optional[float] = None,
+    ) -> JobState:
+        """Register a pending task.
+
+        `deadline_sec` counts from now; None applies DEFAULT_DEADLINE_SEC and
+        0 means no deadline.
+        """
         task_id = str(uuid.uuid4())
         work_dir = self.cfg.data_root / "tasks" / task_id
         work_dir.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        if deadline_sec is None:
+            deadline_sec = self.cfg.default_deadline_sec
+        deadline_sec = min(deadline_sec, MAX_DEADLINE_SEC)
         js = JobState(
             task_id=task_id,
             state="pending",
-            start_time=time.time(),
+            start_time=now,
             debug=debug,
             img_post_proc=img_post_proc,
             work_dir=str(work_dir),
+            batch_id=batch_id,
+            deadline=now + deadline_sec if deadline_sec and deadline_sec > 0 else None,
         )
         self.tasks.insert(js)
         return js
 
+    def zip_policy(self) -> ZipPolicy:
+        return ZipPolicy(deflate_level=self.cfg.zip_deflate_level)
+
     def get(self, task_id: str) -> JobState:
         return self.tasks.get(task_id)
 
     def set_state(self, task_id: str, state: str, err: str = ""):
         self.tasks.set_state(task_id, state, err)
 
+    def heap_policy(self) -> HeapPolicy:
+        """Calabash JVM sizing, re-fitted from recent runs every HEAP_CALIBRATE_SEC."""
+        now = time.monotonic()
+        if self._heap_policy is not None and now - self._heap_policy_at < HEAP_CALIBRATE_SEC:
+            return self._heap_policy
+        max_mb = self.cfg.jvm_heap_max_mb
+        if max_mb <= 0:
+            # Leave a quarter of the memory for metaspace, Inkscape and the API processes
+            limit = memory_limit_bytes()
+            jobs = max(1, self.cfg.uvicorn_workers * self.workers)
+            max_mb = int(limit * 0.75 / jobs / (1024 * 1024)) if limit else 4096
+        policy = HeapPolicy(min_mb=self.cfg.jvm_heap_min_mb, max_mb=max(self.cfg.jvm_heap_min_mb, max_mb))
+        try:
+            samples = [
+                (int(d["document_xml_bytes"]), int(d["usage"]["max_rss_kb"]) * 1024)
+                for d in self.tasks.recent_stage_details("calabash")
+                if d.get("rc") == 0 and d.get("document_xml_bytes") and d.get("usage")
+            ]
+            policy = policy.calibrate(samples)
+        except Exception:
+            pass
+        self._heap_policy, self._heap_policy_at = policy, now
+        return policy
+
+    @staticmethod
+    def _heap_stats(js: JobState, docx: Path) -> DocxStats:
+        """Sizing figures recorded by the pre-flight check; tasks queued without one are analyzed here."""
+        if js.document_xml_bytes is not None:
+            return DocxStats(document_xml_bytes=js.document_xml_bytes, media_bytes=js.media_bytes or 0)
+        try:
+            return docx_stats(analyze_docx(docx, PreflightLimits(scan_bytes=0)))
+        except PreflightError:
+            return DocxStats()
+
+    @contextmanager
+    def stage(self, task_id: str, name: str, **detail):
+        """Time a block and record it in the task's stage timeline.
+
+        The yielded dict can be filled with extra detail (counts, exit code).
+        Recording is best-effort and never fails the job.
+        """
+        info = dict(detail)
+        started = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield info
+        finally:
+            duration = time.perf_counter() - t0
+            metrics.observe("docx2tex_stage_duration_seconds", duration, stage=name)
+            try:
+                self.tasks.add_stage(task_id, name, started, duration, info)
+            except Exception:
+                pass
+
+    def queue_key(self, task_id: str, priority: int, queued_at: float) -> float:
+        """Scheduling key, lowest first: estimated cost minus priority, plus aging.
+
+        `queue_aging * queued_at` grows with submit time, so a job overtakes
+        later ones that are cheaper by less than aging times its extra wait.
+        """
+        try:
+            est = self.get(task_id).est_seconds
+        except KeyError:
+            est = None
+        lo, hi = PRIORITY_RANGE
+        priority = min(hi, max(lo, int(priority)))
+        cost = (est if est is not None else DEFAULT_EST_SEC) - priority * PRIORITY_STEP_SEC
+        return cost + self.cfg.queue_aging * queued_at
+
+    def queue_load(self) -> dict:
+        """Occupancy of all workers' queues against the configured limits."""
+        jobs, nbytes = self.tasks.queue_totals()
+        max_jobs, max_bytes = self.cfg.queue_max_jobs, self.cfg.queue_max_bytes
+        return {
+            "queued_jobs": jobs,
+            "queued_bytes": nbytes,
+            "max_jobs": max_jobs,
+            "max_bytes": max_bytes,
+            "saturated": (max_jobs > 0 and jobs >= max_jobs) or (max_bytes > 0 and nbytes >= max_bytes),
+        }
+
+    def retry_after(self, excess_jobs: int, excess_bytes: int = 0) -> int:
+        """Seconds until the queues should have drained the excess, from observed throughput.
+
+        Uses the jobs (and input bytes) finished in the last
+        THROUGHPUT_WINDOW_SEC; without any, assumes every job slot finishes
+        one DEFAULT_EST_SEC job at a time.
+        """
+        excess_jobs = max(1, excess_jobs)
+        done, done_bytes = self.tasks.finished_since(time.time() - THROUGHPUT_WINDOW_SEC)
+        if done:
+            sec = excess_jobs * THROUGHPUT_WINDOW_SEC / done
+            if excess_bytes > 0 and done_bytes > 0:
+                sec = max(sec, excess_bytes * THROUGHPUT_WINDOW_SEC / done_bytes)
+        else:
+            slots = max(1, self.cfg.uvicorn_workers * self.workers)
+            sec = excess_jobs * DEFAULT_EST_SEC / slots
+        lo, hi = RETRY_AFTER_RANGE
+        return int(min(hi, max(lo, math.ceil(sec))))
+
+    def admit(self, jobs: int = 1, input_bytes: int = 0) -> None:
+        """Raise QueueFull unless `jobs` more jobs (`input_bytes` of DOCX) fit the queue limits.
+
+        Limits are checked against the database before submitting, so
+        concurrent submissions on other workers can overshoot them slightly.
+        A document larger than QUEUE_MAX_BYTES is still admitted into an
+        empty queue.
+        """
+        load = self.queue_load()
+        max_jobs, max_bytes = load["max_jobs"], load["max_bytes"]
+        if max_jobs > 0 and load["queued_jobs"] + jobs > max_jobs:
+            excess = load["queued_jobs"] + jobs - max_jobs
+            raise QueueFull(
+                f"job queue full ({load['queued_jobs']} queued, limit {max_jobs})", self.retry_after(excess), "jobs"
+            )
+        if max_bytes > 0 and load["queued_bytes"] > 0 and load["queued_bytes"] + input_bytes > max_bytes:
+            excess = load["queued_bytes"] + input_bytes - max_bytes
+            raise QueueFull(
+                f"job queue full ({load['queued_bytes']} input bytes queued, limit {max_bytes})",
+                self.retry_after(1, excess),
+                "bytes",
+            )
+
+    def _input_bytes(self, kwargs: dict) -> int:
+        if kwargs.get("reuse_from"):
+            return 0
+        try:
+            return (Path(self.get(kwargs["task_id"]).work_dir) / kwargs["source_value"]).stat().st_size
+        except (KeyError, OSError, TypeError):
+            return 0
+
     # Schedules background job
-    def submit(self, **kwargs):
-        self.pool.submit(self._process_job, **kwargs)
+    def submit(self, priority: int = 0, **kwargs):
+        try:
+            self.save_params(kwargs)
+        except Exception:
+            pass
+        queued_at = time.time()
+        key = self.queue_key(kwargs["task_id"], priority, queued_at)
+        try:
+            self.tasks.set_queue_key(kwargs["task_id"], key, self._input_bytes(kwargs))
+        except Exception:
+            pass
+        metrics.gauge_add("docx2tex_queue_depth", 1, pool="jobs")
+        with self._queued_lock:
+            self._queued[kwargs["task_id"]] = self.pool.submit(key, self._run_queued, queued_at, kwargs)
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """1-based position among queued tasks, None once started.
+
+        Exact for tasks queued in this process; otherwise estimated from the
+        keys all workers record in the database. Those ranks are read for all
+        queued tasks at once and reused for QUEUE_RANK_TTL_SEC, so status
+        polls cost at most one query per interval.
+        """
+        with self._queued_lock:
+            entry = self._queued.get(task_id)
+        if entry is not None:
+            return self.pool.position(entry)
+        with self._ranks_lock:
+            now = time.monotonic()
+            if now - self._ranks_at >= QUEUE_RANK_TTL_SEC:
+                self._ranks = self.tasks.queue_ranks()
+                self._ranks_at = now
+            return self._ranks.get(task_id)
+
+    def cancel(self, task_id: str) -> bool:
+        """Cancel a task that has not ended; False when it already had.
+
+        The task is marked cancelled at once (later state writes of its job
+        are ignored) and dropped from this process's queue. A job running
+        here or in another worker notices within CANCEL_POLL_SEC: its
+        Calabash or Inkscape process group gets SIGTERM, then SIGKILL, and
+        the job stops before its next stage. Cache locks the task holds are
+        released together with their unpublished cache entries, and the
+        work dir is removed.
+        """
+        js = self.get(task_id)
+        if not self.tasks.finish_if_active(task_id, "cancelled", "cancelled by client"):
+            return False
+        with self._queued_lock:
+            entry = self._queued.pop(task_id, None)
+            if task_id in self._running:
+                self._cancelled.add(task_id)
+        if entry is not None and self.pool.cancel(entry):
+            metrics.gauge_add("docx2tex_queue_depth", -1, pool="jobs")
+        for key in self.locks.release_builder(task_id):
+            row = self.cache.get(key)
+            if not row or int(row.get("available", 0)) != 1:
+                self.cache.mark_gone(key)
+                shutil.rmtree(self.cache.cache_dir(key), ignore_errors=True)
+        shutil.rmtree(js.work_dir, ignore_errors=True)
+        log_line(self.cfg.log_dir / f"{task_id}.log", "task_cancelled")
+        console(f"task={task_id} stage=cancelled")
+        return True
+
+    def _cancel_check(self, task_id: str) -> Callable[[], bool]:
+        """Callable telling whether `task_id` was cancelled, cheap enough to poll."""
+        checked_at = [0.0]
+
+        def cancelled() -> bool:
+            if task_id in self._cancelled:
+                return True
+            now = time.monotonic()
+            if now - checked_at[0] < CANCEL_POLL_SEC:
+                return False
+            checked_at[0] = now
+            try:
+                if self.get(task_id).state == "cancelled":
+                    with self._queued_lock:
+                        self._cancelled.add(task_id)
+                    return True
+            except KeyError:
+                return True
+            return False
+
+        return cancelled
+
+    def _expire(self, task_id: str, where: str, detail: str) -> None:
+        """End a task whose deadline passed (`where`: queue or running) and free its work dir."""
+        if not self.tasks.finish_if_active(task_id, "expired", detail):
+            return
+        metrics.inc("docx2tex_tasks_expired_total", where=where)
+        try:
+            shutil.rmtree(self.get(task_id).work_dir, ignore_errors=True)
+        except KeyError:
+            pass
+        log_line(self.cfg.log_dir / f"{task_id}.log", f"task_expired: {detail}")
+        console(f"task={task_id} stage=expired where={where}")
+
+    def _discard_cancelled(self, task_id: str) -> None:
+        """Remove what a cancelled job produced after DELETE freed its work dir."""
+        try:
+            js = self.get(task_id)
+        except KeyError:
+            return
+        shutil.rmtree(js.work_dir, ignore_errors=True)
+        shutil.rmtree(self.cfg.public_root / task_id, ignore_errors=True)
+
+    def _run_queued(self, queued_at: float, kwargs: dict) -> None:
+        task_id = kwargs["task_id"]
+        waited = time.time() - queued_at
+        try:
+            js = self.get(task_id)
+        except KeyError:
+            js = None
+        state = js.state if js is not None else None
+        with self._queued_lock:
+            self._queued.pop(task_id, None)
+            if state is not None and state not in TERMINAL_STATES:
+                self._running.add(task_id)
+        if state is None or state in TERMINAL_STATES:
+            # Cancelled through another worker while queued here
+            metrics.gauge_add("docx2tex_queue_depth", -1, pool="jobs")
+            if state == "cancelled":
+                self._discard_cancelled(task_id)
+            return
+        try:
+            self.tasks.set_queue_key(kwargs["task_id"], None)
+        except Exception:
+            pass
+        metrics.gauge_add("docx2tex_queue_depth", -1, pool="jobs")
+        metrics.observe("docx2tex_stage_duration_seconds", waited, stage="queue_wait")
+        try:
+            self.tasks.add_stage(kwargs["task_id"], "queue_wait", queued_at, waited)
+        except Exception:
+            pass
+        if js.deadline is not None and time.time() >= js.deadline:
+            # Nobody waits for this result any more; do not spend a worker on it
+            self._expire(task_id, "queue", f"deadline exceeded after {waited:.0f}s in queue")
+            with self._queued_lock:
+                self._running.discard(task_id)
+            return
+        metrics.gauge_add("docx2tex_jobs_running", 1, pool="jobs")
+        try:
+            self._process_job(**kwargs)
+        finally:
+            metrics.gauge_add("docx2tex_jobs_running", -1, pool="jobs")
+            if self._cancel_check(task_id)():
+                self._discard_cancelled(task_id)
+            with self._queued_lock:
+                self._running.discard(task_id)
+                self._cancelled.discard(task_id)
+
+    def save_params(self, kwargs: dict) -> None:
+        """Persist the job arguments so the task can be re-packaged later."""
+        js = self.get(kwargs["task_id"])
+        params = {
+            k: (str(v) if isinstance(v, Path) else v)
+            for k, v in kwargs.items()
+            if k not in ("task_id", "reuse_from")
+        }
+        atomic_write_json(Path(js.work_dir) / PARAMS_FILE, params)
+
+    def load_params(self, task_id: str) -> Optional[dict]:
+        js = self.get(task_id)
+        path = Path(js.work_dir) / PARAMS_FILE
+        if not path.exists():
+            return None
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            return None
+
+    def _reuse_outputs(self, source_id: str, cache_key: str, basename: str, work: Path, log_path: Path) -> bool:
+        """Populate `work` with the converter outputs of finished task `source_id`.
+
+        Prefers the source work dir (pristine TeX plus hard-linked trees) and
+        falls back to the cache entry. Returns False when neither is available.
+        """
+        try:
+            src_work = Path(self.get(source_id).work_dir)
+        except KeyError:
+            src_work = None
+        orig_tex = src_work / f"{basename}{ORIG_TEX_SUFFIX}" if src_work else None
+        if orig_tex is not None and orig_tex.exists():
+            s = orig_tex.read_text(encoding="utf-8", errors="replace")
+            (work / f"{basename}.tex").write_text(s.replace(str(src_work), str(work)), encoding="utf-8")
+            for ext in ("xml", "csv"):
+                p = src_work / f"{basename}.{ext}"
+                if p.exists():
+                    shutil.copy2(p, work / p.name)
+            for name in (f"{basename}.debug", f"{basename}.docx.tmp"):
+                p = src_work / name
+                if p.exists():
+                    shutil.copytree(p, work / name, copy_function=_link_or_copy, dirs_exist_ok=True)
+            log_line(log_path, f"reuse source={source_id} from=work_dir")
+            return True
+        cached_base = self.cache.disk_ok(cache_key) if cache_key else None
+        if cached_base:
+            self.cache.restore_to_work(cache_key, cached_base, basename, work)
+            self.cache.touch(cache_key)
+            log_line(log_path, f"reuse source={source_id} from=cache key={cache_key}")
+            return True
+        return False
 
     def _process_job(
         self,
@@ -73,6 +500,8 @@ class JobManager:
         job_cache_key: Optional[str] = None,
         no_cache: bool = False,
         image_dir: str = "image",
+        img_optimize: bool = False,
+        reuse_from: Optional[str] = None,
     ):
         js = self.get(task_id)
         work = Path(js.work_dir)
@@ -89,35 +518,63 @@ class JobManager:
         out_tex = work / f"{basename}.tex"
         out_xml = work / f"{basename}.xml"
         debug_dir = work / f"{basename}.debug"
+        cancelled = self._cancel_check(task_id)
+        deadline = js.deadline
+
+        def past_deadline() -> bool:
+            return deadline is not None and time.time() >= deadline
+
+        def checkpoint() -> None:
+            """Stop before the next stage once the task is cancelled or late."""
+            if cancelled():
+                raise TaskCancelled()
+            if past_deadline():
+                raise TaskExpired()
 
         try:
             self.set_state(task_id, "running")
 
             chosen_conf = conf_file if conf_file else (self.cfg.docx2tex_home / "conf" / "conf.xml")
 
-            cache_key = job_cache_key or compute_cache_key(
-                work / orig_name,
-                chosen_conf,
-                custom_xsl,
-                custom_evolve,
-                mtef_source,
-                table_model,
-                fontmaps_zip,
-            )
+            if reuse_from:
+                # Re-packaging: the DOCX is not re-hashed, the source task's key is reused
+                cache_key = job_cache_key or ""
+            elif job_cache_key:
+                cache_key = job_cache_key
+            else:
+                with self.stage(task_id, "hashing"):
+                    cache_key = compute_cache_key(
+                        work / orig_name,
+                        chosen_conf,
+                        custom_xsl,
+                        custom_evolve,
+                        mtef_source,
+                        table_model,
+                        fontmaps_zip,
+                    )
 
             # Pre-check READY cache
-            row = self.cache.get(cache_key)
-            if (not no_cache) and row and int(row.get("available", 0)) == 1:
+            row = self.cache.get(cache_key) if cache_key else None
+            if reuse_from:
+                with self.stage(task_id, "reuse", source=reuse_from) as st:
+                    st["ok"] = self._reuse_outputs(reuse_from, cache_key, basename, work, log_path)
+                if not st["ok"]:
+                    self.set_state(task_id, "failed", "source task outputs are no longer available")
+                    console(f"task={task_id} stage=reuse_failed source={reuse_from}")
+                    return
+            elif (not no_cache) and row and int(row.get("available", 0)) == 1:
                 cached_base = row.get("basename") or basename
                 log_line(log_path, f"cache_hit key={cache_key} cached_base={cached_base} -> restore to {basename}")
                 console(f"task={task_id} cache_hit key={cache_key}")
-                try:
-                    self.cache.restore_to_work(cache_key, cached_base, basename, Path(js.work_dir))
-                except Exception:
-                    # On restore failure, fall back to rebuild
-                    pass
+                with self.stage(task_id, "cache_restore"):
+                    try:
+                        self.cache.restore_to_work(cache_key, cached_base, basename, Path(js.work_dir))
+                    except Exception:
+                        # On restore failure, fall back to rebuild
+                        pass
                 self.cache.touch(cache_key)
             else:
+                checkpoint()
                 # Build path (optionally guarded by lock when using cache)
                 claimed = True
                 if not no_cache:
@@ -127,7 +584,8 @@ class JobManager:
                         row = self.cache.get(cache_key)
                         if row and int(row.get("available", 0)) == 1:
                             cached_base = row.get("basename") or basename
-                            self.cache.restore_to_work(cache_key, cached_base, basename, Path(js.work_dir))
+                            with self.stage(task_id, "cache_restore"):
+                                self.cache.restore_to_work(cache_key, cached_base, basename, Path(js.work_dir))
                             self.cache.touch(cache_key)
                             claimed = False
                 if claimed:
@@ -138,6 +596,13 @@ class JobManager:
                         "PATH": os.environ.get("PATH", ""),
                         "JAVA_TOOL_OPTIONS": os.environ.get("JAVA_TOOL_OPTIONS", ""),
                     }
+                    jvm: dict = {}
+                    if self.cfg.jvm_heap_policy == "auto":
+                        stats = self._heap_stats(js, work / orig_name)
+                        jvm = self.heap_policy().options(stats)
+                        jvm["document_xml_bytes"] = stats.document_xml_bytes
+                        env["JAVA_TOOL_OPTIONS"] = java_tool_options(env["JAVA_TOOL_OPTIONS"], jvm)
+                        log_line(log_path, f"jvm {env['JAVA_TOOL_OPTIONS']}")
                     cmd = [
                         str(self.cfg.docx2tex_home / "calabash" / "calabash.sh"),
                     ]
@@ -179,43 +644,102 @@ class JobManager:
                     except Exception:
                         pass
 
-                    rc, out, err = run_subprocess(cmd, cwd=self.cfg.docx2tex_home, env=env, timeout=1200)
+                    # Output is streamed into the task log (GET /v1/task/{id}/log?follow=1);
+                    # only the tail of stderr is kept for the error message.
                     with open(log_path, "ab") as lf:
                         lf.write(b"\n--- calabash ---\n")
-                        lf.write((out or "").encode("utf-8") + b"\n" + (err or "").encode("utf-8"))
+                    timeout = CALABASH_TIMEOUT_SEC
+                    if deadline is not None:
+                        timeout = max(1.0, min(timeout, deadline - time.time()))
+                    with self.stage(task_id, "calabash") as st:
+                        usage: dict = {}
+                        rc, _, err = run_subprocess(
+                            cmd,
+                            cwd=self.cfg.docx2tex_home,
+                            env=env,
+                            timeout=timeout,
+                            usage=usage,
+                            log_path=log_path,
+                            tail_bytes=CALABASH_ERR_TAIL_BYTES,
+                            cancel=cancelled,
+                            kill_grace_sec=KILL_GRACE_SEC,
+                        )
+                        st.update(rc=rc, usage=usage, timeout_sec=round(timeout, 1))
+                        if jvm:
+                            st["document_xml_bytes"] = jvm.pop("document_xml_bytes")
+                            st["jvm"] = jvm
+                    metrics.inc("docx2tex_calabash_runs_total", rc=rc)
+                    metrics.record_child_usage("calabash", usage)
                     if rc != 0 or not out_tex.exists():
                         # hard fail; cleanup any partial cache artifacts and release lock
                         try:
                             if not no_cache:
                                 self.cache.mark_gone(cache_key)
                                 # remove on-disk partials
-                                import shutil
                                 shutil.rmtree(self.cache.cache_dir(cache_key), ignore_errors=True)
                         except Exception:
                             pass
                         if not no_cache:
-                            self.locks.release(cache_key)
+                            self.locks.release(cache_key, task_id)
+                        if cancelled():
+                            raise TaskCancelled()
+                        if rc == 124 and timeout < CALABASH_TIMEOUT_SEC:
+                            raise TaskExpired()
                         self.set_state(task_id, "failed", err or "docx2tex failed")
                         console(f"task={task_id} stage=docx2tex_failed")
                         return
-                    # Cache publish
+                    # Cache publish, only while this task still holds the build lock:
+                    # cancel() drops the lock and the work dir, possibly while
+                    # Calabash was finishing, and another task may claim the key.
                     if not no_cache:
+                        if cancelled():
+                            self.locks.release(cache_key, task_id)
+                            raise TaskCancelled()
                         try:
-                            self.cache.save_to_disk(cache_key, basename, Path(js.work_dir))
-                            self.cache.put(cache_key, basename)
-                            log_line(log_path, f"cache_saved key={cache_key} base={basename}")
-                            console(f"task={task_id} cache_saved key={cache_key}")
+                            if (self.locks.get(cache_key) or {}).get("builder") != task_id:
+                                log_line(log_path, f"cache_publish_skipped key={cache_key} reason=lock_lost")
+                            else:
+                                with self.stage(task_id, "cache_publish"):
+                                    self.cache.save_to_disk(cache_key, basename, Path(js.work_dir))
+                                if self.cache.put(cache_key, basename, builder=task_id):
+                                    log_line(log_path, f"cache_saved key={cache_key} base={basename}")
+                                    console(f"task={task_id} cache_saved key={cache_key}")
+                                else:
+                                    # Lost the lock while copying; leave the dir to a new builder
+                                    if self.locks.get(cache_key) is None:
+                                        shutil.rmtree(self.cache.cache_dir(cache_key), ignore_errors=True)
+                                    log_line(log_path, f"cache_publish_skipped key={cache_key} reason=lock_lost")
                         except Exception as e:
                             log_exception(log_path, "cache_save_failed", e)
                         finally:
-                            self.locks.release(cache_key)
+                            self.locks.release(cache_key, task_id)
+
+            # Keep the untouched converter output so the task can be re-packaged later
+            if out_tex.exists():
+                shutil.copy2(out_tex, work / f"{basename}{ORIG_TEX_SUFFIX}")
+
+            checkpoint()
 
             # Vector image conversion (optional, in-process)
             if img_post_proc and out_tex.exists():
                 self.set_state(task_id, "converting")
                 try:
                     from app.core.postprocess import convert_vector_references
-                    c, m, f = convert_vector_references(out_tex)
+                    with self.stage(task_id, "vector_conversion") as st:
+                        usage = {}
+                        c, m, f = convert_vector_references(
+                            out_tex,
+                            usage=usage,
+                            cancel=lambda: cancelled() or past_deadline(),
+                            timeout=self.cfg.inkscape_timeout_sec or None,
+                        )
+                        st.update(converted=c, missing=m, failed=f)
+                        if usage:
+                            st["usage"] = usage
+                    metrics.record_child_usage("inkscape", usage)
+                    for result, n in (("converted", c), ("missing", m), ("failed", f)):
+                        if n:
+                            metrics.inc("docx2tex_vector_conversions_total", n, result=result)
                     with open(log_path, "ab") as lf:
                         lf.write(b"\n--- convert_vector_images ---\n")
                         lf.write(f"converted={c} missing={m} failed={f}\n".encode("utf-8"))
@@ -224,14 +748,17 @@ class JobManager:
                         lf.write(b"\n--- convert_vector_images (error) ---\n")
                         lf.write(str(e).encode("utf-8"))
 
+            checkpoint()
+
             try:
                 # Packaging (require valid main TeX or debug artifacts)
                 self.set_state(task_id, "packaging")
-                from zipfile import ZipFile, ZIP_DEFLATED
 
-                result_zip_public = self.cfg.public_root / f"{basename}.zip"
-                log_line(log_path, f"packaging -> {result_zip_public}")
-                console(f"task={task_id} stage=packaging zip={result_zip_public}")
+                # Per-task directory: tasks with the same input name never share a result file
+                result_zip_public = self.cfg.public_root / task_id / f"{basename}.zip"
+                stream_only = debug and self.cfg.debug_result_mode == "stream"
+                log_line(log_path, f"packaging -> {'stream' if stream_only else result_zip_public}")
+                console(f"task={task_id} stage=packaging zip={'stream' if stream_only else result_zip_public}")
                 manifest = {
                     "task_id": task_id,
                     "debug": debug,
@@ -242,69 +769,59 @@ class JobManager:
                     "table_model": (table_model or ""),
                     "fontmaps_dir": str(fontmaps_dir) if fontmaps_dir else "",
                 }
-                self.cfg.public_root.mkdir(parents=True, exist_ok=True)
-                with ZipFile(result_zip_public, "w", ZIP_DEFLATED) as zf:
-                    if debug:
-                        # debug-mode: tidy TeX, comment .vsdx, normalize width
-                        try:
+                if debug:
+                    # debug-mode: tidy TeX, comment .vsdx, normalize width
+                    try:
+                        with self.stage(task_id, "tex_normalize"):
                             _ = debug_comment_vsdx_and_normalize(out_tex)
-                        except Exception:
-                            pass
-                        for p in [out_tex, out_xml]:
-                            if p.exists():
-                                zf.write(p, arcname=p.name)
-                                manifest["files"].append(p.name)
-                        csv_path = work / f"{basename}.csv"
-                        if csv_path.exists():
-                            zf.write(csv_path, arcname=csv_path.name)
-                            manifest["files"].append(csv_path.name)
-                        if (work / f"{basename}.debug").exists():
-                            for sub in (work / f"{basename}.debug").rglob("*"):
-                                if sub.is_file():
-                                    arc = f"{(work / f'{basename}.debug').name}/{sub.relative_to(work / f'{basename}.debug')}"
-                                    zf.write(sub, arcname=arc)
-                                    manifest["files"].append(arc)
-                        tmp_dir = work / f"{basename}.docx.tmp"
-                        if tmp_dir.exists():
-                            for sub in tmp_dir.rglob("*"):
-                                if sub.is_file():
-                                    arc = f"{tmp_dir.name}/{sub.relative_to(tmp_dir)}"
-                                    zf.write(sub, arcname=arc)
-                                    manifest["files"].append(arc)
-                        # include log
-                        if log_path.exists():
-                            arc = f"logs/{log_path.name}"
-                            zf.write(log_path, arcname=arc)
-                            manifest["files"].append(arc)
-                        # include effective custom evolve xsl & stylemap manifest if present
-                        eff = work / "custom-evolve-effective.xsl"
-                        if eff.exists():
-                            zf.write(eff, arcname=f"xsl/{eff.name}")
-                            manifest["files"].append(f"xsl/{eff.name}")
-                        sm = work / "stylemap_manifest.json"
-                        if sm.exists():
-                            zf.write(sm, arcname=sm.name)
-                            manifest["files"].append(sm.name)
-                    else:
-                        # non-debug: collect images, rewrite paths, drop .vsdx, normalize width
-                        try:
-                            image_dir_path = work / image_dir
+                    except Exception:
+                        pass
+                    entries = debug_entries(work, basename, log_path)
+                else:
+                    # non-debug: collect images, rewrite paths, drop .vsdx, normalize width
+                    try:
+                        image_dir_path = work / image_dir
+                        image_stats: dict = {}
+                        with self.stage(task_id, "image_collection") as st:
                             ncol, ndrop = release_collect_images_and_normalize(
-                                out_tex, image_dir_path, image_alias=image_dir
+                                out_tex, image_dir_path, image_alias=image_dir, stats=image_stats
                             )
-                        except Exception:
-                            pass
-                        if out_tex.exists():
-                            zf.write(out_tex, arcname=out_tex.name)
-                            manifest["files"].append(out_tex.name)
-                        image_dir_path = work / image_dir
-                        if image_dir_path.exists():
-                            for sub in image_dir_path.rglob("*"):
-                                if sub.is_file():
-                                    arc = f"{image_dir}/{sub.relative_to(image_dir_path)}"
-                                    zf.write(sub, arcname=arc)
-                                    manifest["files"].append(arc)
-                    zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+                            st.update(collected=ncol, dropped=ndrop)
+                        manifest["images"] = {
+                            "collected": ncol,
+                            "deduplicated": image_stats.get("deduplicated", 0),
+                            "bytes_saved": image_stats.get("bytes_saved", 0),
+                        }
+                    except Exception:
+                        pass
+                    if img_optimize and out_tex.exists():
+                        try:
+                            with self.stage(task_id, "image_optimization"):
+                                opt = optimize_raster_images(
+                                    out_tex,
+                                    work / image_dir,
+                                    image_alias=image_dir,
+                                    max_dpi=self.cfg.img_opt_max_dpi,
+                                    textwidth_in=self.cfg.img_opt_textwidth_in,
+                                    jpeg_quality=self.cfg.img_opt_jpeg_quality,
+                                    workers=self.cfg.img_opt_workers,
+                                    cache_dir=self.cfg.data_root / "imgopt",
+                                )
+                            manifest["image_optimization"] = opt
+                            log_line(log_path, f"image_optimization {json.dumps(opt)}")
+                        except Exception as e:
+                            log_exception(log_path, "image_optimization_failed", e)
+                    entries = release_entries(work, basename, image_dir)
+                manifest["files"] = [arc for arc, _ in entries]
+                policy = self.zip_policy()
+                if stream_only:
+                    manifest["packaging"] = {"mode": "stream", "policy": policy.as_dict()}
+                else:
+                    with self.stage(task_id, "zip") as st:
+                        zstats = write_zip(result_zip_public, entries, manifest, policy)
+                        st.update(entries=zstats["entries"], bytes_out=zstats["bytes_out"])
+                    log_line(log_path, f"packaging_stats {json.dumps(zstats)}")
+                save_entries(work, basename, entries, manifest)
 
                 # Sanity: if no meaningful files were added (e.g., calabash produced nothing), fail the task
                 if not debug and not out_tex.exists():
@@ -312,6 +829,16 @@ class JobManager:
                     console(f"task={task_id} stage=packaging_failed no_output")
                     return
 
+                # Record where the package lives and its digest (serves ETag/Range downloads)
+                if stream_only:
+                    self.tasks.set_result(task_id, str(work / ENTRIES_FILE), "", 0, mode="stream")
+                else:
+                    self.tasks.set_result(
+                        task_id,
+                        str(result_zip_public),
+                        compute_sha256(result_zip_public),
+                        result_zip_public.stat().st_size,
+                    )
                 self.set_state(task_id, "done")
                 log_line(log_path, "task_done")
                 console(f"task={task_id} stage=done")
@@ -320,6 +847,11 @@ class JobManager:
                 self.set_state(task_id, "failed", str(e))
                 console(f"task={task_id} stage=failed error={e}")
                 return
+        except TaskCancelled:
+            log_line(log_path, "task_stopped: cancelled")
+            console(f"task={task_id} stage=stopped reason=cancelled")
+        except TaskExpired:
+            self._expire(task_id, "running", f"deadline exceeded after {time.time() - js.start_time:.0f}s")
         except Exception as e:
             log_line(log_path, f"task_failed: {e}")
             self.set_state(task_id, "failed", str(e))
@@ -0,0 +1,83 @@
+"""Throughput benchmark for the SQLite access paths hit by the API.
+
+Compares the previous behaviour (a fresh connection plus PRAGMAs per call)
+against the persistent per-thread connections in `app.core.db.Database`.
+
+    python bench/bench_db.py [--ops 5000] [--threads 4]
+
+- status poll : TaskStore.get (GET /v1/task/{id})
+- submit      : TaskStore.insert + CacheStore.get (POST /v1/task bookkeeping)
+"""
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.core.cache import CacheStore  # noqa: E402
+from app.core.db import Database  # noqa: E402
+from app.core.models import JobState  # noqa: E402
+from app.core.tasks import TaskStore  # noqa: E402
+
+
+class PerCallDatabase(Database):
+    """Emulates the old connect(): new connection + PRAGMAs on every call."""
+
+    def connect(self) -> sqlite3.Connection:
+        return self._open()
+
+
+def _job(task_id: str, root: Path) -> JobState:
+    return JobState(task_id=task_id, state="pending", start_time=time.time(), work_dir=str(root / task_id))
+
+
+def _run(db_cls: type[Database], ops: int, threads: int) -> dict[str, float]:
+    with tempfile.TemporaryDirectory() as td:
+        root = Path(td)
+        db = db_cls(root / "state.db")
+        db.init_schema()
+        tasks = TaskStore(db)
+        cache = CacheStore(db, root)
+        ids = [str(uuid.uuid4()) for _ in range(64)]
+        for tid in ids:
+            tasks.insert(_job(tid, root))
+
+        def poll(i: int) -> None:
+            tasks.get(ids[i % len(ids)])
+
+        def submit(i: int) -> None:
+            tasks.insert(_job(str(uuid.uuid4()), root))
+            cache.get("k%d" % (i % 32))
+
+        out: dict[str, float] = {}
+        for name, fn in (("status_poll", poll), ("submit", submit)):
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(fn, range(ops)))
+            out[name] = ops / (time.perf_counter() - t0)
+        db.close()
+        return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ops", type=int, default=5000)
+    ap.add_argument("--threads", type=int, default=4)
+    args = ap.parse_args()
+
+    before = _run(PerCallDatabase, args.ops, args.threads)
+    after = _run(Database, args.ops, args.threads)
+    print(f"{'path':<12} {'before ops/s':>14} {'after ops/s':>14} {'speedup':>8}")
+    for k in before:
+        print(f"{k:<12} {before[k]:>14.0f} {after[k]:>14.0f} {after[k] / before[k]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,20 @@ $Form.Add($sc, $Name, $fi.Name)
 return $fs
 }
 
+# Returns $true when the server already stores this DOCX digest (HEAD /v1/blobs/{sha256})
+function Test-Docx2TexBlob {
+param(
+[Parameter(Mandatory=$true)][System.Net.Http.HttpClient]$Client,
+[Parameter(Mandatory=$true)][string]$Server,
+[Parameter(Mandatory=$true)][string]$Sha256
+)
+try {
+$req = New-Object System.Net.Http.HttpRequestMessage([System.Net.Http.HttpMethod]::Head, "$Server/v1/blobs/$Sha256")
+$resp = $Client.SendAsync($req).Result
+return ([int]$resp.StatusCode -eq 200)
+} catch { return $false }
+}
+
 function New-Docx2TexTask {
 [CmdletBinding(DefaultParameterSetName="File")]
 param(
@@ -52,6 +66,9 @@ param(
 [Parameter()][string]$CustomEvolve,
 [Parameter()][string]$ImageDir,
 [Parameter()][bool]$NoCache = $false,
+[Parameter()][bool]$UseDigest = $true,
+# Seconds after which the server drops the task (0 = server default)
+[Parameter()][int]$DeadlineSec = 0,
 
 [Parameter()][int]$TimeoutSec = 300
 )
@@ -63,8 +80,20 @@ try {
 if ($PSCmdlet.ParameterSetName -eq "File") {
 if (-not (Test-Path -LiteralPath $File)) { throw "File not found: $File" }
 if (-not $File.ToLower().EndsWith(".docx")) { throw "Only .docx is supported: $File" }
-$docStream = Add-FilePart -Form $form -Name "file" -FilePath $File -ContentType "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-$streams.Add($docStream) | Out-Null
+$sha = $null
+if ($UseDigest -and -not $NoCache) {
+  # Fast path: reference a DOCX the server already has instead of uploading it again
+  $sha = (Get-FileHash -LiteralPath $File -Algorithm SHA256).Hash.ToLower()
+  if (-not (Test-Docx2TexBlob -Client $hc -Server $Server -Sha256 $sha)) { $sha = $null }
+}
+if ($sha) {
+  Write-Host ("docx_sha256={0} (already on server, upload skipped)" -f $sha)
+  Add-StringPart -Form $form -Name "docx_sha256" -Value $sha
+  Add-StringPart -Form $form -Name "filename" -Value ((Get-Item -LiteralPath $File).Name)
+} else {
+  $docStream = Add-FilePart -Form $form -Name "file" -FilePath $File -ContentType "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+  $streams.Add($docStream) | Out-Null
+}
 } else {
 Add-StringPart -Form $form -Name "url" -Value $Url
 }
@@ -98,6 +127,7 @@ $evolveStream = Add-FilePart -Form $form -Name "custom_evolve" -FilePath $Custom
 if ($ImageDir) {
   Add-StringPart -Form $form -Name "image_dir" -Value $ImageDir
 }
+if ($DeadlineSec -gt 0) { Add-StringPart -Form $form -Name "deadline_sec" -Value $DeadlineSec.ToString() }
 
 $resp = $hc.PostAsync($endpoint, $form).Result
 $body = $resp.Content.ReadAsStringAsync().Result
@@ -134,21 +164,41 @@ return ($body | ConvertFrom-Json)
 } finally { try { $hc.Dispose() } catch {} }
 }
 
+function Stop-Docx2TexTask {
+param(
+[Parameter(Mandatory=$true)][string]$Server,
+[Parameter(Mandatory=$true)][string]$TaskId,
+[int]$TimeoutSec = 60
+)
+$hc = New-HttpClient -TimeoutSec $TimeoutSec
+try {
+$resp = $hc.DeleteAsync("$Server/v1/task/$TaskId").Result
+$body = $resp.Content.ReadAsStringAsync().Result
+if (-not $resp.IsSuccessStatusCode) { throw "HTTP $($resp.StatusCode) $body" }
+return ($body | ConvertFrom-Json)
+} finally { try { $hc.Dispose() } catch {} }
+}
+
 function Wait-Docx2TexTask {
 param(
 [Parameter(Mandatory=$true)][string]$Server,
 [Parameter(Mandatory=$true)][string]$TaskId,
 [int]$PollIntervalSec = 2,
-[int]$TimeoutSec = 900
+[int]$TimeoutSec = 900,
+[bool]$CancelOnTimeout = $true
 )
 $start = Get-Date
 while ($true) {
 $st = Get-Docx2TexTask -Server $Server -TaskId $TaskId
 $state = $st.data.state
 Write-Host ("[{0}] state={1}" -f (Get-Date), $state)
-if ($state -in @('done','failed')) { return $st }
+if ($state -in @('done','failed','cancelled','expired')) { return $st }
 Start-Sleep -Seconds $PollIntervalSec
-if ((Get-Date) -gt $start.AddSeconds($TimeoutSec)) { throw "Timeout waiting for task $TaskId" }
+if ((Get-Date) -gt $start.AddSeconds($TimeoutSec)) {
+  # Free the server's worker slot instead of leaving the job running
+  if ($CancelOnTimeout) { try { Stop-Docx2TexTask -Server $Server -TaskId $TaskId | Out-Null } catch {} }
+  throw "Timeout waiting for task $TaskId"
+}
 }
 }
 
@@ -201,14 +251,15 @@ param(
 [string]$ImageDir,
 
 [bool]$NoCache = $false,
+[bool]$UseDigest = $true,
 [int]$PollIntervalSec = 2,
 [int]$TimeoutSec = 900
 )
 
 $task = if ($PSCmdlet.ParameterSetName -eq "File") {
-New-Docx2TexTask -Server $Server -File $File -IncludeDebug:$IncludeDebug -ImgPostProc:$ImgPostProc -Conf $Conf -CustomXsl $CustomXsl -CustomEvolve $CustomEvolve -StyleMap $StyleMap -MathTypeSource $MathTypeSource -TableModel $TableModel -FontMapsZip $FontMapsZip -NoCache:$NoCache -ImageDir $ImageDir
+New-Docx2TexTask -Server $Server -File $File -IncludeDebug:$IncludeDebug -ImgPostProc:$ImgPostProc -Conf $Conf -CustomXsl $CustomXsl -CustomEvolve $CustomEvolve -StyleMap $StyleMap -MathTypeSource $MathTypeSource -TableModel $TableModel -FontMapsZip $FontMapsZip -NoCache:$NoCache -UseDigest:$UseDigest -ImageDir $ImageDir -DeadlineSec $TimeoutSec
 } else {
-New-Docx2TexTask -Server $Server -Url $Url -IncludeDebug:$IncludeDebug -ImgPostProc:$ImgPostProc -Conf $Conf -CustomXsl $CustomXsl -CustomEvolve $CustomEvolve -StyleMap $StyleMap -MathTypeSource $MathTypeSource -TableModel $TableModel -FontMapsZip $FontMapsZip -NoCache:$NoCache -ImageDir $ImageDir
+New-Docx2TexTask -Server $Server -Url $Url -IncludeDebug:$IncludeDebug -ImgPostProc:$ImgPostProc -Conf $Conf -CustomXsl $CustomXsl -CustomEvolve $CustomEvolve -StyleMap $StyleMap -MathTypeSource $MathTypeSource -TableModel $TableModel -FontMapsZip $FontMapsZip -NoCache:$NoCache -ImageDir $ImageDir -DeadlineSec $TimeoutSec
 }
 
 if (-not $task.TaskId) { throw "Task creation failed (no TaskId returned)." }
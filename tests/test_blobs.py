@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from app.core.blobs import BlobStore, is_sha256
+
+
+def test_blob_store_put_link_and_cleanup():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        src = td / "a.docx"
+        src.write_bytes(b"DOCX")
+        sha = hashlib.sha256(b"DOCX").hexdigest()
+        store = BlobStore(td / "inputs")
+
+        assert is_sha256(sha) and not is_sha256("../etc")
+        assert not store.has(sha)
+        store.put(src, sha)
+        store.put(src, sha)  # idempotent
+        assert store.has(sha)
+
+        dest = store.link_to(sha, td / "work" / "b.docx")
+        assert dest is not None and dest.read_bytes() == b"DOCX"
+        assert store.link_to("0" * 64, td / "work" / "c.docx") is None
+
+        old = time.time() - 10 * 86400
+        os.utime(store.path(sha), (old, old))
+        assert store.cleanup(0) == 0
+        assert store.cleanup(7) == 1
+        assert not store.has(sha)
@@ -61,3 +61,17 @@ def test_lock_manager_claim_release():
         lm.release(key)
         assert lm.claim(key, "b3") is True
 
+
+
+def test_cache_put_by_builder_requires_the_lock():
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        cache, lm = CacheStore(db, Path(td)), LockManager(db)
+        assert lm.claim("k", "t1")
+        lm.release("k", "t1")  # e.g. cancel() released it
+        assert lm.claim("k", "t2")
+        assert not cache.put("k", "base", builder="t1")
+        assert cache.get("k") is None
+        assert cache.put("k", "base", builder="t2")
+        assert cache.get("k")["available"] == 1
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from app.core.cache import CacheStore, LockManager
+from app.core.cleanup import _cleanup_caches, _cleanup_old_jobs, fail_interrupted_tasks
+from app.core.config import Config
+from app.core.db import Database
+
+
+def _cfg(root: Path) -> Config:
+    os.environ["DATA_ROOT"] = str(root / "data")
+    os.environ["LOG_DIR"] = str(root / "logs")
+    os.environ["WORK_ROOT"] = str(root / "work")
+    try:
+        return Config.from_env()
+    finally:
+        os.environ.pop("DATA_ROOT", None)
+        os.environ.pop("LOG_DIR", None)
+        os.environ.pop("WORK_ROOT", None)
+
+
+def test_cleanup_purges_only_expired_in_batches():
+    with tempfile.TemporaryDirectory() as td:
+        root = Path(td)
+        cfg = _cfg(root)
+        db = Database(root / "state.db")
+        db.init_schema()
+        cache = CacheStore(db, cfg.data_root)
+        old = time.time() - 30 * 86400
+        now = time.time()
+        with db.connect() as con:
+            for i in range(7):
+                con.execute(
+                    "INSERT INTO tasks(task_id,state,start_time,end_time,debug,img_post_proc,work_dir,created) VALUES(?,?,?,?,0,1,'',?)",
+                    (f"old{i}", "done" if i % 2 else "failed", old, old, old),
+                )
+            con.execute(
+                "INSERT INTO tasks(task_id,state,start_time,end_time,debug,img_post_proc,work_dir,created) VALUES('new','done',?,?,0,1,'',?)",
+                (now, now, now),
+            )
+            con.execute(
+                "INSERT INTO tasks(task_id,state,start_time,end_time,debug,img_post_proc,work_dir,created) VALUES('run','running',?,NULL,0,1,'',?)",
+                (old, old),
+            )
+            for i in range(5):
+                con.execute(
+                    "INSERT INTO caches(cache_key,basename,created,last_access,available) VALUES(?,?,?,?,1)",
+                    (f"c{i}", "b", old, old),
+                )
+            con.execute("INSERT INTO caches(cache_key,basename,created,last_access,available) VALUES('fresh','b',?,?,1)", (now, now))
+            con.execute("INSERT INTO locks(cache_key,builder,started) VALUES('stale','x',?)", (old,))
+            con.execute("INSERT INTO locks(cache_key,builder,started) VALUES('live','x',?)", (now,))
+            con.commit()
+        (cfg.data_root / "tasks" / "old0").mkdir(parents=True)
+        for tid in ("old0", "new"):
+            (cfg.public_root / tid).mkdir(parents=True)
+            (cfg.public_root / tid / "doc.zip").write_bytes(b"PK")
+
+        assert _cleanup_old_jobs(cfg, db, 7, batch=2) == 7
+        assert _cleanup_caches(cfg, db, cache, 7, batch=2) == 5
+        assert LockManager(db).cleanup(3600, batch=1) == 1
+
+        with db.connect() as con:
+            assert sorted(r[0] for r in con.execute("SELECT task_id FROM tasks")) == ["new", "run"]
+            assert [r[0] for r in con.execute("SELECT cache_key FROM caches")] == ["fresh"]
+            assert [r[0] for r in con.execute("SELECT cache_key FROM locks")] == ["live"]
+        assert not (cfg.data_root / "tasks" / "old0").exists()
+        assert not (cfg.public_root / "old0").exists() and (cfg.public_root / "new" / "doc.zip").exists()
+        db.close()
+
+
+def test_cleanup_batches_keeps_dirs_with_live_tasks():
+    from app.core.cleanup import _cleanup_batches
+
+    with tempfile.TemporaryDirectory() as td:
+        root = Path(td)
+        cfg = _cfg(root)
+        db = Database(root / "state.db")
+        db.init_schema()
+        old = time.time() - 30 * 86400
+        for bid in ("gone", "live", "fresh"):
+            (cfg.data_root / "batches" / bid / "shared").mkdir(parents=True)
+            if bid != "fresh":
+                os.utime(cfg.data_root / "batches" / bid, (old, old))
+        with db.connect() as con:
+            con.execute(
+                "INSERT INTO tasks(task_id,state,start_time,debug,img_post_proc,work_dir,created,batch_id) VALUES('t','done',?,0,1,'',?,'live')",
+                (old, old),
+            )
+            con.commit()
+        assert _cleanup_batches(cfg, db, 7) == 1
+        assert sorted(p.name for p in (cfg.data_root / "batches").iterdir()) == ["fresh", "live"]
+
+
+def test_fail_interrupted_tasks_clears_queue():
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        now = time.time()
+        with db.connect() as con:
+            for tid, state, key in (("q", "pending", 1.0), ("r", "converting", None), ("d", "done", None)):
+                con.execute(
+                    "INSERT INTO tasks(task_id,state,start_time,debug,img_post_proc,work_dir,created,queue_key) VALUES(?,?,?,0,1,'',?,?)",
+                    (tid, state, now, now, key),
+                )
+            con.commit()
+        assert fail_interrupted_tasks(db) == 2
+        with db.connect() as con:
+            rows = {r["task_id"]: r for r in con.execute("SELECT * FROM tasks").fetchall()}
+        assert rows["q"]["state"] == "failed" and rows["q"]["queue_key"] is None
+        assert rows["r"]["state"] == "failed" and rows["r"]["end_time"] is not None
+        assert rows["d"]["state"] == "done"
@@ -87,3 +87,12 @@ def test_config_overrides(monkeypatch=None):
         "LOCK_MAX_AGE_SEC",
     ]:
         os.environ.pop(k, None)
+
+
+def test_default_deadline_rejects_non_finite_values():
+    for raw, expected in (("inf", 0.0), ("nan", 0.0), ("-5", 0.0), ("90", 90.0)):
+        os.environ["DEFAULT_DEADLINE_SEC"] = raw
+        try:
+            assert Config.from_env().default_deadline_sec == expected, raw
+        finally:
+            os.environ.pop("DEFAULT_DEADLINE_SEC", None)
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import gc
+import tempfile
+import threading
+import weakref
+from pathlib import Path
+
+from app.core.db import Database, SCHEMA_VERSION
+
+
+def test_connect_reuses_connection_per_thread():
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        con = db.connect()
+        assert db.connect() is con
+
+        other: list = []
+        t = threading.Thread(target=lambda: other.append(db.connect()))
+        t.start()
+        t.join()
+        assert other and other[0] is not con
+
+        # a failed statement inside `with` must not poison the shared connection
+        try:
+            with db.connect() as c:
+                c.execute("INSERT INTO locks(cache_key,builder,started) VALUES('k','b',0)")
+                c.execute("INSERT INTO locks(cache_key,builder,started) VALUES('k','b',0)")
+        except Exception:
+            pass
+        with db.connect() as c:
+            assert c.execute("SELECT COUNT(*) FROM locks").fetchone()[0] == 0
+
+        db.close()
+        assert db.connect() is not con
+        db.close()
+
+
+def test_connections_of_exited_threads_are_released():
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        opened: list = []
+
+        def work():
+            con = db.connect()
+            con.execute("SELECT 1")
+            opened.append(weakref.ref(con))
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        gc.collect()
+        assert all(ref() is None for ref in opened)
+        assert list(db._all) == [db.connect()]
+        db.close()
+
+
+def test_migrations_create_indexes_used_by_cleanup():
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        assert db.schema_version() == SCHEMA_VERSION
+        # idempotent
+        db.init_schema()
+        assert db.migrate() == SCHEMA_VERSION
+
+        with db.connect() as con:
+            plans = {
+                "tasks": "SELECT task_id FROM tasks WHERE state='done' AND end_time < 1 LIMIT 5",
+                "caches": "SELECT cache_key FROM caches WHERE last_access < 1 ORDER BY last_access LIMIT 5",
+                "locks": "SELECT cache_key FROM locks WHERE started < 1 LIMIT 5",
+            }
+            for table, sql in plans.items():
+                detail = " ".join(r["detail"] for r in con.execute("EXPLAIN QUERY PLAN " + sql))
+                assert "USING INDEX" in detail or "USING COVERING INDEX" in detail, (table, detail)
+        db.close()
+
+
+def test_busy_statements_are_retried_and_counted():
+    from app.core import metrics
+
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        con = db.connect()
+        con.execute("PRAGMA busy_timeout=0")
+        holder = db._open()
+        holder.execute("BEGIN IMMEDIATE")
+        holder.execute("INSERT INTO locks(cache_key,builder,started) VALUES('a','b',0)")
+        release = threading.Timer(0.08, holder.commit)
+        release.start()
+        key = ("docx2tex_sqlite_busy_retries_total", ())
+        before = metrics.REGISTRY.collect()["counters"].get(key, 0)
+        with con:
+            con.execute("INSERT INTO locks(cache_key,builder,started) VALUES('c','d',0)")
+        release.join()
+        assert metrics.REGISTRY.collect()["counters"].get(key, 0) > before
+        with db.connect() as c:
+            assert c.execute("SELECT COUNT(*) FROM locks").fetchone()[0] == 2
+        holder.close()
+        db.close()
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from app.core.imageopt import optimize_raster_images
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def test_optimize_downscales_converts_and_caches():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        imgdir = td / "image"
+        imgdir.mkdir()
+        # 2000px wide PNG shown at 1in -> at most 100px at 100 dpi
+        Image.new("RGB", (2000, 1000), (200, 10, 10)).save(imgdir / "big.png")
+        Image.new("RGB", (50, 50), (0, 0, 255)).save(imgdir / "shot.bmp")
+        tex = td / "doc.tex"
+        tex.write_text(
+            "\\includegraphics[width=1in]{image/big.png}\n"
+            "\\includegraphics{image/shot.bmp}\n",
+            encoding="utf-8",
+        )
+        cache = td / "cache"
+
+        stats = optimize_raster_images(tex, imgdir, max_dpi=100, cache_dir=cache)
+        assert stats["failed"] == 0
+        assert stats["converted"] == 1
+        assert stats["bytes_after"] < stats["bytes_before"]
+        with Image.open(imgdir / "big.png") as im:
+            assert im.width == 100 and im.height == 50
+        assert not (imgdir / "shot.bmp").exists()
+        assert (imgdir / "shot.png").exists()
+        assert "{image/shot.png}" in tex.read_text(encoding="utf-8")
+
+        # same inputs again are served from the hash cache
+        Image.new("RGB", (2000, 1000), (200, 10, 10)).save(imgdir / "big.png")
+        stats2 = optimize_raster_images(tex, imgdir, max_dpi=100, cache_dir=cache)
+        assert stats2["cache_hits"] == 1
+        with Image.open(imgdir / "big.png") as im:
+            assert im.width == 100
+
+
+def test_same_stem_images_optimize_in_parallel_without_leftovers():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        imgdir = td / "image"
+        imgdir.mkdir()
+        # a.bmp becomes a_1.png; both share the stem of a.png
+        Image.new("RGB", (400, 200), (200, 10, 10)).save(imgdir / "a.png")
+        Image.new("RGB", (300, 300), (0, 0, 255)).save(imgdir / "a.bmp")
+        tex = td / "doc.tex"
+        tex.write_text("\\includegraphics{image/a.png}\n\\includegraphics{image/a.bmp}\n", encoding="utf-8")
+        cache = td / "cache"
+
+        stats = optimize_raster_images(tex, imgdir, workers=2, cache_dir=cache)
+        assert stats["failed"] == 0 and stats["converted"] == 1
+        assert sorted(p.name for p in imgdir.iterdir()) == ["a.png", "a_1.png"]
+        with Image.open(imgdir / "a_1.png") as im:
+            assert im.size == (300, 300)
+        assert not [p for p in cache.rglob(".*")]
@@ -0,0 +1,456 @@
+from __future__ import annotations
+
+import io
+import os
+import tempfile
+from pathlib import Path
+from zipfile import ZipFile
+
+from app.core.cache import CacheStore, LockManager
+from app.core.config import Config
+from app.core.db import Database
+from app.core.jvm import DocxStats
+from app.core.tasks import TaskStore
+from app.services.job_manager import JobManager
+
+# Stand-in for calabash.sh: writes the requested result/hub outputs and a
+# debug artifact, so _process_job can run end to end without Java.
+FAKE_CALABASH = r"""#!/bin/sh
+for a in "$@"; do
+  case "$a" in
+    result=file://*) tex="${a#result=file://}" ;;
+    hub=file://*) hub="${a#hub=file://}" ;;
+    debug-dir-uri=file://*) dbg="${a#debug-dir-uri=file://}" ;;
+  esac
+done
+printf '\\documentclass{article}\n\\includegraphics[width=1\\textwidth]{media/a.png}\n' > "$tex"
+printf '<hub/>' > "$hub"
+mkdir -p "$dbg" && printf 'trace' > "$dbg/trace.txt"
+echo calabash-ok
+"""
+
+
+def make_env(td: Path, **env: str) -> Config:
+    d2t = td / "d2t"
+    (d2t / "calabash").mkdir(parents=True)
+    script = d2t / "calabash" / "calabash.sh"
+    script.write_text(FAKE_CALABASH, encoding="utf-8")
+    script.chmod(0o755)
+    values = {
+        "DATA_ROOT": str(td / "data"),
+        "WORK_ROOT": str(td / "work"),
+        "LOG_DIR": str(td / "logs"),
+        "DOCX2TEX_HOME": str(d2t),
+        **env,
+    }
+    old = {k: os.environ.get(k) for k in values}
+    os.environ.update(values)
+    try:
+        return Config.from_env()
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def make_manager(cfg: Config) -> JobManager:
+    cfg.log_dir.mkdir(parents=True, exist_ok=True)  # done by server startup
+    db = Database(cfg.db_path)
+    db.init_schema()
+    return JobManager(cfg, TaskStore(db), CacheStore(db, cfg.data_root), LockManager(db), workers=1)
+
+
+def run_job(jm: JobManager, debug: bool, **kwargs):
+    js = jm.create(debug=debug, img_post_proc=False)
+    work = Path(js.work_dir)
+    (work / "doc.docx").write_bytes(b"FAKE-DOCX")
+    (work / "media").mkdir()
+    (work / "media" / "a.png").write_bytes(b"\x89PNG\r\n\x1a\n")
+    conf = work / "conf.xml"
+    conf.write_text("<set/>", encoding="utf-8")
+    jm._process_job(
+        task_id=js.task_id,
+        source_kind="file",
+        source_value="doc.docx",
+        debug=debug,
+        img_post_proc=False,
+        conf_file=conf,
+        custom_xsl=None,
+        custom_evolve=None,
+        no_cache=True,
+        **kwargs,
+    )
+    return jm.get(js.task_id)
+
+
+def test_process_job_release_package():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm = make_manager(cfg)
+        js = run_job(jm, debug=False)
+        assert js.state == "done", js.err_msg
+        assert js.result_mode == "zip" and js.result_sha256
+        assert Path(js.result_path) == cfg.public_root / js.task_id / "doc.zip"
+        with ZipFile(js.result_path) as zf:
+            assert set(zf.namelist()) == {"doc.tex", "image/a.png", "manifest.json"}
+        # a second task for a document with the same name gets its own file
+        other = run_job(jm, debug=False)
+        assert other.result_path != js.result_path and Path(js.result_path).is_file()
+
+
+def test_process_job_debug_stream_mode_writes_no_zip():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td), DEBUG_RESULT_MODE="stream")
+        jm = make_manager(cfg)
+        js = run_job(jm, debug=True)
+        assert js.state == "done", js.err_msg
+        assert js.result_mode == "stream"
+        assert not (cfg.public_root / "doc.zip").exists()
+
+        from app.core.package import load_entries, stream_zip
+
+        spec = load_entries(Path(js.work_dir))
+        zf = ZipFile(io.BytesIO(b"".join(stream_zip([(a, Path(s)) for a, s in spec["entries"]], spec["manifest"]))))
+        assert "doc.debug/trace.txt" in zf.namelist()
+        assert "manifest.json" in zf.namelist()
+
+
+def test_repackage_reuses_outputs_without_calabash():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm = make_manager(cfg)
+        src = run_job(jm, debug=True)
+        assert src.state == "done", src.err_msg
+        src_work = Path(src.work_dir)
+        assert (src_work / "doc.tex.orig").exists()
+        (src_work / "doc.docx.tmp" / "media").mkdir(parents=True)
+        (src_work / "doc.docx.tmp" / "media" / "a.png").write_bytes(b"\x89PNG\r\n\x1a\n")
+        # Any further converter run would fail the task
+        (cfg.docx2tex_home / "calabash" / "calabash.sh").write_text("#!/bin/sh\nexit 1\n", encoding="utf-8")
+
+        js = jm.create(debug=False, img_post_proc=False)
+        jm._process_job(
+            task_id=js.task_id,
+            source_kind="file",
+            source_value="doc.docx",
+            debug=False,
+            img_post_proc=False,
+            conf_file=None,
+            custom_xsl=None,
+            custom_evolve=None,
+            no_cache=True,
+            image_dir="figs",
+            reuse_from=src.task_id,
+        )
+        js = jm.get(js.task_id)
+        assert js.state == "done", js.err_msg
+        with ZipFile(js.result_path) as zf:
+            assert set(zf.namelist()) == {"doc.tex", "figs/a.png", "manifest.json"}
+            assert "{figs/a.png}" in zf.read("doc.tex").decode("utf-8")
+        # the source task's files are untouched
+        assert "{media/a.png}" in (src_work / "doc.tex.orig").read_text(encoding="utf-8")
+        assert not (src_work / "figs").exists()
+
+
+def test_repackage_fails_when_source_outputs_are_gone():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm = make_manager(cfg)
+        src = jm.create(debug=False, img_post_proc=False)
+        js = jm.create(debug=False, img_post_proc=False)
+        jm._process_job(
+            task_id=js.task_id,
+            source_kind="file",
+            source_value="doc.docx",
+            debug=False,
+            img_post_proc=False,
+            conf_file=None,
+            custom_xsl=None,
+            custom_evolve=None,
+            reuse_from=src.task_id,
+        )
+        js = jm.get(js.task_id)
+        assert js.state == "failed"
+        assert "no longer available" in js.err_msg
+
+
+def test_process_job_records_stage_timeline():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm = make_manager(cfg)
+        js = run_job(jm, debug=False)
+        stages = jm.tasks.stages(js.task_id)
+        names = [s["stage"] for s in stages]
+        assert names == ["hashing", "calabash", "image_collection", "zip"]
+        assert stages[1]["detail"]["rc"] == 0
+        usage = stages[1]["detail"]["usage"]
+        assert usage["max_rss_kb"] > 0 and usage["cpu_user_sec"] >= 0
+        assert stages[1]["detail"]["jvm"] == {"xmx_mb": 256, "xss": "4m", "gc": "SerialGC"}
+        assert "-Xmx256m" in (cfg.log_dir / f"{js.task_id}.log").read_text()
+        assert stages[2]["detail"]["collected"] == 1
+        assert all(s["duration"] >= 0 for s in stages)
+
+        jm.tasks.add_stage(js.task_id, "queue_wait", js.start_time - 1, 0.5)
+        assert jm.tasks.stages(js.task_id)[0]["stage"] == "queue_wait"
+
+
+def test_heap_stats_use_preflight_figures():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm = make_manager(cfg)
+        js = jm.create(debug=False, img_post_proc=False)
+        docx = Path(js.work_dir) / "doc.docx"
+        with ZipFile(docx, "w") as zf:
+            zf.writestr("word/document.xml", "<w:document/>")
+            zf.writestr("word/media/image1.png", b"\x89PNG" + b"\x00" * 96)
+        # no pre-flight recorded: the archive is analyzed on demand
+        assert jm._heap_stats(jm.get(js.task_id), docx) == DocxStats(document_xml_bytes=13, media_count=1, media_bytes=100)
+
+        jm.tasks.set_estimate(js.task_id, 5.0, document_xml_bytes=64 << 20, media_bytes=1 << 20)
+        js = jm.get(js.task_id)
+        assert (js.document_xml_bytes, js.media_bytes) == (64 << 20, 1 << 20)
+        assert jm._heap_stats(js, docx) == DocxStats(document_xml_bytes=64 << 20, media_bytes=1 << 20)
+
+
+def test_queue_key_orders_by_estimate_priority_and_age():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm = make_manager(cfg)
+        small = jm.create(debug=False, img_post_proc=False)
+        big = jm.create(debug=False, img_post_proc=False)
+        jm.tasks.set_estimate(small.task_id, 4.0)
+        jm.tasks.set_estimate(big.task_id, 400.0)
+        now = 1_000_000.0
+        assert jm.queue_key(small.task_id, 0, now) < jm.queue_key(big.task_id, 0, now)
+        # an explicit priority outweighs the size difference
+        assert jm.queue_key(big.task_id, 10, now) < jm.queue_key(small.task_id, 0, now)
+        # after waiting long enough the large job runs before new small ones
+        assert jm.queue_key(big.task_id, 0, now) < jm.queue_key(small.task_id, 0, now + 400)
+
+        jm.tasks.set_queue_key(small.task_id, 10.0)
+        jm.tasks.set_queue_key(big.task_id, 5.0)
+        assert jm.tasks.queue_position(big.task_id) == 1
+        assert jm.tasks.queue_position(small.task_id) == 2
+        jm.tasks.set_queue_key(big.task_id, None)
+        assert jm.tasks.queue_position(big.task_id) is None
+        assert jm.tasks.queue_position(small.task_id) == 1
+
+
+def test_admission_limits_and_retry_after_from_throughput():
+    import dataclasses
+    import time
+
+    import pytest
+
+    from app.services.job_manager import QueueFull
+
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td), QUEUE_MAX_JOBS="2", QUEUE_MAX_BYTES="1000")
+        jm = make_manager(cfg)
+        queued = [jm.create(debug=False, img_post_proc=False) for _ in range(2)]
+        jm.tasks.set_queue_key(queued[0].task_id, 1.0, 600)
+        jm.admit(input_bytes=300)
+        with pytest.raises(QueueFull) as e:
+            jm.admit(input_bytes=500)
+        assert e.value.reason == "bytes"
+        jm.tasks.set_queue_key(queued[1].task_id, 2.0, 10)
+        assert jm.queue_load()["saturated"]
+        with pytest.raises(QueueFull) as e:
+            jm.admit()
+        assert e.value.reason == "jobs"
+        # nothing finished yet: one default-sized job per slot
+        assert e.value.retry_after == 3
+
+        # 60 jobs finished in the last ten minutes -> one slot frees every 10 s
+        for i in range(60):
+            js = jm.create(debug=False, img_post_proc=False)
+            jm.tasks.set_queue_key(js.task_id, None, 100)
+            jm.set_state(js.task_id, "done")
+        assert jm.retry_after(1) == 10
+        assert jm.retry_after(3) == 30
+        # bytes drain at 60*100 B per 600 s
+        assert jm.retry_after(1, 500) == 50
+
+        # a large document still enters an empty queue
+        jm.cfg = dataclasses.replace(cfg, queue_max_jobs=0)
+        for js in queued:
+            jm.tasks.set_queue_key(js.task_id, None)
+        jm.admit(input_bytes=10_000)
+        assert not jm.queue_load()["saturated"]
+
+
+def _job_kwargs(jm: JobManager, js, **extra) -> dict:
+    work = Path(js.work_dir)
+    (work / "doc.docx").write_bytes(b"FAKE-DOCX")
+    conf = work / "conf.xml"
+    conf.write_text("<set/>", encoding="utf-8")
+    return dict(
+        task_id=js.task_id,
+        source_kind="file",
+        source_value="doc.docx",
+        debug=False,
+        img_post_proc=False,
+        conf_file=conf,
+        custom_xsl=None,
+        custom_evolve=None,
+        **extra,
+    )
+
+
+def test_cancel_from_another_worker_stops_running_calabash():
+    import threading
+    import time
+
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td), JVM_HEAP_POLICY="off")
+        (cfg.docx2tex_home / "calabash" / "calabash.sh").write_text("#!/bin/sh\nsleep 30 &\nwait\n", encoding="utf-8")
+        jm, other = make_manager(cfg), make_manager(cfg)
+        js = jm.create(debug=False, img_post_proc=False)
+        kwargs = _job_kwargs(jm, js, job_cache_key="key-cancel")
+        t = threading.Thread(target=jm._process_job, kwargs=kwargs)
+        t.start()
+        deadline = time.monotonic() + 10
+        while jm.get(js.task_id).state != "converting" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert jm.locks.get("key-cancel")["builder"] == js.task_id
+
+        t0 = time.monotonic()
+        assert other.cancel(js.task_id)
+        assert jm.locks.get("key-cancel") is None
+        assert not Path(js.work_dir).exists()
+        t.join(15)
+        assert not t.is_alive() and time.monotonic() - t0 < 10
+        state = jm.get(js.task_id)
+        assert state.state == "cancelled" and state.err_msg == "cancelled by client"
+        assert "task_stopped: cancelled" in (cfg.log_dir / f"{js.task_id}.log").read_text()
+        assert not other.cancel(js.task_id)
+
+
+def test_cancel_queued_tasks_locally_and_across_workers():
+    import threading
+    import time
+
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm, other = make_manager(cfg), make_manager(cfg)
+        gate, started = threading.Event(), threading.Event()
+        jm.pool.submit(float("-inf"), lambda: (started.set(), gate.wait(10)))
+        started.wait(5)
+        local = jm.create(debug=False, img_post_proc=False)
+        remote = jm.create(debug=False, img_post_proc=False)
+        jm.submit(**_job_kwargs(jm, local, no_cache=True))
+        jm.submit(**_job_kwargs(jm, remote, no_cache=True))
+        assert jm.pool.pending() == 2 and jm.queue_position(remote.task_id) == 2
+
+        assert jm.cancel(local.task_id)
+        assert jm.pool.pending() == 1 and jm.queue_position(local.task_id) is None
+        # cancelled through another worker: skipped when popped, never run
+        assert other.cancel(remote.task_id)
+        assert jm.tasks.queue_totals()[0] == 0
+        gate.set()
+        deadline = time.monotonic() + 5
+        while jm.pool.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)
+        for js in (local, remote):
+            assert jm.get(js.task_id).state == "cancelled"
+            assert [s["stage"] for s in jm.tasks.stages(js.task_id)] == []
+            assert not Path(js.work_dir).exists()
+        # later job writes cannot leave the cancelled state
+        jm.set_state(remote.task_id, "failed", "late")
+        assert jm.get(remote.task_id).state == "cancelled"
+
+
+def test_deadline_expires_queued_and_running_tasks():
+    import threading
+    import time
+
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td), JVM_HEAP_POLICY="off", DEFAULT_DEADLINE_SEC="600")
+        (cfg.docx2tex_home / "calabash" / "calabash.sh").write_text("#!/bin/sh\nsleep 30\n", encoding="utf-8")
+        jm = make_manager(cfg)
+        js = jm.create(debug=False, img_post_proc=False)
+        assert js.deadline is not None and 599 < js.deadline - js.start_time <= 600
+        assert jm.create(debug=False, img_post_proc=False, deadline_sec=0).deadline is None
+
+        # dropped before starting once the queue wait used up the budget
+        gate, started = threading.Event(), threading.Event()
+        jm.pool.submit(float("-inf"), lambda: (started.set(), gate.wait(10)))
+        started.wait(5)
+        late = jm.create(debug=False, img_post_proc=False, deadline_sec=0.2)
+        jm.submit(**_job_kwargs(jm, late, no_cache=True))
+        time.sleep(0.4)
+        gate.set()
+        deadline = time.monotonic() + 5
+        while jm.get(late.task_id).state == "pending" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        state = jm.get(late.task_id)
+        assert state.state == "expired" and "in queue" in state.err_msg
+        assert [s["stage"] for s in jm.tasks.stages(late.task_id)] == ["queue_wait"]
+        assert not Path(late.work_dir).exists()
+
+        # the Calabash timeout is the remaining budget, not the fixed limit
+        running = jm.create(debug=False, img_post_proc=False, deadline_sec=1.5)
+        t0 = time.monotonic()
+        jm._process_job(**_job_kwargs(jm, running, job_cache_key="key-deadline"))
+        assert time.monotonic() - t0 < 10
+        state = jm.get(running.task_id)
+        assert state.state == "expired" and state.err_msg.startswith("deadline exceeded")
+        calabash = [s for s in jm.tasks.stages(running.task_id) if s["stage"] == "calabash"][0]
+        assert calabash["detail"]["rc"] == 124 and calabash["detail"]["timeout_sec"] <= 1.5
+        assert jm.locks.get("key-deadline") is None
+
+
+def test_queue_position_of_remote_tasks_reuses_db_ranks():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm = make_manager(cfg)
+        a = jm.create(debug=False, img_post_proc=False)
+        b = jm.create(debug=False, img_post_proc=False)
+        jm.tasks.set_queue_key(a.task_id, 2.0)
+        jm.tasks.set_queue_key(b.task_id, 1.0)
+        calls = []
+        ranks = jm.tasks.queue_ranks
+        jm.tasks.queue_ranks = lambda: calls.append(1) or ranks()  # type: ignore[assignment]
+
+        assert jm.queue_position(a.task_id) == 2
+        assert jm.queue_position(b.task_id) == 1
+        assert len(calls) == 1
+        jm._ranks_at -= 60
+        jm.tasks.set_queue_key(b.task_id, None)
+        assert jm.queue_position(a.task_id) == 1 and len(calls) == 2
+
+
+def test_cancel_between_calabash_and_publish_leaves_no_cache_entry():
+    with tempfile.TemporaryDirectory() as td:
+        cfg = make_env(Path(td))
+        jm, other = make_manager(cfg), make_manager(cfg)
+        js = jm.create(debug=False, img_post_proc=False)
+        work = Path(js.work_dir)
+        (work / "doc.docx").write_bytes(b"FAKE-DOCX")
+        save = jm.cache.save_to_disk
+
+        def cancel_then_save(key, basename, src):
+            # cancel lands after Calabash succeeded, inside the cancel poll window
+            assert other.cancel(js.task_id)
+            save(key, basename, src)
+
+        jm.cache.save_to_disk = cancel_then_save  # type: ignore[assignment]
+        jm._process_job(
+            task_id=js.task_id,
+            source_kind="file",
+            source_value="doc.docx",
+            debug=False,
+            img_post_proc=False,
+            conf_file=None,
+            custom_xsl=None,
+            custom_evolve=None,
+            job_cache_key="k-cancel",
+        )
+        assert jm.get(js.task_id).state == "cancelled"
+        assert jm.cache.get("k-cancel") is None
+        assert not jm.cache.cache_dir("k-cancel").exists()
+        assert jm.locks.get("k-cancel") is None
+        assert "cache_publish_skipped key=k-cancel" in (cfg.log_dir / f"{js.task_id}.log").read_text()
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import zipfile
+from pathlib import Path
+
+from app.core.jvm import DocxStats, HeapPolicy, docx_stats, java_tool_options
+from app.core.preflight import analyze_docx
+
+MIB = 1024 * 1024
+
+
+def test_docx_stats_from_preflight_report(tmp_path: Path):
+    p = tmp_path / "a.docx"
+    with zipfile.ZipFile(p, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("word/document.xml", "<w:document>" + " " * 100000 + "</w:document>")
+        zf.writestr("word/media/image1.png", b"\x89PNG" + b"\x00" * 1000)
+        zf.writestr("word/media/image2.emf", b"\x00" * 500)
+    st = docx_stats(analyze_docx(p))
+    assert st.document_xml_bytes == 100025
+    assert (st.media_count, st.media_bytes) == (2, 1504)
+
+    bad = tmp_path / "bad.docx"
+    bad.write_bytes(b"not a zip")
+    assert docx_stats(analyze_docx(bad)) == DocxStats()
+
+
+def test_heap_policy_scales_and_clamps():
+    policy = HeapPolicy(min_mb=256, max_mb=2048)
+    small = policy.options(DocxStats(document_xml_bytes=100 * 1024))
+    assert small == {"xmx_mb": 256, "xss": "4m", "gc": "SerialGC"}
+    mid = policy.options(DocxStats(document_xml_bytes=60 * MIB))
+    assert 1024 < mid["xmx_mb"] <= 2048 and mid["xmx_mb"] % 64 == 0
+    assert mid["gc"] == "ParallelGC" and mid["xss"] == "16m"
+    assert policy.heap_mb(DocxStats(document_xml_bytes=1024 * MIB)) == 2048
+
+
+def test_calibrate_fits_p90_ratio():
+    policy = HeapPolicy()
+    assert policy.calibrate([(10 * MIB, 400 * MIB)]) is policy  # too few samples
+    samples = [(10 * MIB, (192 + 10 * r) * MIB) for r in (5, 6, 7, 8, 20)] + [(1000, 900 * MIB)]
+    fitted = policy.calibrate(samples)
+    assert fitted.xml_factor == 20.0
+    assert HeapPolicy().calibrate([(10 * MIB, 10_000 * MIB)] * 5).xml_factor == 40.0
+
+
+def test_java_tool_options_keep_operator_flags():
+    opts = {"xmx_mb": 512, "xss": "4m", "gc": "SerialGC"}
+    assert java_tool_options("", opts) == "-Xmx512m -Xss4m -XX:+UseSerialGC"
+    assert java_tool_options("-Xmx8g -XX:+UseG1GC", opts) == "-Xmx8g -XX:+UseG1GC -Xss4m"
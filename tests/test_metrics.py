@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from app.core.metrics import Registry, merge, render
+
+
+def test_render_counters_gauges_and_histograms():
+    reg = Registry()
+    reg.inc("docx2tex_cache_requests_total", status="HIT")
+    reg.inc("docx2tex_cache_requests_total", status="HIT")
+    reg.inc("docx2tex_upload_bytes_total", 1024, kind="multipart")
+    reg.gauge_add("docx2tex_queue_depth", 2, pool="jobs")
+    reg.observe("docx2tex_stage_duration_seconds", 0.2, stage="calabash")
+    reg.observe("docx2tex_stage_duration_seconds", 7.0, stage="calabash")
+    reg.inc("not_a_declared_metric")
+
+    text = render(merge([reg.snapshot()]), {"docx2tex_cache_entries": 3})
+    lines = text.splitlines()
+    assert "# TYPE docx2tex_stage_duration_seconds histogram" in lines
+    assert 'docx2tex_cache_requests_total{status="HIT"} 2' in lines
+    assert 'docx2tex_upload_bytes_total{kind="multipart"} 1024' in lines
+    assert 'docx2tex_queue_depth{pool="jobs"} 2' in lines
+    assert "docx2tex_cache_entries 3" in lines
+    assert 'docx2tex_stage_duration_seconds_bucket{stage="calabash",le="0.25"} 1' in lines
+    assert 'docx2tex_stage_duration_seconds_bucket{stage="calabash",le="10"} 2' in lines
+    assert 'docx2tex_stage_duration_seconds_bucket{stage="calabash",le="+Inf"} 2' in lines
+    assert 'docx2tex_stage_duration_seconds_count{stage="calabash"} 2' in lines
+    assert "not_a_declared_metric" not in text
+    buckets = [l for l in lines if l.startswith("docx2tex_stage_duration_seconds_bucket")]
+    assert buckets[-1].endswith('le="+Inf"} 2')
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_collect_merges_snapshots_of_other_workers():
+    with tempfile.TemporaryDirectory() as td:
+        d = Path(td)
+        reg = Registry()
+        reg.start_flusher(d, interval_sec=3600)
+        reg.inc("docx2tex_calabash_runs_total", rc=0)
+        reg.gauge_add("docx2tex_jobs_running", 1, pool="jobs")
+
+        pid = os.fork()
+        if pid == 0:  # exited worker: counters persist, gauges do not
+            try:
+                reg.reset()
+                reg.inc("docx2tex_calabash_runs_total", 2, rc=0)
+                reg.gauge_add("docx2tex_jobs_running", 5, pool="jobs")
+                reg.dump()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        # A live worker's snapshot contributes gauges as well
+        live = Registry()
+        live.inc("docx2tex_calabash_runs_total", rc=1)
+        live.gauge_add("docx2tex_jobs_running", 1, pool="jobs")
+        snap = {**live.snapshot(), "pid": os.getppid()}
+        (d / f"{os.getppid()}-live.json").write_text(json.dumps(snap))
+
+        merged = reg.collect()
+        assert merged["counters"][("docx2tex_calabash_runs_total", (("rc", "0"),))] == 3
+        assert merged["counters"][("docx2tex_calabash_runs_total", (("rc", "1"),))] == 1
+        assert merged["gauges"][("docx2tex_jobs_running", (("pool", "jobs"),))] == 2
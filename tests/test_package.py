@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import io
+import json
+import tempfile
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from app.core.package import ZipPolicy, debug_entries, load_entries, save_entries, stream_zip, write_zip
+
+
+def test_stream_zip_matches_materialized_zip():
+    with tempfile.TemporaryDirectory() as td:
+        work = Path(td)
+        (work / "doc.tex").write_text("\\documentclass{article}", encoding="utf-8")
+        (work / "doc.xml").write_text("<hub/>", encoding="utf-8")
+        dbg = work / "doc.debug" / "sub"
+        dbg.mkdir(parents=True)
+        (dbg / "big.bin").write_bytes(b"\x00\x01" * (3 * 1024 * 1024))
+        log = work / "t.log"
+        log.write_text("log", encoding="utf-8")
+
+        entries = debug_entries(work, "doc", log)
+        manifest = {"files": [a for a, _ in entries]}
+        save_entries(work, "doc", entries, manifest)
+        spec = load_entries(work)
+        assert spec and spec["basename"] == "doc"
+
+        chunks = list(stream_zip([(a, Path(s)) for a, s in spec["entries"]], spec["manifest"]))
+        assert len(chunks) > 1
+        streamed = ZipFile(io.BytesIO(b"".join(chunks)))
+        assert streamed.testzip() is None
+
+        write_zip(work / "out.zip", entries, manifest)
+        with ZipFile(work / "out.zip") as materialized:
+            assert sorted(streamed.namelist()) == sorted(materialized.namelist())
+            for name in materialized.namelist():
+                if name != "manifest.json":  # materialized one adds packaging stats
+                    assert streamed.read(name) == materialized.read(name)
+        assert "logs/t.log" in streamed.namelist()
+        assert json.loads(streamed.read("manifest.json"))["files"] == manifest["files"]
+
+
+def test_write_zip_policy_stores_media_and_records_stats():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        files = []
+        for i in range(6):
+            p = td / f"part{i}.xml"
+            p.write_bytes((b"<para>text %d</para>\n" % i) * 40000)
+            files.append((p.name, p))
+        png = td / "fig.png"
+        png.write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 100)
+        files.append((f"image/{png.name}", png))
+
+        manifest: dict = {}
+        out = td / "out.zip"
+        stats = write_zip(out, files, manifest, ZipPolicy(deflate_level=1))
+        assert stats["stored"] == 1 and stats["entries"] == 7
+        assert 0 < stats["ratio"] < 1
+        with ZipFile(out) as zf:
+            assert zf.testzip() is None
+            assert zf.getinfo("image/fig.png").compress_type == ZIP_STORED
+            assert zf.getinfo("part0.xml").compress_type == ZIP_DEFLATED
+            for arc, src in files:
+                assert zf.read(arc) == src.read_bytes()
+            assert json.loads(zf.read("manifest.json"))["packaging"]["ratio"] == stats["ratio"]
+            written = zf.getinfo("part0.xml").date_time
+
+        # streamed packages follow the same policy and keep file times
+        with ZipFile(io.BytesIO(b"".join(stream_zip(files, {}, ZipPolicy(deflate_level=1))))) as zf:
+            assert zf.testzip() is None
+            assert zf.getinfo("image/fig.png").compress_type == ZIP_STORED
+            assert zf.getinfo("part0.xml").compress_type == ZIP_DEFLATED
+            assert zf.getinfo("part0.xml").date_time == written
+            assert zf.read("part0.xml") == files[0][1].read_bytes()
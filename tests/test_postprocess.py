@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+import time
 from pathlib import Path
 import tempfile
 
 from app.core.postprocess import (
+    _convert_with_inkscape,
     release_collect_images_and_normalize,
     debug_comment_vsdx_and_normalize,
 )
@@ -42,6 +44,38 @@ def test_release_collect_images_rewrites_and_drops_vsdx():
         assert any(p.suffix.lower() == ".png" for p in (tex.parent / "image").iterdir())
 
 
+def test_release_collect_images_dedups_by_content():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        tex = td / "doc.tex"
+        media = td / "media"
+        media.mkdir(parents=True, exist_ok=True)
+        payload = b"\x89PNG\r\n\x1a\n" + b"x" * 100
+        (media / "a.png").write_bytes(payload)
+        (media / "b.png").write_bytes(payload)
+        (media / "c.png").write_bytes(b"\x89PNG\r\n\x1a\n" + b"y" * 10)
+        # name clash with a different content
+        (td / "other").mkdir()
+        (td / "other" / "c.png").write_bytes(b"\x89PNG\r\n\x1a\n" + b"z" * 10)
+        content = (
+            r"\includegraphics{media/a.png}\n"
+            + r"\includegraphics{media/b.png}\n"
+            + r"\includegraphics{media/c.png}\n"
+            + r"\includegraphics{other/c.png}\n"
+        )
+        _write(tex, content)
+
+        stats: dict = {}
+        ncol, _ = release_collect_images_and_normalize(tex, td / "image", stats=stats)
+        assert ncol == 3
+        assert stats == {"deduplicated": 1, "bytes_saved": len(payload)}
+        names = sorted(p.name for p in (td / "image").iterdir())
+        assert names == ["a.png", "c.png", "c_1.png"]
+        new_text = tex.read_text(encoding="utf-8")
+        assert new_text.count("{image/a.png}") == 2
+        assert "{image/c_1.png}" in new_text
+
+
 def test_debug_comment_vsdx_and_normalize_width():
     with tempfile.TemporaryDirectory() as td:
         td = Path(td)
@@ -59,3 +93,20 @@ def test_debug_comment_vsdx_and_normalize_width():
         # vsdx line is commented out
         assert "% \\includegraphics" in new_text or "shape.VSDX" in new_text and "%" in new_text.split("shape.VSDX")[0]
 
+
+def test_inkscape_conversion_timeout_is_explicit():
+    with tempfile.TemporaryDirectory() as td:
+        root = Path(td)
+        fake = root / "inkscape"
+        fake.write_text("#!/bin/sh\nexit 0\n", encoding="utf-8")
+        fake.chmod(0o755)
+        src, dst = root / "a.svg", root / "out" / "a.pdf"
+        src.write_text("<svg/>", encoding="utf-8")
+        assert _convert_with_inkscape([str(fake)], src, dst)
+
+        slow = root / "slow"
+        slow.write_text("#!/bin/sh\nsleep 30\n", encoding="utf-8")
+        slow.chmod(0o755)
+        t0 = time.monotonic()
+        assert not _convert_with_inkscape([str(slow)], src, dst, timeout=0.5)
+        assert time.monotonic() - t0 < 10
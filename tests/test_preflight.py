@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from app.core.preflight import CostModel, PreflightError, PreflightLimits, analyze_docx, poll_interval_sec
+
+
+def _docx(path: Path, body: str, extra: dict[str, bytes] | None = None) -> Path:
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", "<Types/>")
+        zf.writestr("word/document.xml", f"<w:document><w:body>{body}</w:body></w:document>")
+        for name, data in (extra or {}).items():
+            zf.writestr(name, data)
+    return path
+
+
+def test_analyze_counts_media_ole_tables_and_mathtype(tmp_path: Path):
+    body = "<w:tbl><w:tr/></w:tbl>" * 3 + '<o:OLEObject ProgID="Equation.DSMT4"/>' * 2
+    p = _docx(
+        tmp_path / "a.docx",
+        body,
+        {
+            "word/media/image1.emf": b"\x01" * 300,
+            "word/media/image2.png": b"\x02" * 200,
+            "word/media/image3.jpeg": b"\x03" * 100,
+            "word/embeddings/oleObject1.bin": b"\x00" * 50,
+        },
+    )
+    r = analyze_docx(p)
+    assert r["valid"] is True and r["entries"] == 6
+    assert r["media"]["vector"] == {"count": 1, "bytes": 300}
+    assert r["media"]["raster"] == {"count": 2, "bytes": 300}
+    assert r["ole_objects"] == 1
+    assert (r["tables"], r["mathtype_objects"]) == (3, 2)
+    assert r["counts_estimated"] is False
+
+    # Markers straddling scan chunks are counted once; truncated scans extrapolate
+    big = _docx(tmp_path / "big.docx", ("x" * 1000 + "<w:tbl>") * 600)
+    assert analyze_docx(big)["tables"] == 600
+    est = analyze_docx(big, PreflightLimits(scan_bytes=300 * 1007))
+    assert est["counts_estimated"] is True and 590 <= est["tables"] <= 610
+
+    cost = CostModel()
+    assert cost.estimate(r, img_post_proc=True) == cost.estimate(r, img_post_proc=False) + cost.per_vector_sec
+    assert poll_interval_sec(3.0) == 1.0 and poll_interval_sec(1000) == 30.0
+
+
+def test_non_zip_is_reported_not_rejected(tmp_path: Path):
+    p = tmp_path / "fake.docx"
+    p.write_bytes(b"FAKE-DOCX")
+    assert analyze_docx(p) == {"valid": False}
+
+
+def test_zip_bombs_are_rejected(tmp_path: Path):
+    p = tmp_path / "bomb.docx"
+    with zipfile.ZipFile(p, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("word/document.xml", "<w:document/>")
+        zf.writestr("word/media/huge.png", b"\x00" * (8 * 1024 * 1024))
+    with pytest.raises(PreflightError) as ei:
+        analyze_docx(p)
+    assert ei.value.status_code == 422 and "compression ratio" in ei.value.detail
+    with pytest.raises(PreflightError) as ei:
+        analyze_docx(p, PreflightLimits(max_uncompressed_bytes=1024 * 1024, max_ratio=1e9))
+    assert ei.value.status_code == 413
+    with pytest.raises(PreflightError):
+        analyze_docx(p, PreflightLimits(max_entries=1, max_ratio=1e9))
+    assert analyze_docx(p, PreflightLimits(max_ratio=1e9))["valid"] is True
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import sys
 
-from app.core.proc import run_subprocess
+from app.core.proc import merge_usage, run_subprocess
 
 
 def test_run_subprocess_python_ok():
@@ -10,3 +10,71 @@ def test_run_subprocess_python_ok():
     assert rc == 0
     assert "OK" in (out or "")
 
+
+
+def test_run_subprocess_reports_child_usage():
+    usage: dict = {}
+    code = "x = bytearray(32 * 1024 * 1024); sum(range(200000)); print(len(x))"
+    rc, out, _ = run_subprocess([sys.executable, "-c", code], timeout=30, usage=usage)
+    assert rc == 0 and out.strip() == str(32 * 1024 * 1024)
+    assert set(usage) == {"cpu_user_sec", "cpu_sys_sec", "max_rss_kb", "io_read_blocks", "io_write_blocks"}
+    assert usage["max_rss_kb"] >= 32 * 1024
+    assert usage["cpu_user_sec"] + usage["cpu_sys_sec"] > 0
+
+    total = merge_usage({}, usage)
+    merge_usage(total, {**usage, "max_rss_kb": 1})
+    assert total["max_rss_kb"] == usage["max_rss_kb"]
+    assert total["io_read_blocks"] == 2 * usage["io_read_blocks"]
+
+
+def test_run_subprocess_timeout_returns_124():
+    rc, _, _ = run_subprocess([sys.executable, "-c", "import time; time.sleep(5)"], timeout=0.2)
+    assert rc == 124
+
+
+def test_run_subprocess_streams_output_to_log(tmp_path):
+    log = tmp_path / "task.log"
+    log.write_bytes(b"header\n")
+    code = "import sys; print('x' * 5000); sys.stderr.write('e' * 3000 + 'END')"
+    rc, out, err = run_subprocess([sys.executable, "-c", code], timeout=30, log_path=log, tail_bytes=100)
+    assert rc == 0
+    data = log.read_bytes()
+    assert data.startswith(b"header\n")
+    assert b"x" * 5000 in data and b"e" * 3000 + b"END" in data
+    assert len(err) == 100 and err.endswith("END")
+    assert len(out) == 100
+
+
+def _alive(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_run_subprocess_cancel_kills_process_group(tmp_path):
+    import threading
+    import time
+
+    pidfile = tmp_path / "grandchild.pid"
+    script = f"sleep 30 & echo $! > {pidfile}; wait"
+    stop = threading.Event()
+    threading.Timer(0.3, stop.set).start()
+    t0 = time.monotonic()
+    rc, _, _ = run_subprocess(["sh", "-c", script], timeout=30, cancel=stop.is_set, kill_grace_sec=2)
+    assert rc < 0 and time.monotonic() - t0 < 5
+    pid = int(pidfile.read_text())
+    deadline = time.monotonic() + 5
+    while _alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not _alive(pid)
+
+
+def test_run_subprocess_escalates_to_sigkill():
+    import time
+
+    t0 = time.monotonic()
+    rc, _, _ = run_subprocess(["sh", "-c", "trap '' TERM; sleep 30"], timeout=0.2, kill_grace_sec=0.5)
+    assert rc == 124
+    assert 0.5 <= time.monotonic() - t0 < 5
@@ -53,6 +53,7 @@ def test_task_lifecycle_with_stubbed_background_job():
         resp = client.get(f"/v1/task/{task_id}")
         assert resp.status_code == 200
         assert resp.json()["data"]["state"] in {"pending", "running"}
+        assert "queue_position" in resp.json()["data"]
         resp = client.get(f"/v1/task/{task_id}/result")
         assert resp.status_code == 409
 
@@ -70,9 +71,616 @@ def test_task_lifecycle_with_stubbed_background_job():
         resp = client.get(f"/v1/task/{task_id}")
         assert resp.status_code == 200
         assert resp.json()["data"]["state"] == "done"
+        # Unchanged status revalidates with 304
+        etag = resp.headers.get("etag")
+        assert etag
+        resp = client.get(f"/v1/task/{task_id}", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
 
         # Result available
         resp = client.get(f"/v1/task/{task_id}/result")
         assert resp.status_code == 200
         assert resp.headers.get("content-type") == "application/zip"
 
+
+
+def test_result_download_etag_and_range():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+        from app.core.storage import compute_sha256
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+
+        js = r.ctx.jobs.create(debug=False, img_post_proc=False)
+        out_zip = Path(r.ctx.cfg.public_root) / js.task_id / "doc.zip"
+        out_zip.parent.mkdir(parents=True, exist_ok=True)
+        out_zip.write_bytes(bytes(range(256)) * 4)
+        sha = compute_sha256(out_zip)
+        r.ctx.tasks.set_result(js.task_id, str(out_zip), sha, out_zip.stat().st_size)
+        r.ctx.tasks.set_state(js.task_id, "done")
+
+        resp = client.get(f"/v1/task/{js.task_id}/result")
+        assert resp.status_code == 200
+        assert resp.headers["etag"] == f'"{sha}"'
+        assert resp.headers["content-length"] == "1024"
+        assert resp.content == out_zip.read_bytes()
+
+        resp = client.get(f"/v1/task/{js.task_id}/result", headers={"If-None-Match": f'"{sha}"'})
+        assert resp.status_code == 304
+
+        resp = client.get(f"/v1/task/{js.task_id}/result", headers={"Range": "bytes=1000-"})
+        assert resp.status_code == 206
+        assert resp.content == out_zip.read_bytes()[1000:]
+        assert resp.headers["content-range"] == "bytes 1000-1023/1024"
+
+        # a result at a path shared with other tasks never gets the digest ETag
+        shared = Path(r.ctx.cfg.public_root) / "doc.zip"
+        shared.write_bytes(out_zip.read_bytes()[::-1])
+        r.ctx.tasks.set_result(js.task_id, str(shared), sha, shared.stat().st_size)
+        resp = client.get(f"/v1/task/{js.task_id}/result", headers={"If-None-Match": f'"{sha}"'})
+        assert resp.status_code == 200 and resp.headers["etag"] != f'"{sha}"'
+
+
+def test_per_file_listing_and_download():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+        from app.core.package import release_entries, save_entries
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+
+        js = r.ctx.jobs.create(debug=False, img_post_proc=False)
+        work = Path(js.work_dir)
+        tex_body = "\\documentclass{article}\n" + "text\n" * 2000
+        (work / "doc.tex").write_text(tex_body, encoding="utf-8")
+        (work / "image").mkdir()
+        (work / "image" / "a.png").write_bytes(b"\x89PNG\r\n\x1a\n")
+        entries = release_entries(work, "doc", "image")
+        save_entries(work, "doc", entries, {"files": [a for a, _ in entries]})
+
+        resp = client.get(f"/v1/task/{js.task_id}/files")
+        assert resp.status_code == 409
+        r.ctx.tasks.set_state(js.task_id, "done")
+
+        resp = client.get(f"/v1/task/{js.task_id}/files")
+        assert resp.status_code == 200
+        listing = {f["path"]: f for f in resp.json()["data"]["files"]}
+        assert set(listing) == {"doc.tex", "image/a.png", "manifest.json"}
+        assert listing["doc.tex"]["size"] == len(tex_body.encode("utf-8"))
+
+        resp = client.get(f"/v1/task/{js.task_id}/files/doc.tex", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["content-encoding"] == "gzip"
+        assert resp.text == tex_body
+        etag = resp.headers["etag"]
+        assert etag == f'"{listing["doc.tex"]["sha256"]}-gz"'
+        resp = client.get(
+            f"/v1/task/{js.task_id}/files/doc.tex",
+            headers={"Accept-Encoding": "gzip", "If-None-Match": etag},
+        )
+        assert resp.status_code == 304
+
+        resp = client.get(f"/v1/task/{js.task_id}/files/image/a.png", headers={"Accept-Encoding": "identity"})
+        assert resp.status_code == 200 and resp.content == b"\x89PNG\r\n\x1a\n"
+        assert "content-encoding" not in resp.headers
+
+        assert client.get(f"/v1/task/{js.task_id}/files/../state.db").status_code == 404
+
+
+def test_repackage_derives_new_task_from_saved_params():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+
+        submitted: list[dict] = []
+        r.ctx.jobs.pool.submit = lambda key, fn, queued_at, kwargs: submitted.append(kwargs)  # type: ignore[assignment]
+
+        assert client.post("/v1/task/nope/repackage").status_code == 404
+        js = r.ctx.jobs.create(debug=False, img_post_proc=True)
+        r.ctx.jobs.submit(
+            task_id=js.task_id,
+            source_kind="file",
+            source_value="doc.docx",
+            debug=False,
+            img_post_proc=True,
+            conf_file=Path(js.work_dir) / "conf.xml",
+            custom_xsl=None,
+            custom_evolve=None,
+            job_cache_key="k1",
+            image_dir="image",
+        )
+        assert client.post(f"/v1/task/{js.task_id}/repackage").status_code == 409
+        r.ctx.tasks.set_state(js.task_id, "done")
+
+        resp = client.post(f"/v1/task/{js.task_id}/repackage", data={"debug": "true", "image_dir": "figs"})
+        assert resp.status_code == 200
+        new_id = resp.json()["task_id"]
+        assert resp.json()["source_task_id"] == js.task_id
+        kw = submitted[-1]
+        assert kw["task_id"] == new_id and kw["reuse_from"] == js.task_id
+        assert kw["debug"] is True and kw["image_dir"] == "figs"
+        assert kw["img_post_proc"] is True and kw["job_cache_key"] == "k1"
+        assert r.ctx.jobs.get(new_id).debug is True
+
+
+def test_batch_submission_shares_inputs_and_aggregates():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+        from zipfile import ZipFile
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+
+        submitted: list[dict] = []
+        r.ctx.jobs.submit = lambda **kwargs: submitted.append(kwargs)  # type: ignore[assignment]
+
+        conf_xml = b"""<?xml version='1.0'?><set xmlns='http://transpect.io/xml2tex'/>"""
+        files = [
+            ("files", ("a.docx", b"DOCX-A", "application/octet-stream")),
+            ("files", ("b.docx", b"DOCX-B", "application/octet-stream")),
+            ("conf", ("conf.xml", conf_xml, "application/xml")),
+        ]
+        resp = client.post("/v1/batch", data={"debug": "false"}, files=files)
+        assert resp.status_code == 200
+        body = resp.json()
+        batch_id = body["batch_id"]
+        assert [t["source"] for t in body["tasks"]] == ["a.docx", "b.docx"]
+        # one shared conf, referenced by every task
+        assert {kw["conf_file"] for kw in submitted} == {submitted[0]["conf_file"]}
+        assert submitted[0]["conf_file"].parent.name == "shared"
+        # same key as a standalone submission would compute
+        work_a = Path(r.ctx.jobs.get(body["tasks"][0]["task_id"]).work_dir)
+        assert body["tasks"][0]["cache_key"] == r.compute_cache_key(
+            work_a / "a.docx", submitted[0]["conf_file"], None, None, None, None, None
+        )
+
+        resp = client.get(f"/v1/batch/{batch_id}")
+        assert resp.json()["data"]["counts"] == {"pending": 2}
+        assert client.get(f"/v1/batch/{batch_id}/result").status_code == 409
+
+        ids = [t["task_id"] for t in body["tasks"]]
+        zpath = td / "work" / "a.zip"
+        zpath.parent.mkdir(parents=True, exist_ok=True)
+        zpath.write_bytes(b"PK-A")
+        r.ctx.tasks.set_result(ids[0], str(zpath), "x", 4)
+        r.ctx.tasks.set_state(ids[0], "done")
+        r.ctx.tasks.set_state(ids[1], "failed", "boom")
+        data = client.get(f"/v1/batch/{batch_id}").json()["data"]
+        assert data["finished"] is True and data["counts"] == {"done": 1, "failed": 1}
+
+        resp = client.get(f"/v1/batch/{batch_id}/result")
+        assert resp.status_code == 200
+        zf = ZipFile(io.BytesIO(resp.content))
+        assert zf.read(f"{ids[0]}/a.zip") == b"PK-A"
+        assert "manifest.json" in zf.namelist()
+        assert client.get("/v1/batch/nope").status_code == 404
+
+
+def test_submit_by_digest_skips_upload():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import hashlib
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+        r.ctx.jobs.submit = lambda **kwargs: None  # type: ignore[assignment]
+
+        sha = hashlib.sha256(b"DIGEST-DOCX").hexdigest()
+        assert client.head(f"/v1/blobs/{sha}").status_code == 404
+        assert client.head("/v1/blobs/not-a-digest").status_code == 400
+        conf = ("conf.xml", b"<set/>", "application/xml")
+        resp = client.post("/v1/task", data={"docx_sha256": sha}, files={"conf": conf})
+        assert resp.status_code == 404
+
+        files = {"file": ("sample.docx", b"DIGEST-DOCX", "application/octet-stream"), "conf": conf}
+        first = client.post("/v1/task", files=files).json()
+        assert r.ctx.tasks._read(first["task_id"]).sha256 == sha
+        resp = client.head(f"/v1/blobs/{sha}")
+        assert resp.status_code == 200 and resp.headers["x-blob-size"] == "11"
+
+        resp = client.post("/v1/task", data={"docx_sha256": sha, "filename": "again.docx"}, files={"conf": conf})
+        assert resp.status_code == 200
+        second = resp.json()
+        assert second["cache_key"] == first["cache_key"]
+        work = Path(r.ctx.jobs.get(second["task_id"]).work_dir)
+        assert (work / "again.docx").read_bytes() == b"DIGEST-DOCX"
+
+        resp = client.post(
+            "/v1/task",
+            data={"docx_sha256": sha},
+            files={"file": ("x.docx", b"X", "application/octet-stream"), "conf": conf},
+        )
+        assert resp.status_code == 400
+
+
+def test_resumable_upload_finalize_creates_task():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import hashlib
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+        r.ctx.jobs.submit = lambda **kwargs: None  # type: ignore[assignment]
+
+        body = b"CHUNKED-DOCX-" * 1000
+        resp = client.post("/v1/uploads", data={"filename": "big.docx", "size": str(len(body))})
+        assert resp.status_code == 200
+        uid = resp.json()["upload_id"]
+
+        resp = client.put(f"/v1/uploads/{uid}?offset=0", content=body[:5000])
+        assert resp.json()["offset"] == 5000
+        resp = client.put(f"/v1/uploads/{uid}?offset=0", content=body[5000:])
+        assert resp.status_code == 409 and resp.headers["upload-offset"] == "5000"
+        assert client.get(f"/v1/uploads/{uid}").json()["offset"] == 5000
+        conf = ("conf.xml", b"<set/>", "application/xml")
+        assert client.post(f"/v1/uploads/{uid}/finalize", files={"conf": conf}).status_code == 409
+        client.put(f"/v1/uploads/{uid}?offset=5000", content=body[5000:])
+
+        sha = hashlib.sha256(body).hexdigest()
+        # a rejected submission keeps the upload so finalize can be retried
+        admit = r.ctx.jobs.admit
+
+        def queue_full(*args, **kwargs):
+            raise r.QueueFull("queue full", 5, "jobs")
+
+        r.ctx.jobs.admit = queue_full  # type: ignore[assignment]
+        resp = client.post(f"/v1/uploads/{uid}/finalize", data={"sha256": sha}, files={"conf": conf})
+        assert resp.status_code == 429
+        assert client.get(f"/v1/uploads/{uid}").json()["offset"] == len(body)
+        # the sealed session takes no more bytes, and the stored blob keeps its content
+        resp = client.put(f"/v1/uploads/{uid}?offset={len(body)}", content=b"EVIL")
+        assert resp.status_code == 409
+        assert r.ctx.blobs.path(sha).read_bytes() == body
+
+        r.ctx.jobs.admit = admit  # type: ignore[assignment]
+        resp = client.post(f"/v1/uploads/{uid}/finalize", data={"sha256": sha}, files={"conf": conf})
+        assert resp.status_code == 200, resp.text
+        task_id = resp.json()["task_id"]
+        work = Path(r.ctx.jobs.get(task_id).work_dir)
+        assert (work / "big.docx").read_bytes() == body
+        assert client.head(f"/v1/blobs/{sha}").status_code == 200
+        assert client.get(f"/v1/uploads/{uid}").status_code == 404
+
+
+def test_metrics_endpoint_reports_cache_and_upload_counters():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+        r.ctx.jobs.submit = lambda **kwargs: None  # type: ignore[assignment]
+
+        def value(text: str, series: str) -> float:
+            for line in text.splitlines():
+                if line.startswith(series + " "):
+                    return float(line.split()[-1])
+            return 0.0
+
+        before = client.get("/metrics").text
+        files = {
+            "file": ("m.docx", b"METRICS-DOCX", "application/octet-stream"),
+            "conf": ("conf.xml", b"<set/>", "application/xml"),
+        }
+        assert client.post("/v1/task", files=files).status_code == 200
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.headers["content-type"].startswith("text/plain")
+        after = resp.text
+        miss = 'docx2tex_cache_requests_total{status="MISS"}'
+        assert value(after, miss) == value(before, miss) + 1
+        up = 'docx2tex_upload_bytes_total{kind="multipart"}'
+        assert value(after, up) >= value(before, up) + len(b"METRICS-DOCX")
+        assert "docx2tex_cache_entries " in after
+        assert 'docx2tex_stage_duration_seconds_count{stage="hashing"}' in after
+
+
+def test_task_log_offset_and_follow():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import threading
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+        r.LOG_FOLLOW_POLL_SEC = 0.05
+
+        assert client.get("/v1/task/nope/log").status_code == 404
+        js = r.ctx.jobs.create(debug=False, img_post_proc=False)
+        r.ctx.tasks.set_state(js.task_id, "converting")
+        assert client.get(f"/v1/task/{js.task_id}/log").text == ""
+
+        log_path = r.ctx.cfg.log_dir / f"{js.task_id}.log"
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        log_path.write_bytes(b"--- calabash ---\nline 1\n")
+        assert client.get(f"/v1/task/{js.task_id}/log?offset=17").text == "line 1\n"
+
+        def finish():
+            with open(log_path, "ab") as f:
+                f.write(b"line 2\n")
+            r.ctx.tasks.set_state(js.task_id, "done")
+
+        timer = threading.Timer(0.3, finish)
+        timer.start()
+        resp = client.get(f"/v1/task/{js.task_id}/log?follow=1")
+        timer.join()
+        assert resp.status_code == 200
+        assert resp.text == "--- calabash ---\nline 1\nline 2\n"
+
+        # a task that never finishes does not hold the stream open forever
+        stuck = r.ctx.jobs.create(debug=False, img_post_proc=False)
+        r.ctx.tasks.set_state(stuck.task_id, "converting")
+        r.LOG_FOLLOW_MAX_SEC = 0.2
+        resp = client.get(f"/v1/task/{stuck.task_id}/log?follow=1")
+        assert resp.status_code == 200 and resp.text == ""
+
+
+def test_preflight_estimate_and_zip_bomb_rejection():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import zipfile
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+        r.ctx.jobs.submit = lambda **kwargs: None  # type: ignore[assignment]
+        conf = ("conf.xml", b"<set/>", "application/xml")
+
+        def docx(entries: dict[str, bytes]) -> bytes:
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr("word/document.xml", "<w:document><w:tbl></w:tbl></w:document>")
+                for name, data in entries.items():
+                    zf.writestr(name, data)
+            return buf.getvalue()
+
+        good = docx({"word/media/image1.emf": b"\x01" * 10})
+        resp = client.post("/v1/task", files={"file": ("pf.docx", good, "application/octet-stream"), "conf": conf})
+        assert resp.status_code == 200
+        pf = resp.json()["preflight"]
+        assert pf["valid"] and pf["tables"] == 1 and pf["media"]["vector"]["count"] == 1
+        assert pf["estimate_sec"] > 0 and pf["poll_interval_sec"] >= 1
+        status = client.get(f"/v1/task/{resp.json()['task_id']}").json()["data"]
+        assert status["est_seconds"] == pf["estimate_sec"]
+        assert status["deadline"] is None
+        assert any(s["stage"] == "preflight" for s in status["stages"])
+
+        bomb = docx({"word/media/zeros.png": b"\x00" * (16 * 1024 * 1024)})
+        resp = client.post("/v1/task", files={"file": ("bomb.docx", bomb, "application/octet-stream"), "conf": conf})
+        assert resp.status_code == 422
+        assert "compression ratio" in resp.json()["detail"]
+
+
+def test_queue_limit_returns_429_and_readyz_reports_saturation():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import dataclasses
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+        r.ctx.jobs.submit = lambda **kwargs: None  # type: ignore[assignment]
+        queued = r.ctx.tasks.queue_totals()[0]
+        r.ctx.jobs.cfg = dataclasses.replace(r.ctx.cfg, queue_max_jobs=queued + 1, queue_max_bytes=0)
+
+        resp = client.get("/readyz")
+        assert resp.status_code == 200 and resp.json()["status"] == "ready"
+
+        blocker = r.ctx.jobs.create(debug=False, img_post_proc=False)
+        r.ctx.tasks.set_queue_key(blocker.task_id, 1.0, 100)
+        files = {"file": ("busy.docx", b"FAKE-DOCX-429", "application/octet-stream"), "conf": ("conf.xml", b"<set/>", "application/xml")}
+        resp = client.post("/v1/task", files=files)
+        assert resp.status_code == 429
+        assert int(resp.headers["retry-after"]) >= 1
+        assert "queue full" in resp.json()["detail"]
+        resp = client.get("/readyz")
+        assert resp.status_code == 503
+        assert resp.json()["queue"]["saturated"] and "retry-after" in resp.headers
+        assert 'docx2tex_admission_rejected_total{reason="jobs"}' in client.get("/metrics").text
+
+        r.ctx.tasks.set_queue_key(blocker.task_id, None)
+        resp = client.post("/v1/task", files=files)
+        assert resp.status_code == 200
+
+
+def test_delete_task_cancels_and_is_idempotent():
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        os.environ["DOCX2TEX_HOME"] = str(td / "d2t")
+
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+        r.ctx.jobs.submit = lambda **kwargs: None  # type: ignore[assignment]
+        files = {"file": ("cancel.docx", b"FAKE-DOCX-CANCEL", "application/octet-stream"), "conf": ("conf.xml", b"<set/>", "application/xml")}
+
+        assert client.delete("/v1/task/does-not-exist").status_code == 404
+        for bad in ("-1", "inf", "1e309", "nan", str(8 * 86400)):
+            assert client.post("/v1/task", files=files, data={"deadline_sec": bad}).status_code == 400, bad
+        timed = client.post("/v1/task", files=files, data={"deadline_sec": "900"}).json()["task_id"]
+        status = client.get(f"/v1/task/{timed}").json()["data"]
+        assert status["deadline"] - status["start_time"] == pytest.approx(900)
+        task_id = client.post("/v1/task", files=files).json()["task_id"]
+        work = Path(r.ctx.jobs.get(task_id).work_dir)
+        resp = client.delete(f"/v1/task/{task_id}")
+        assert resp.status_code == 200
+        assert resp.json() == {"task_id": task_id, "state": "cancelled", "previous_state": "pending"}
+        assert not work.exists()
+        status = client.get(f"/v1/task/{task_id}").json()["data"]
+        assert status["state"] == "cancelled" and status["end_time"] is not None
+        assert client.delete(f"/v1/task/{task_id}").status_code == 200
+        assert client.get(f"/v1/task/{task_id}/result").status_code == 409
+
+        done_id = client.post("/v1/task", files=files).json()["task_id"]
+        r.ctx.tasks.set_state(done_id, "done")
+        resp = client.delete(f"/v1/task/{done_id}")
+        assert resp.status_code == 409 and "done" in resp.json()["detail"]
+
+
+def test_write_upload_stream_copies_rolled_over_spool_and_hashes():
+    import asyncio
+    import hashlib
+
+    from fastapi import HTTPException
+    from starlette.datastructures import UploadFile
+
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+
+        payload = os.urandom(3 * 1024 * 1024 + 17)
+
+        def spooled() -> UploadFile:
+            # Same spool the multipart parser uses; small max_size forces the rollover
+            spool = tempfile.SpooledTemporaryFile(max_size=1024)
+            spool.write(payload)
+            spool.seek(0)
+            assert spool._rolled
+            return UploadFile(spool, filename="big.docx")
+
+        dest = td / "work" / "t1" / "big.docx"
+        h = asyncio.run(r.write_upload_stream(spooled(), dest))
+        assert dest.read_bytes() == payload
+        assert h.hexdigest() == hashlib.sha256(payload).hexdigest()
+
+        with pytest.raises(HTTPException) as ei:
+            asyncio.run(r.write_upload_stream(spooled(), td / "work" / "t2" / "big.docx", max_bytes=1024 * 1024))
+        assert ei.value.status_code == 413
+        assert not (td / "work" / "t2" / "big.docx").exists()
+
+
+def test_batch_debug_tasks_get_shared_stylemap_artifacts():
+    import json
+
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        os.environ["DATA_ROOT"] = str(td / "data")
+        os.environ["WORK_ROOT"] = str(td / "work")
+        os.environ["LOG_DIR"] = str(td / "logs")
+        repo_docx2tex = Path.cwd() / "docx2tex"
+        os.environ["DOCX2TEX_HOME"] = str(repo_docx2tex if repo_docx2tex.exists() else (td / "d2t"))
+
+        import app.api.routes as routes
+        r = importlib.reload(routes)
+        from fastapi.testclient import TestClient
+        from app.core.package import debug_entries
+
+        app = FastAPI()
+        app.include_router(r.router)
+        client = TestClient(app)
+        r.ctx.jobs.submit = lambda **kwargs: None  # type: ignore[assignment]
+
+        conf_xml = b"<?xml version='1.0'?><set xmlns='http://transpect.io/xml2tex'><import href='conf.xml'/></set>"
+        files = [
+            ("files", ("a.docx", b"DOCX-A", "application/octet-stream")),
+            ("files", ("b.docx", b"DOCX-B", "application/octet-stream")),
+            ("conf", ("conf.xml", conf_xml, "application/xml")),
+        ]
+        data = {"debug": "true", "StyleMap": json.dumps({"Heading1": "I级标题"})}
+        resp = client.post("/v1/batch", data=data, files=files)
+        assert resp.status_code == 200
+        for t in resp.json()["tasks"]:
+            work = Path(r.ctx.jobs.get(t["task_id"]).work_dir)
+            arcs = [arc for arc, _ in debug_entries(work, Path(t["source"]).stem, None)]
+            assert "stylemap_manifest.json" in arcs
@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import threading
+
+from app.core.scheduler import PriorityPool
+
+
+def test_runs_lowest_key_first_and_supports_cancel():
+    pool = PriorityPool(1)
+    gate = threading.Event()
+    order: list[str] = []
+    done = threading.Event()
+    started = threading.Event()
+
+    def block() -> None:
+        started.set()
+        gate.wait()
+
+    pool.submit(0, block)  # occupies the only worker
+    assert started.wait(5)
+
+    entries = {name: pool.submit(key, order.append, name) for name, key in (("big", 50), ("small", 1), ("mid", 10))}
+    late = pool.submit(1, order.append, "small-later")
+    assert pool.pending() == 4
+    assert pool.position(entries["small"]) == 1
+    assert pool.position(late) == 2
+    assert pool.position(entries["big"]) == 4
+
+    assert pool.cancel(entries["mid"]) is True
+    assert pool.cancel(entries["mid"]) is False
+    assert pool.position(entries["big"]) == 3
+    pool.submit(1000, done.set)
+    gate.set()
+    assert done.wait(5)
+    assert order == ["small", "small-later", "big"]
+    assert pool.pending() == 0 and pool.position(entries["big"]) is None
@@ -5,7 +5,7 @@ import tempfile
 from pathlib import Path
 
 from app.core.db import Database
-from app.core.tasks import TaskStore
+from app.core.tasks import StatusCache, TaskStore
 from app.core.models import JobState
 
 
@@ -38,3 +38,103 @@ def test_taskstore_insert_get_update_sha():
         store.set_sha256("t1", "abcd")
         assert store.get("t1").sha256 is None or isinstance(store.get("t1").sha256, str)
 
+
+
+def test_taskstore_write_behind_reads_own_writes_and_flushes_terminal():
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        store = TaskStore(db, write_behind_sec=3600)
+        plain = TaskStore(db)
+        store.insert(
+            JobState(task_id="t1", state="pending", start_time=time.time(), work_dir=str(Path(td) / "t1"))
+        )
+
+        store.set_state("t1", "running")
+        store.set_state("t1", "converting")
+        # own reads see the pending write; the row itself is not written yet
+        assert store.get("t1").state == "converting"
+        assert plain.get("t1").state == "pending"
+
+        assert store.flush() == 1
+        assert plain.get("t1").state == "converting"
+
+        store.set_state("t1", "packaging")
+        store.set_state("t1", "done")
+        after = plain.get("t1")
+        assert after.state == "done" and after.end_time is not None
+
+
+def test_status_cache_write_through_and_cross_process_invalidation():
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        cache = StatusCache(db, max_entries=8, check_interval_sec=0)
+        store = TaskStore(db, status_cache=cache)
+        store.insert(
+            JobState(task_id="t1", state="pending", start_time=time.time(), work_dir=str(Path(td) / "t1"))
+        )
+        assert store.get("t1").state == "pending"
+        assert store.get("t1").state == "pending"
+        assert cache.hits >= 1
+
+        store.set_state("t1", "running")
+        assert store.get("t1").state == "running"
+
+        # another "worker" with its own Database writes behind our back
+        other = TaskStore(Database(Path(td) / "state.db"))
+        other.set_state("t1", "done")
+        assert store.get("t1").state == "done"
+
+
+def test_status_cache_drops_only_changed_tasks():
+    from app.core.cleanup import _prune_task_changes
+
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        cache = StatusCache(db, max_entries=8, check_interval_sec=0)
+        store = TaskStore(db, status_cache=cache)
+        for tid in ("t1", "t2"):
+            store.insert(JobState(task_id=tid, state="pending", start_time=time.time(), work_dir=str(Path(td) / tid)))
+            store.get(tid)
+
+        # local and foreign writes to t1 leave t2 cached
+        store.set_state("t1", "running")
+        other = TaskStore(Database(Path(td) / "state.db"))
+        other.set_state("t1", "converting")
+        hits = cache.hits
+        assert store.get("t2").state == "pending"
+        assert cache.hits == hits + 1
+        assert store.get("t1").state == "converting"
+
+        # changes pruned before this process saw them: everything is dropped
+        other.set_state("t2", "running")
+        other.set_state("t1", "packaging")
+        assert _prune_task_changes(db, keep=1) >= 1
+        assert store.get("t2").state == "running"
+        assert store.get("t1").state == "packaging"
+
+
+def test_stages_are_written_behind_and_served_from_the_cache():
+    with tempfile.TemporaryDirectory() as td:
+        db = Database(Path(td) / "state.db")
+        db.init_schema()
+        cache = StatusCache(db, max_entries=8, check_interval_sec=3600)
+        store = TaskStore(db, write_behind_sec=3600, status_cache=cache)
+        plain = TaskStore(db)
+        store.insert(JobState(task_id="t1", state="pending", start_time=time.time(), work_dir=str(Path(td) / "t1")))
+        store.get("t1")
+
+        store.add_stage("t1", "hashing", 2.0, 0.1)
+        store.add_stage("t1", "input", 1.0, 0.5, {"bytes": 10})
+        # pending records are visible to the writer only
+        assert [s["stage"] for s in store.stages("t1")] == ["input", "hashing"]
+        assert plain.stages("t1") == []
+
+        # appends also land in the cached timeline, in start order
+        store.add_stage("t1", "queue_wait", 3.0, 0.2)
+        assert [s["stage"] for s in store.stages("t1")] == ["input", "hashing", "queue_wait"]
+
+        assert store.flush() == 3
+        assert plain.stages("t1")[0] == {"stage": "input", "started": 1.0, "duration": 0.5, "detail": {"bytes": 10}}
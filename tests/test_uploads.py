@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+from app.core.uploads import UploadError, UploadStore
+
+
+def test_resumable_upload_hashes_incrementally_and_resumes_elsewhere():
+    with tempfile.TemporaryDirectory() as td:
+        root = Path(td) / "uploads"
+        store = UploadStore(root, max_bytes=100)
+        sess = store.create("big.docx", size=10)
+        uid = sess["upload_id"]
+
+        with store.open_append(uid, 0) as w:
+            w.write(b"hello")
+        assert store.get(uid)["offset"] == 5
+
+        with pytest.raises(UploadError) as ei:
+            with store.open_append(uid, 0):
+                pass
+        assert ei.value.status_code == 409 and ei.value.offset == 5
+
+        # Over the declared size: the request's bytes are rolled back
+        with pytest.raises(UploadError) as ei:
+            with store.open_append(uid, 5) as w:
+                w.write(b"wor")
+                w.write(b"ld!!")
+        assert ei.value.status_code == 413
+        assert store.get(uid)["offset"] == 5
+
+        with pytest.raises(UploadError):
+            store.finish(uid)  # incomplete
+
+        # Another worker (fresh store) continues the same session
+        other = UploadStore(root, max_bytes=100)
+        with other.open_append(uid, 5) as w:
+            w.write(b"world")
+        path, sha, meta = other.finish(uid, hashlib.sha256(b"helloworld").hexdigest())
+        assert sha == hashlib.sha256(b"helloworld").hexdigest()
+        assert path.read_bytes() == b"helloworld" and meta["filename"] == "big.docx"
+        with pytest.raises(UploadError) as ei:
+            other.finish(uid, "0" * 64)
+        assert ei.value.status_code == 422
+
+        # sealed: no more bytes, from this worker or another one
+        for s in (store, other):
+            with pytest.raises(UploadError) as ei:
+                with s.open_append(uid, 10) as w:
+                    w.write(b"EVIL")
+            assert ei.value.status_code == 409
+        assert path.read_bytes() == b"helloworld"
+        # once the data has been moved away, finalize can still be repeated
+        path.rename(Path(td) / "blob")
+        assert store.finish(uid)[:2] == (None, sha)
+        assert store.get(uid)["offset"] == 10
+
+        other.discard(uid)
+        with pytest.raises(UploadError):
+            store.get(uid)
+
+
+def test_upload_limits_and_stale_cleanup():
+    with tempfile.TemporaryDirectory() as td:
+        store = UploadStore(Path(td), max_bytes=4)
+        with pytest.raises(UploadError) as ei:
+            store.create("x.docx", size=5)
+        assert ei.value.status_code == 413
+        uid = store.create("x.docx")["upload_id"]
+        with pytest.raises(UploadError):
+            with store.open_append(uid, 0) as w:
+                w.write(b"12345")
+        fresh = store.create("y.docx")["upload_id"]
+        old = time.time() - 7200
+        os.utime(Path(td) / uid / "data", (old, old))
+        assert store.cleanup(3600) == 1
+        assert store.get(fresh)["offset"] == 0
+        with pytest.raises(UploadError) as ei:
+            store.get("../etc")
+        assert ei.value.status_code == 404